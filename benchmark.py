@@ -0,0 +1,197 @@
+# Benchmarks of the encode, demodulation, sync and packet code, using
+# synthetic signals, so no audio interface or recording is needed. Every
+# benchmark reports how many samples (or bytes) it processes per second. For
+# audio, the realtime factor is how many seconds of audio are processed in a
+# second: a receiver with a realtime factor below 1 falls behind live audio,
+# and 1 divided by the factor is the fraction of a CPU core it needs.
+#
+#   python benchmark.py                          print results
+#   python benchmark.py results.json             also save results as JSON
+#   python benchmark.py results.json old.json    also compare with old results
+#
+# Save results of two revisions on the same machine to compare them.
+
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from typing import Callable, Optional
+
+import numpy as np
+
+import compression
+import crc16
+import decode_fsk
+import decode_mfsk
+from digital_pll import DigitalPLL
+import encode
+from modem import ModemConfig
+import packet
+import smallgzip
+import tone_conversion
+
+
+# Every benchmark is repeated this many times, the fastest run is reported
+REPEAT = 5
+
+# Synthetic signals have noise with this standard deviation, about 30 dB
+# below the signal, so every profile decodes the whole message
+NOISE = 300
+
+# Test message, a mix of text and random bytes, so it compresses a bit
+MESSAGE = (b'GET /index.html HTTP/1.1\r\nHost: example.com\r\nAccept: */*\r\n\r\n' +
+           np.random.default_rng(0).integers(0, 256, 128, dtype='u1').tobytes())
+
+# Data for the crc16 and compression benchmarks
+DATA = MESSAGE * 8
+
+
+def configs() -> list[tuple[str, ModemConfig]]:
+    # MFSK with different numbers of tone bits, the other MFSK profiles and
+    # both FSK profiles
+    result = [(f'mfsk TONE_BITS={bits}', ModemConfig.from_profile('mfsk', TONE_BITS=bits)) for bits in (2, 3, 4, 6)]
+    for name in ['mfsk-fast', 'mfsk-coded', 'mfsk-multi', 'fsk', 'fsk-600']:
+        result.append((name, ModemConfig.from_profile(name)))
+    return result
+
+
+def measure(function: Callable[[], object]) -> float:
+    # Seconds for a single call of function
+    timer = timeit.Timer(function)
+    number, _seconds = timer.autorange()
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def result(name: str, profile: Optional[str], unit: str, size: int, seconds: float,
+           sample_rate: Optional[int] = None) -> dict:
+    # sample_rate is only given for benchmarks that process or produce audio
+    return {
+        'name': name,
+        'profile': profile,
+        'unit': unit,
+        'size': size,
+        'seconds': seconds,
+        'per_second': size / seconds,
+        'realtime_factor': None if sample_rate is None else size / sample_rate / seconds,
+    }
+
+
+def signal(config: ModemConfig) -> np.ndarray:
+    # Transmission of MESSAGE with noise, and noise before and after it
+    rng = np.random.default_rng(1)
+    audio = encode.data_to_audio(MESSAGE, config)
+    padding = np.zeros(config.SAMPLE_RATE // 4)
+    samples = np.concatenate((padding, audio / 2, padding))
+    samples = samples + rng.normal(0, NOISE, len(samples))
+    return np.clip(samples, -32768, 32767).astype('i2')
+
+
+def benchmark_config(profile: str, config: ModemConfig) -> list[dict]:
+    config.precompute()
+    results = []
+    rate = config.SAMPLE_RATE
+    send_data = packet.pack(MESSAGE)
+    tones = encode.packet_to_tones(send_data, config)
+    samples = signal(config)
+
+    seconds = measure(lambda: encode.tones_to_sine_gauss(tones, config))
+    size = encode.Synthesizer(tones, config).size
+    results.append(result('encode.tones_to_sine_gauss', profile, 'samples', size, seconds, rate))
+
+    if config.MFSK:
+        seconds = measure(lambda: decode_mfsk.find_first_tone_midpoint(samples, config))
+        results.append(result('decode_mfsk.find_first_tone_midpoint', profile, 'samples', len(samples), seconds, rate))
+
+        start = decode_mfsk.find_first_tone_midpoint(samples, config)
+        if start is None:
+            print(profile, 'sync not found, skipping audio_to_tones')
+        else:
+            seconds = measure(lambda: decode_mfsk.audio_to_tones(samples, start, config))
+            results.append(result('decode_mfsk.audio_to_tones', profile, 'samples', len(samples) - start, seconds, rate))
+    else:
+        seconds = measure(lambda: decode_fsk.decode(samples, config=config))
+        results.append(result('decode_fsk.decode', profile, 'samples', len(samples), seconds, rate))
+
+        # Ideal bit signal with a sample for every audio sample, as the PLL
+        # gets it from the low pass filter
+        bits_signal = np.repeat(tones.astype(bool), config.SAMPLES_PER_TONE)
+        seconds = measure(lambda: DigitalPLL(rate, config.TONES_PER_SECOND).process(bits_signal))
+        results.append(result('DigitalPLL.process', profile, 'samples', len(bits_signal), seconds, rate))
+
+    seconds = measure(lambda: tone_conversion.bytes_to_tones(send_data, config))
+    results.append(result('tone_conversion.bytes_to_tones', profile, 'bytes', len(send_data), seconds))
+    tone_list = tones.tolist()
+    seconds = measure(lambda: tone_conversion.tones_to_bytes(tone_list, config))
+    results.append(result('tone_conversion.tones_to_bytes', profile, 'bytes', len(send_data), seconds))
+    return results
+
+
+def benchmark_packet() -> list[dict]:
+    results = []
+    seconds = measure(lambda: crc16.crc16(DATA))
+    results.append(result('crc16.crc16', None, 'bytes', len(DATA), seconds))
+
+    compressed = smallgzip.compress(DATA)
+    seconds = measure(lambda: smallgzip.compress(DATA))
+    results.append(result('smallgzip.compress', None, 'bytes', len(DATA), seconds))
+    seconds = measure(lambda: smallgzip.decompress(compressed))
+    results.append(result('smallgzip.decompress', None, 'bytes', len(DATA), seconds))
+
+    compressed = compression.compress(MESSAGE)
+    seconds = measure(lambda: compression.compress(MESSAGE))
+    results.append(result('compression.compress', None, 'bytes', len(MESSAGE), seconds))
+    seconds = measure(lambda: compression.decompress(compressed))
+    results.append(result('compression.decompress', None, 'bytes', len(MESSAGE), seconds))
+
+    send_data = packet.pack(MESSAGE)
+    seconds = measure(lambda: packet.unpack(send_data))
+    results.append(result('packet.unpack', None, 'bytes', len(send_data), seconds))
+    return results
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(r: dict, previous: Optional[dict] = None):
+    line = f'{r["name"]:<38} {r["profile"] or "":<16} {r["per_second"]:>12.4g} {r["unit"]}/s'
+    if r['realtime_factor'] is not None:
+        line += f'  {r["realtime_factor"]:>8.1f}x realtime'
+    if previous is not None:
+        line += f'  ({previous["seconds"] / r["seconds"]:.2f}x previous)'
+    print(line)
+
+
+if __name__ == '__main__':
+    previous = {}
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            previous = {(r['name'], r['profile']): r for r in json.load(f)['results']}
+
+    results = []
+    for profile, config in configs():
+        for r in benchmark_config(profile, config):
+            print_result(r, previous.get((r['name'], r['profile'])))
+            results.append(r)
+    for r in benchmark_packet():
+        print_result(r, previous.get((r['name'], r['profile'])))
+        results.append(r)
+
+    if len(sys.argv) > 1:
+        output = {
+            'revision': revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'results': results,
+        }
+        with open(sys.argv[1], 'w') as f:
+            json.dump(output, f, indent=2)
+        print('saved results to', sys.argv[1])
@@ -0,0 +1,380 @@
+# Network bridge between a TUN interface and the modem, as a single asyncio
+# program. Packets read from the TUN interface are sent as audio, packets
+# decoded from audio input are written to the TUN interface. See README.md
+# for creating the interface.
+#
+# Nothing polls or sleeps: the TUN file descriptor is watched by the event
+# loop, the audio callbacks wake up the event loop when samples arrive or a
+# transmission has been played, and link layer timers are awaited directly.
+# Encoding and decoding run in worker threads, so they do not block the
+# event loop.
+
+import asyncio
+import logging
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+import decode_fsk_realtime
+import decode_mfsk_realtime
+from compression import DecompressError, StreamCompressor, StreamDecompressor
+from encode import Transmission
+from header_compression import HeaderCompressor, HeaderDecompressor, HeaderDecompressError
+import link
+from link import LinkEndpoint, LinkFrameError
+import metrics
+import modem
+from modem import ModemConfig
+import packet
+from ring_buffer import RingBuffer
+import settings
+import tun
+
+
+log = logging.getLogger(__name__)
+
+class AudioOutput:
+    """
+    Plays transmissions through an output stream, and silence when there is
+    nothing to send, so the audio interface stays awake. The stream callback
+    synthesizes samples of queued transmissions directly into the output
+    buffer, and resolves the future of a transmission when its last sample
+    has been written.
+    """
+    config: ModemConfig
+    loop: asyncio.AbstractEventLoop
+    pending: deque
+
+    def __init__(self, config: ModemConfig, loop: asyncio.AbstractEventLoop):
+        self.config = config
+        self.loop = loop
+        self.pending = deque()
+
+    def callback(self, outdata: np.ndarray, frames: int, _time, status):
+        if status:
+            log.warning('%s', status)
+            metrics.count('audio_status')
+        out = outdata[:, 0]
+        filled = 0
+        while filled < frames and self.pending:
+            transmission, future = self.pending[0]
+            filled += transmission.fill(out[filled:])
+            if transmission.done:
+                self.pending.popleft()
+                self.loop.call_soon_threadsafe(future.set_result, None)
+        out[filled:] = 0
+
+    async def play(self, transmission: Transmission):
+        # Returns when all samples have been passed to the audio interface
+        future = self.loop.create_future()
+        self.pending.append((transmission, future))
+        await future
+
+
+class Bridge:
+    """
+    Forwards packets between a TUN file descriptor and the modem. Packets
+    from the TUN interface wait in a bounded queue. When the queue is full,
+    the interface is no longer read, so the kernel queue fills up and the
+    kernel drops packets, instead of an ever growing delay. Frames that are
+    ready at the same time are combined in a single transmission. With
+    BRIDGE_ARQ, packets are sent using the selective repeat link layer (see
+    link.py), otherwise every packet is sent once. With HEADER_COMPRESSION,
+    packet headers are compressed before they are queued, and decompressed
+    before packets are written to the interface. With COMPRESSION_STREAM,
+    packets are also compressed with a shared history after header
+    compression.
+    """
+    config: ModemConfig
+    tun_fd: int
+    play: Callable[[Transmission], Awaitable[None]]
+    link: Optional[LinkEndpoint]
+    loop: asyncio.AbstractEventLoop
+    tx_queue: asyncio.Queue
+    wakeup: asyncio.Event
+    input_ready: asyncio.Event
+    reading: bool
+    held: Optional[bytes]
+    compressor: Optional[HeaderCompressor]
+    decompressor: Optional[HeaderDecompressor]
+    stream_compressor: Optional[StreamCompressor]
+    stream_decompressor: Optional[StreamDecompressor]
+    decoded: list[bytes]
+    processor: object
+    buffer: RingBuffer
+    process_size: int
+    samples_since_process: int
+    encode_executor: ThreadPoolExecutor
+    decode_executor: ThreadPoolExecutor
+
+    def __init__(self, tun_fd: int, play: Callable[[Transmission], Awaitable[None]],
+                 config: Optional[ModemConfig] = None, use_arq: bool = settings.BRIDGE_ARQ):
+        # Must be created in a coroutine, uses the running event loop
+        self.config = modem.get(config)
+        assert self.config.CHANNELS == 1
+        self.tun_fd = tun_fd
+        os.set_blocking(tun_fd, False)
+        self.play = play
+        self.link = LinkEndpoint(self.config) if use_arq else None
+        self.loop = asyncio.get_running_loop()
+        self.tx_queue = asyncio.Queue(settings.BRIDGE_QUEUE_SIZE)
+        self.wakeup = asyncio.Event()
+        self.input_ready = asyncio.Event()
+        self.reading = False
+        # Packet taken from the queue that did not fit in the previous
+        # transmission, only used without link layer
+        self.held = None
+        if settings.HEADER_COMPRESSION:
+            self.compressor = HeaderCompressor()
+            self.decompressor = HeaderDecompressor()
+        else:
+            self.compressor = None
+            self.decompressor = None
+        if settings.COMPRESSION_STREAM:
+            self.stream_compressor = StreamCompressor()
+            self.stream_decompressor = StreamDecompressor()
+        else:
+            self.stream_compressor = None
+            self.stream_decompressor = None
+        self.encode_executor = ThreadPoolExecutor(1)
+        self.decode_executor = ThreadPoolExecutor(1)
+
+        # Messages decoded by the processor are collected in process_input()
+        self.decoded = []
+        if self.config.MFSK:
+            self.buffer = RingBuffer(self.config.RECORD_BUFFER_SIZE)
+            self.processor = decode_mfsk_realtime.AudioProcessor(self.buffer, self.config, self.decoded.append)
+            self.process_size = self.config.RECORD_PROCESS_SIZE
+        else:
+            self.processor = decode_fsk_realtime.AudioProcessor(self.config, on_message=self.decoded.append)
+            self.buffer = self.processor.buffer
+            self.process_size = self.config.REALTIME_PROCESS_MINIMUM
+        self.samples_since_process = 0
+
+    async def run(self):
+        self.config.precompute()
+        self.resume_reading()
+        await asyncio.gather(self.transmit(), self.receive())
+
+    # Packets from the TUN interface
+
+    def resume_reading(self):
+        self.loop.add_reader(self.tun_fd, self.read_tun)
+        self.reading = True
+
+    def read_tun(self):
+        # Read all packets that are available, without blocking
+        while not self.tx_queue.full():
+            try:
+                data = os.read(self.tun_fd, 4096)
+            except BlockingIOError:
+                return
+            if self.compressor is not None:
+                data = self.compressor.compress(data)
+            if self.stream_compressor is not None:
+                data = self.stream_compressor.compress(data, link.MAX_PAYLOAD_SIZE)
+            if len(data) > link.MAX_PAYLOAD_SIZE:
+                log.warning('dropping packet larger than maximum packet size, lower the interface MTU')
+                metrics.count('packets_too_large')
+                continue
+            self.tx_queue.put_nowait(data)
+            metrics.count('tun_packets_read')
+            self.wakeup.set()
+        # Queue is full, continue reading when a packet is taken from the queue
+        self.loop.remove_reader(self.tun_fd)
+        self.reading = False
+
+    def packet_taken(self):
+        # A packet was taken from the queue, there is room for another one
+        if not self.reading:
+            self.resume_reading()
+
+    def fill_link(self):
+        # Packets stay in the bounded queue until the link layer can send
+        # them, so a full window also stops reading
+        while not self.tx_queue.empty() and not self.link.queue:
+            self.link.send(self.tx_queue.get_nowait())
+            self.packet_taken()
+
+    async def next_frame(self) -> bytes:
+        # Next frame to send, waits until there is one
+        if self.link is None:
+            if self.held is not None:
+                data, self.held = self.held, None
+                return data
+            data = await self.tx_queue.get()
+            self.packet_taken()
+            return data
+
+        while True:
+            self.fill_link()
+            now = self.loop.time()
+            frame = self.link.poll(now)
+            if frame is not None:
+                return frame
+            # Wait for a packet, a received frame or a link layer timer
+            event = self.link.next_event(now)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), None if event is None else event - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def ready_frame(self, max_size: int, now: float) -> Optional[bytes]:
+        # Frame that can be sent right away, if it is not larger than max_size
+        if self.link is not None:
+            self.fill_link()
+            return self.link.poll(now, max_size)
+
+        if self.held is None:
+            if self.tx_queue.empty():
+                return None
+            self.held = self.tx_queue.get_nowait()
+            self.packet_taken()
+        if len(self.held) > max_size:
+            return None
+        data, self.held = self.held, None
+        return data
+
+    async def next_frames(self) -> list[bytes]:
+        # Frames for the next transmission: the next frame, and other frames
+        # that are ready to be sent, as long as they fit in AGGREGATE_MAX_SIZE
+        # bytes. This way, multiple frames share the noise, sync sweep and end
+        # tone of a single transmission.
+        first_order = self.link.send_order if self.link is not None else 0
+        frames = [await self.next_frame()]
+        if settings.AGGREGATE_DELAY > 0:
+            await asyncio.sleep(settings.AGGREGATE_DELAY)
+
+        now = self.loop.time()
+        size = packet.SUBPACKET_HEADER.size + len(frames[0])
+        while True:
+            frame = self.ready_frame(settings.AGGREGATE_MAX_SIZE - size - packet.SUBPACKET_HEADER.size, now)
+            if frame is None:
+                break
+            frames.append(frame)
+            size += packet.SUBPACKET_HEADER.size + len(frame)
+
+        if self.link is not None and len(frames) > 1:
+            self.link.sent_together(first_order, now, size)
+        return frames
+
+    async def transmit(self):
+        while True:
+            frames = await self.next_frames()
+            start = self.loop.time()
+            transmission = await self.loop.run_in_executor(self.encode_executor, self.frames_to_audio, frames)
+            metrics.observe('encode_time', self.loop.time() - start)
+            await self.play(transmission)
+            # Encoding, waiting for the output stream and playing
+            metrics.observe('transmit_time', self.loop.time() - start)
+            metrics.count('transmissions_sent')
+            metrics.count('frames_sent', len(frames))
+
+    def frames_to_audio(self, frames: list[bytes]) -> Transmission:
+        # Runs in the encode thread. Samples are synthesized by the output
+        # stream callback, while they are played.
+        return Transmission(packet.pack_many(frames), self.config, noise=False)
+
+    # Packets from audio input
+
+    def add_samples(self, samples: np.ndarray):
+        # Called by the audio input callback with 16 bit samples for a single
+        # channel. Wakes up receive() when enough samples have arrived.
+        self.buffer.write(samples)
+        metrics.count('samples_captured', len(samples))
+        self.samples_since_process += len(samples)
+        if self.samples_since_process >= self.process_size:
+            self.samples_since_process = 0
+            self.loop.call_soon_threadsafe(self.input_ready.set)
+
+    def process_input(self) -> list[bytes]:
+        # Runs in the decode thread, returns decoded messages
+        if self.config.MFSK:
+            self.processor.update_buffer(self.buffer.pos)
+        self.processor.process()
+        messages = list(self.decoded)
+        self.decoded.clear()
+        return messages
+
+    async def receive(self):
+        while True:
+            await self.input_ready.wait()
+            self.input_ready.clear()
+            for message in await self.loop.run_in_executor(self.decode_executor, self.process_input):
+                self.receive_frame(message)
+
+    def receive_frame(self, frame: bytes):
+        if self.link is None:
+            self.deliver(frame)
+            return
+        try:
+            packets = self.link.receive(frame, self.loop.time())
+        except LinkFrameError as ex:
+            log.info('invalid frame: %s', ex)
+            metrics.count('invalid_frames')
+            return
+        # An acknowledgement may be due, or frames may have been acknowledged
+        self.wakeup.set()
+        for data in packets:
+            self.deliver(data)
+
+    def deliver(self, data: bytes):
+        if self.stream_decompressor is not None:
+            try:
+                data = self.stream_decompressor.decompress(data)
+            except DecompressError as ex:
+                log.info('dropping packet: %s', ex)
+                metrics.count('packets_dropped')
+                return
+        if self.decompressor is not None:
+            try:
+                data = self.decompressor.decompress(data)
+            except HeaderDecompressError as ex:
+                log.info('dropping packet: %s', ex)
+                metrics.count('packets_dropped')
+                return
+        self.write_tun(data)
+
+    def write_tun(self, data: bytes):
+        # Only IPv4 and IPv6 packets are accepted by the interface
+        if len(data) == 0 or data[0] >> 4 not in (4, 6):
+            log.info('not an IP packet, dropping')
+            metrics.count('packets_dropped')
+            return
+        try:
+            os.write(self.tun_fd, data)
+        except OSError as ex:
+            log.warning('could not write packet to interface: %s', ex)
+            return
+        metrics.count('tun_packets_written')
+
+
+async def main(tun_name: str):
+    import sounddevice as sd
+
+    metrics.setup()
+    config = modem.DEFAULT
+    loop = asyncio.get_running_loop()
+    output = AudioOutput(config, loop)
+    bridge = Bridge(tun.tun_open(tun_name), output.play, config)
+
+    def input_callback(indata, _frames, _time, status):
+        if status:
+            log.warning('%s', status)
+            metrics.count('audio_status')
+        bridge.add_samples(indata[:, 0].copy())
+
+    with sd.OutputStream(samplerate=config.SAMPLE_RATE, latency='high', channels=1, dtype='int16',
+                         callback=output.callback), \
+            sd.InputStream(samplerate=config.SAMPLE_RATE, latency='high', channels=1, dtype='int16',
+                           callback=input_callback):
+        await bridge.run()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else settings.TUN_NAME))
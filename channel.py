@@ -0,0 +1,164 @@
+# Simulated audio channel between the encoder and the decoders, for testing
+# modem settings without speakers and microphones. Audio produced by
+# encode.data_to_audio() goes through the same impairments as over the air:
+# multipath echoes, a frequency offset between transmitter and receiver, a
+# sample clock that runs slightly faster or slower, noise, clipping and
+# dropouts. Results are repeatable, every impairment uses the random seed of
+# the channel. See sweep.py for error rates over many simulated transmissions.
+
+import sys
+from typing import Optional
+
+import numpy as np
+
+import decode_fsk
+import decode_mfsk
+import encode
+import modem
+from modem import ModemConfig
+import packet
+from packet import BasePacketDecodeError
+
+
+class Channel:
+    """
+    Impairments of a simulated channel. All impairments are off by default.
+
+    snr is the ratio in dB of the average power of the transmission to the
+    power of white noise over the whole band (0 Hz to half the sample rate).
+    frequency_offset shifts all frequencies by a number of Hz, as with
+    radios that are not tuned to exactly the same frequency. clock_drift is
+    how much faster (in parts per million) the sample clock of the receiver
+    runs than that of the transmitter. echoes are (delay in seconds, gain)
+    pairs of delayed copies of the signal. Dropouts of dropout_length
+    seconds, where the receiver gets silence, occur on average dropout_rate
+    times per second. clip_level clips samples at a fraction of the maximum
+    sample value.
+    """
+    snr: Optional[float]
+    frequency_offset: float
+    clock_drift: float
+    echoes: list[tuple[float, float]]
+    dropout_rate: float
+    dropout_length: float
+    clip_level: Optional[float]
+    rng: np.random.Generator
+
+    def __init__(self, snr: Optional[float] = None, frequency_offset: float = 0.0, clock_drift: float = 0.0,
+                 echoes: list[tuple[float, float]] = [], dropout_rate: float = 0.0, dropout_length: float = 0.01,
+                 clip_level: Optional[float] = None, seed: Optional[int] = None):
+        self.snr = snr
+        self.frequency_offset = frequency_offset
+        self.clock_drift = clock_drift
+        self.echoes = list(echoes)
+        self.dropout_rate = dropout_rate
+        self.dropout_length = dropout_length
+        self.clip_level = clip_level
+        self.rng = np.random.default_rng(seed)
+
+    def transmit(self, audio: np.ndarray, config: Optional[ModemConfig] = None) -> np.ndarray:
+        # 16 bit samples as received for a transmission, with NOISE_SAMPLES
+        # of silence before and after it, so the receiver has to find the
+        # start of the transmission in noise
+        config = modem.get(config)
+        audio = np.asarray(audio, dtype=float)
+        power = np.mean(audio ** 2) if len(audio) > 0 else 0.0
+        silence = np.zeros(config.NOISE_SAMPLES)
+        samples = np.concatenate((silence, audio, silence))
+
+        samples = self.add_echoes(samples, config.SAMPLE_RATE)
+        if self.frequency_offset != 0:
+            samples = shift_frequency(samples, self.frequency_offset, config.SAMPLE_RATE)
+        if self.clock_drift != 0:
+            samples = resample(samples, 1 + self.clock_drift * 1e-6)
+        if self.snr is not None:
+            noise_power = power / 10 ** (self.snr / 10)
+            samples += self.rng.normal(0, np.sqrt(noise_power), len(samples))
+        limit = config.OUTPUT_MAX if self.clip_level is None else self.clip_level * config.OUTPUT_MAX
+        samples = np.clip(samples, -limit, limit)
+        self.drop(samples, config.SAMPLE_RATE)
+        return samples.astype('i2')
+
+    def add_echoes(self, samples: np.ndarray, sample_rate: int) -> np.ndarray:
+        result = samples.copy()
+        for delay, gain in self.echoes:
+            offset = int(round(delay * sample_rate))
+            if 0 < offset < len(samples):
+                result[offset:] += gain * samples[:-offset]
+        return result
+
+    def drop(self, samples: np.ndarray, sample_rate: int):
+        # Silence random parts of samples, in place
+        count = self.rng.poisson(self.dropout_rate * len(samples) / sample_rate)
+        length = int(self.dropout_length * sample_rate)
+        for start in self.rng.integers(0, len(samples), count):
+            samples[start:start+length] = 0
+
+
+def shift_frequency(samples: np.ndarray, offset: float, sample_rate: int) -> np.ndarray:
+    # Single sideband shift of every frequency by offset Hz, using the
+    # analytic signal (negative frequencies removed)
+    spectrum = np.fft.fft(samples)
+    weights = np.zeros(len(samples))
+    weights[0] = 1
+    weights[1:(len(samples) + 1) // 2] = 2
+    if len(samples) % 2 == 0:
+        weights[len(samples) // 2] = 1
+    analytic = np.fft.ifft(spectrum * weights)
+    t = np.arange(len(samples)) / sample_rate
+    return np.real(analytic * np.exp(2j * np.pi * offset * t))
+
+
+def resample(samples: np.ndarray, ratio: float) -> np.ndarray:
+    # Samples as recorded by a sample clock running ratio times as fast,
+    # band limited resampling in the frequency domain
+    spectrum = np.fft.rfft(samples)
+    size = int(round(len(samples) * ratio))
+    bins = size // 2 + 1
+    if bins > len(spectrum):
+        spectrum = np.concatenate((spectrum, np.zeros(bins - len(spectrum))))
+    return np.fft.irfft(spectrum[:bins], size) * size / len(samples)
+
+
+def receive_bytes(samples: np.ndarray, config: Optional[ModemConfig] = None) -> bytes:
+    # Bytes decoded from a simulated transmission, as decode_mfsk.decode()
+    # and decode_fsk.decode() would receive them, before unpacking. Empty if
+    # the start of the transmission was not found.
+    config = modem.get(config)
+    if config.MFSK:
+        start = decode_mfsk.find_first_tone_midpoint(samples, config)
+        if start is None:
+            return b''
+        return decode_mfsk.audio_to_bytes(samples, start, config)
+    try:
+        return decode_fsk.audio_to_bytes(samples, config=config)
+    except BasePacketDecodeError:
+        return b''
+
+
+def unpack(data: bytes) -> Optional[bytes]:
+    # Message in received bytes, None if it was not received correctly
+    if len(data) < packet.header_size():
+        return None
+    try:
+        return packet.unpack(data)
+    except BasePacketDecodeError:
+        return None
+
+
+if __name__ == '__main__':
+    # Send a message with every impairment, usage: python channel.py [snr]
+    # At the default SNR of 20 dB the message is received with the settings
+    # in settings.py. At lower SNRs, and with FSK at times even without
+    # noise, the start of the transmission is missed: the exit status is
+    # then 1. See sweep.py for error rates over many transmissions.
+    config = modem.DEFAULT
+    snr = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    message = b'hello world, this message went through a simulated channel'
+    channel = Channel(snr, frequency_offset=2.0, clock_drift=20.0, echoes=[(0.001, 0.3)], seed=0)
+    samples = channel.transmit(encode.data_to_audio(message, config) / 2, config)
+    received = unpack(receive_bytes(samples, config))
+    if received != message:
+        print(f'snr {snr:.1f} dB: could not decode message')
+        sys.exit(1)
+    print(f'snr {snr:.1f} dB: received', received)
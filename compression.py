@@ -0,0 +1,279 @@
+# Compression of packet messages, using raw deflate (no gzip header or
+# trailer, the packet checksum already detects corruption) primed with a
+# preset dictionary. Short messages have little history of their own to
+# refer to, with a dictionary of strings that are common in the traffic they
+# can refer to the dictionary instead.
+#
+# Every compressed message starts with a single byte: 0 for a message that is
+# sent uncompressed, because compression did not make it smaller, or 0x80
+# with the dictionary version in the lower 7 bits for a compressed message.
+# Dictionary version 0 means no dictionary. Dictionaries are stored as
+# dictionaries/<version>.bin and are never changed once used, a new
+# dictionary gets a new version. The receiver needs all dictionary versions
+# the sender may use.
+#
+# A dictionary can be trained from captured traffic, for example captured
+# using tcpdump -i tun0 -w capture.pcap:
+#   python compression.py train dictionaries/2.bin capture.pcap
+
+import functools
+import os
+import struct
+import sys
+import zlib
+from collections import Counter
+from typing import Optional
+
+import settings
+
+
+FLAG_COMPRESSED = 0x80
+MAX_VERSION = 0x7f
+
+# Raw deflate, maximum window and memory usage
+WINDOW_BITS = -15
+LEVEL = 9
+MEMORY_LEVEL = 9
+
+# Marker of the empty block ending a sync flush, every flushed stream message
+# ends with these bytes, so they are not sent
+SYNC_MARKER = b'\0\0\xff\xff'
+
+DICTIONARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dictionaries')
+
+
+class DecompressError(Exception):
+    """
+    Message can not be decompressed: it is corrupt, or uses a dictionary
+    version that is not available
+    """
+    pass
+
+
+class StreamError(DecompressError):
+    """
+    A compressed message of the stream was lost, so the history of the
+    stream is incomplete. Compressed messages are dropped until the
+    compressor starts a new stream.
+    """
+    pass
+
+
+@functools.lru_cache
+def dictionary(version: int) -> bytes:
+    if version == 0:
+        return b''
+    path = os.path.join(DICTIONARY_DIR, f'{version}.bin')
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        raise DecompressError(f'Dictionary version {version} not found')
+
+
+def compressor(version: int):
+    if version == 0:
+        return zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, MEMORY_LEVEL)
+    return zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, MEMORY_LEVEL, zdict=dictionary(version))
+
+
+def decompressor(version: int):
+    if version == 0:
+        return zlib.decompressobj(WINDOW_BITS)
+    return zlib.decompressobj(WINDOW_BITS, zdict=dictionary(version))
+
+
+def split_flag(data: bytes) -> tuple[bool, int]:
+    # Whether the message is compressed, and the dictionary version
+    if len(data) == 0:
+        raise DecompressError('Empty message')
+    if data[0] != 0 and not data[0] & FLAG_COMPRESSED:
+        raise DecompressError(f'Invalid flag {data[0]}')
+    return bool(data[0] & FLAG_COMPRESSED), data[0] & MAX_VERSION
+
+
+def compress(data: bytes, version: int = settings.COMPRESSION_DICTIONARY) -> bytes:
+    # Compressed message, or the uncompressed message if compression does
+    # not make it smaller
+    c = compressor(version)
+    compressed = c.compress(data) + c.flush()
+    if len(compressed) < len(data):
+        return bytes([FLAG_COMPRESSED | version]) + compressed
+    return b'\0' + data
+
+
+def decompress(data: bytes) -> bytes:
+    compressed, version = split_flag(data)
+    if not compressed:
+        return data[1:]
+    d = decompressor(version)
+    try:
+        decompressed = d.decompress(data[1:], settings.MAX_PACKET_SIZE + 1)
+    except zlib.error as ex:
+        raise DecompressError(str(ex))
+    if not d.eof or len(decompressed) > settings.MAX_PACKET_SIZE:
+        raise DecompressError('Invalid compressed message')
+    return decompressed
+
+
+class StreamCompressor:
+    """
+    Compresses messages with a history shared by all messages of a stream,
+    so messages can refer to previous messages, like repeated requests. The
+    receiver must receive compressed messages in order, which the ARQ link
+    layer provides, and can only continue the stream after a lost message
+    once the compressor starts a new stream. A new stream starts every
+    reset_interval compressed messages.
+
+    Compressed messages have a second byte with the position of the message
+    in the stream, 0 for the first message of a new stream. Messages sent
+    uncompressed are not part of the stream and have no position.
+    """
+    version: int
+    reset_interval: int
+    compressor: object
+    position: int
+
+    def __init__(self, version: int = settings.COMPRESSION_DICTIONARY,
+                 reset_interval: int = settings.COMPRESSION_STREAM_RESET):
+        assert 0 < reset_interval <= 256
+        self.version = version
+        self.reset_interval = reset_interval
+        self.position = reset_interval
+
+    def compress(self, data: bytes, max_size: Optional[int] = None) -> bytes:
+        # Messages that would be larger than max_size compressed are sent
+        # uncompressed, so a caller that drops them as too large does not
+        # leave a message in the history the receiver never gets
+        if self.position == self.reset_interval:
+            self.compressor = compressor(self.version)
+            self.position = 0
+        # Keep the state before this message, so the message can be left
+        # out of the history if it is sent uncompressed
+        previous = self.compressor.copy()
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        assert compressed.endswith(SYNC_MARKER)
+        compressed = compressed[:-len(SYNC_MARKER)]
+        too_large = max_size is not None and len(compressed) + 2 > max_size
+        if len(compressed) + 1 >= len(data) or too_large:
+            self.compressor = previous
+            return b'\0' + data
+        header = bytes([FLAG_COMPRESSED | self.version, self.position])
+        self.position += 1
+        return header + compressed
+
+
+class StreamDecompressor:
+    """
+    Restores messages created by a StreamCompressor
+    """
+    decompressor: object
+    position: int
+
+    def __init__(self):
+        self.decompressor = None
+        self.position = 0
+
+    def decompress(self, data: bytes) -> bytes:
+        compressed, version = split_flag(data)
+        if not compressed:
+            return data[1:]
+        if len(data) < 2:
+            raise DecompressError('Truncated message')
+        position = data[1]
+        if position == 0:
+            self.decompressor = decompressor(version)
+        elif self.decompressor is None or position != self.position:
+            self.decompressor = None
+            raise StreamError(f'Expected stream position {self.position}, message has position {position}')
+        self.position = position + 1
+
+        try:
+            decompressed = self.decompressor.decompress(data[2:] + SYNC_MARKER, settings.MAX_PACKET_SIZE + 1)
+        except zlib.error as ex:
+            self.decompressor = None
+            raise DecompressError(str(ex))
+        if len(decompressed) > settings.MAX_PACKET_SIZE:
+            self.decompressor = None
+            raise DecompressError('Invalid compressed message')
+        return decompressed
+
+
+def read_pcap(path: str) -> list[bytes]:
+    # Packets in a capture file written by tcpdump (libpcap format)
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, = struct.unpack_from('<I', data)
+    byte_order = '<' if magic in (0xa1b2c3d4, 0xa1b23c4d) else '>'
+    packets = []
+    offset = 24
+    while offset + 16 <= len(data):
+        _seconds, _fraction, size, _original_size = struct.unpack_from(byte_order + 'IIII', data, offset)
+        offset += 16
+        packets.append(data[offset:offset+size])
+        offset += size
+    return packets
+
+
+def train(samples: list[bytes], size: int = 4096, segment_size: int = 32, kmer_size: int = 6) -> bytes:
+    # Dictionary of segments that cover the byte sequences (k-mers) which
+    # occur in most samples. Segments are selected greedily, every k-mer only
+    # counts for the first segment that contains it. Deflate encodes nearby
+    # matches with fewer bits, so the best segments are placed at the end.
+    frequency = Counter()
+    for sample in samples:
+        frequency.update({sample[i:i+kmer_size] for i in range(len(sample) - kmer_size + 1)})
+    for kmer in [kmer for kmer, count in frequency.items() if count < 2]:
+        del frequency[kmer]
+
+    candidates = {sample[i:i+segment_size] for sample in samples
+                  for i in range(0, max(len(sample) - segment_size, 0) + 1, kmer_size)}
+    segments = []
+    total = 0
+    while total < size and candidates:
+        def score(segment: bytes) -> int:
+            kmers = {segment[i:i+kmer_size] for i in range(len(segment) - kmer_size + 1)}
+            return sum(frequency[kmer] for kmer in kmers)
+        best = max(candidates, key=score)
+        if score(best) == 0:
+            break
+        candidates.remove(best)
+        for i in range(len(best) - kmer_size + 1):
+            frequency[best[i:i+kmer_size]] = 0
+        segments.append(best)
+        total += len(best)
+    return b''.join(reversed(segments))[-size:]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3 and sys.argv[1] == 'train':
+        samples = [packet for path in sys.argv[3:] for packet in read_pcap(path)]
+        trained = train(samples)
+        with open(sys.argv[2], 'wb') as f:
+            f.write(trained)
+        print(f'trained dictionary of {len(trained)} bytes from {len(samples)} packets')
+        sys.exit(0)
+
+    messages = [b'GET / HTTP/1.1\r\nHost: example.com\r\nAccept: */*\r\n\r\n',
+                b'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\nContent-Length: 42\r\n\r\n',
+                b'{"id": 12, "status": "ok", "result": true}',
+                b'hello world',
+                bytes(range(256))]
+    for version in [0, 1]:
+        sizes = [len(compress(message, version)) for message in messages]
+        assert all(decompress(compress(message, version)) == message for message in messages)
+        print(f'dictionary {version}: {sum(len(m) for m in messages)} bytes compressed to {sum(sizes)}, {sizes}')
+
+    stream_compressor = StreamCompressor(1, 8)
+    stream_decompressor = StreamDecompressor()
+    sent = [stream_compressor.compress(message) for message in messages * 4]
+    for i, (message, data) in enumerate(zip(messages * 4, sent)):
+        if i == 6:
+            # Lost message, the stream continues after the reset
+            continue
+        try:
+            assert stream_decompressor.decompress(data) == message
+        except StreamError as ex:
+            print(f'message {i}:', ex)
+    print(f'stream: {len(messages) * 4} messages, {sum(len(m) for m in messages) * 4} bytes compressed to '
+          f'{sum(len(data) for data in sent)}')
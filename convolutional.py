@@ -0,0 +1,100 @@
+# Convolutional code with rate 1/2 and constraint length 7 (generator
+# polynomials 171 and 133 octal, as used by Voyager and 802.11), with a soft
+# decision Viterbi decoder. Soft decisions are log-likelihood ratios: positive
+# for a bit that is probably 0, negative for a bit that is probably 1, with a
+# larger magnitude for a more certain bit.
+
+import numpy as np
+
+
+CONSTRAINT_LENGTH = 7
+POLYNOMIALS = (0o171, 0o133)
+STATE_COUNT = 2**(CONSTRAINT_LENGTH - 1)
+
+# Encoder state is the last CONSTRAINT_LENGTH - 1 input bits, the most recent
+# bit in the least significant position. Every state can be reached from two
+# previous states, which differ in the oldest bit that is shifted out.
+_states = np.arange(STATE_COUNT)
+PREVIOUS = np.stack([(_states >> 1) | (oldest << (CONSTRAINT_LENGTH - 2)) for oldest in (0, 1)], axis=-1)
+
+# Encoder output bits for the transition from PREVIOUS[state, i] to state,
+# as +1 (bit 0) or -1 (bit 1), so the branch metric is a dot product with the
+# log-likelihood ratios.
+_registers = _states[:, np.newaxis] | (np.arange(2) << (CONSTRAINT_LENGTH - 1))
+_outputs = np.stack([np.vectorize(lambda r: bin(r & p).count('1') & 1)(_registers) for p in POLYNOMIALS], axis=-1)
+BRANCH_SIGNS = 1 - 2 * _outputs
+
+# Number of steps after which the survivor paths of all states have
+# (almost always) merged, so decisions for earlier bits are final even if the
+# final state is unknown
+DECISION_DEPTH = 5 * CONSTRAINT_LENGTH
+
+# Polynomials as tap arrays, tap k applies to the input bit k steps ago
+TAPS = [np.array([p >> k & 1 for k in range(CONSTRAINT_LENGTH)]) for p in POLYNOMIALS]
+
+
+def encode(bits: np.ndarray) -> np.ndarray:
+    # Encode bits, starting in state 0. Zero tail bits are appended to return
+    # the encoder to state 0, so the decoder knows the final state. Returns
+    # two output bits for every input bit, interleaved.
+    bits = np.concatenate((np.asarray(bits, dtype=int), np.zeros(CONSTRAINT_LENGTH - 1, dtype=int)))
+    outputs = [np.convolve(bits, taps)[:len(bits)] % 2 for taps in TAPS]
+    return np.stack(outputs, axis=-1).ravel().astype('u1')
+
+
+def decode(llrs: np.ndarray, terminated: bool = True) -> np.ndarray:
+    # Most likely input bits for the given log-likelihood ratios of encoded
+    # bits, including the tail bits. Extra encoded zero bits after the tail
+    # (padding) decode as extra zero input bits, since state 0 stays in state
+    # 0 when sending zeros. Set terminated to False to decode the start of a
+    # sequence that is still being received: the traceback then starts at
+    # the most likely state, and only bits up to DECISION_DEPTH steps before
+    # the end are reliable.
+    llrs = np.asarray(llrs, dtype=np.float64)
+    step_count = len(llrs) // len(POLYNOMIALS)
+    llrs = llrs[:step_count * len(POLYNOMIALS)].reshape(step_count, len(POLYNOMIALS))
+
+    # Branch metrics for all steps at once, shape (steps, states, 2)
+    branches = np.einsum('nr,skr->nsk', llrs, BRANCH_SIGNS)
+    previous_0 = PREVIOUS[:, 0]
+    previous_1 = PREVIOUS[:, 1]
+
+    # Add-compare-select for all states at once. Only the choice of previous
+    # state is remembered for every step, for the traceback.
+    metrics = np.full(STATE_COUNT, -np.inf)
+    metrics[0] = 0
+    decisions = np.empty((step_count, STATE_COUNT), dtype=bool)
+    for i in range(step_count):
+        candidate_0 = metrics[previous_0] + branches[i, :, 0]
+        candidate_1 = metrics[previous_1] + branches[i, :, 1]
+        decision = candidate_1 > candidate_0
+        decisions[i] = decision
+        metrics = np.where(decision, candidate_1, candidate_0)
+
+    # Trace back from state 0 (or the most likely state), the input bit of
+    # every step is the least significant bit of the state it leads to
+    bits = np.empty(step_count, dtype='u1')
+    state = 0 if terminated else int(np.argmax(metrics))
+    for i in range(step_count - 1, -1, -1):
+        bits[i] = state & 1
+        state = PREVIOUS[state, int(decisions[i, state])]
+    return bits
+
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng()
+    data_bits = rng.integers(0, 2, 8 * 1500)
+    encoded = encode(data_bits)
+    assert len(encoded) == 2 * (len(data_bits) + CONSTRAINT_LENGTH - 1)
+
+    for sigma in [0.5, 0.7, 0.9]:
+        received = 1 - 2.0 * encoded + rng.normal(0, sigma, len(encoded))
+        hard_errors = np.count_nonzero((received < 0) != encoded)
+        start_time = time.perf_counter()
+        decoded = decode(received)
+        duration = time.perf_counter() - start_time
+        errors = np.count_nonzero(decoded[:len(data_bits)] != data_bits)
+        print(f'sigma {sigma}: {hard_errors} channel bit errors, {errors} bit errors after decoding, '
+              f'{len(data_bits) / duration:.0f} bits/s')
@@ -20,12 +20,16 @@ LUT = [
 ]
 
 
-def crc16(data: bytes) -> int:
+INITIAL = 0xFFFF
+
+
+def crc16(data: bytes, crc: int = INITIAL) -> int:
     '''
-    CRC-16 (CCITT) implemented with a precomputed lookup table
+    CRC-16 (CCITT) implemented with a precomputed lookup table. Pass the
+    result for previous bytes as crc to continue with more bytes, so a
+    checksum can be updated as bytes arrive.
     '''
-    crc = 0xFFFF
+    lut = LUT
     for byte in data:
-        crc = (crc << 8) ^ LUT[(crc >> 8) ^ byte]
-        crc &= 0xFFFF
+        crc = ((crc << 8) & 0xFFFF) ^ lut[(crc >> 8) ^ byte]
     return crc
@@ -1,54 +1,192 @@
+import logging
 from typing import Optional
 import sys
 
 import numpy as np
-from scipy.signal import firwin, lfiltic, lfilter
+from scipy.signal import lfiltic, lfilter, sosfilt
 
-import settings
+import metrics
+import modem
+from modem import ModemConfig
 import test_wav
 import tone_conversion
 from digital_pll import DigitalPLL
-from packet import NoStartMarkerError
+from packet import NoStartMarkerError, PacketCorruptError, PacketParser
 import packet
 
 
-assert not settings.MFSK
+log = logging.getLogger(__name__)
 
 
-START_MARKER_BITS = tone_conversion.bytes_to_tones(settings.START_MARKER)
-
-
-def find_start(bits: np.ndarray) -> Optional[int]:
-    marker_pos = 0
+def find_start(bits: np.ndarray, config: Optional[ModemConfig] = None) -> Optional[int]:
+    # Shift bits into a register holding the last start_marker_bit_count
+    # bits, and compare it to the start marker
+    config = modem.get(config)
+    register = 0
     for i, bit in enumerate(bits):
-        if bit == START_MARKER_BITS[marker_pos]:
-            marker_pos += 1
-            if marker_pos == len(START_MARKER_BITS):
-                return i + 1
-        else:
-            marker_pos = 0
+        register = (register << 1 | int(bit)) & config.start_marker_mask
+        if register == config.start_marker_int and i + 1 >= config.start_marker_bit_count:
+            return i + 1
     return None
 
 
-def low_pass(samples: np.ndarray) -> np.ndarray:
-    lpf_coeffs = np.array(firwin(101, [760.0/(settings.SAMPLE_RATE/2)],
-                                 width=None,
-                                 pass_zero=True,
-                                 scale=True,
-                                 window='hann') * settings.OUTPUT_MAX,
-                          dtype='i2')
-    zl = lfiltic(lpf_coeffs, settings.OUTPUT_MAX, [], [])
-    result1, zl = lfilter(lpf_coeffs, settings.OUTPUT_MAX, samples, -1, zl)
-    result2, zl = lfilter(lpf_coeffs, settings.OUTPUT_MAX, np.zeros(len(lpf_coeffs)), -1, zl)
-    return np.append(result1, result2[len(lpf_coeffs)//2:])
-
-
-def decode(samples: np.ndarray, plot_option: list[str] = []) -> bytes:
-    assert not settings.MFSK
+def low_pass(samples: np.ndarray, config: Optional[ModemConfig] = None) -> np.ndarray:
+    config = modem.get(config)
+    coeffs = config.low_pass_coeffs
+    zl = lfiltic(coeffs, config.OUTPUT_MAX, [], [])
+    result1, zl = lfilter(coeffs, config.OUTPUT_MAX, samples, -1, zl)
+    result2, zl = lfilter(coeffs, config.OUTPUT_MAX, np.zeros(len(coeffs)), -1, zl)
+    return np.append(result1, result2[len(coeffs)//2:])
+
+
+class ChannelFilter:
+    """
+    Selects a single channel from audio containing multiple channels (see
+    CHANNELS setting). Other channels are removed using a band pass filter,
+    then the channel is shifted down to the usual mark and space frequencies
+    by multiplying with a cosine of the shift frequency, and a low pass filter
+    removes what is left above the channel. Filter state and the cosine phase
+    are carried over from one chunk to the next.
+    """
+    config: ModemConfig
+    position: int
+    band_pass_state: np.ndarray
+    low_pass_state: np.ndarray
+
+    def __init__(self, config: ModemConfig):
+        self.config = config
+        self.position = 0
+        self.band_pass_state = np.zeros((len(config.band_pass_sos), 2))
+        self.low_pass_state = np.zeros((len(config.shift_low_pass_sos), 2))
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        config = self.config
+        filtered, self.band_pass_state = sosfilt(config.band_pass_sos, samples, zi=self.band_pass_state)
+        if config.CHANNEL_SHIFT:
+            n = np.arange(self.position, self.position + len(samples))
+            filtered = filtered * 2 * np.cos(2 * np.pi * config.CHANNEL_SHIFT * n / config.SAMPLE_RATE)
+        # Also for the first channel, which is not shifted, the band pass
+        # alone lets through too much of the next channel
+        filtered, self.low_pass_state = sosfilt(config.shift_low_pass_sos, filtered, zi=self.low_pass_state)
+        self.position += len(samples)
+        return filtered
+
+
+class StreamingDemodulator:
+    """
+    Demodulates audio in chunks of any size, as it arrives. The same steps as
+    decode() are used, but all state (comb filter delay line, low pass filter
+    state, PLL, start marker search and received bytes) is carried over from
+    one chunk to the next. Every sample is only processed once.
+    """
+    config: ModemConfig
+    channel_filter: Optional[ChannelFilter]
+    positive_history: np.ndarray
+    low_pass_state: np.ndarray
+    pll: DigitalPLL
+    marker_register: int
+    marker_bit_count: int
+    receiving: bool
+    parser: Optional[PacketParser]
+    current_byte: int
+    current_bit_count: int
+
+    def __init__(self, config: Optional[ModemConfig] = None):
+        self.config = modem.get(config)
+        assert not self.config.MFSK
+        self.channel_filter = None
+        if self.config.BAND_PASS is not None:
+            self.channel_filter = ChannelFilter(self.config)
+        self.positive_history = np.empty(0, dtype=bool)
+        self.low_pass_state = lfiltic(self.config.low_pass_coeffs, self.config.OUTPUT_MAX, [], [])
+        self.pll = DigitalPLL(self.config.SAMPLE_RATE, self.config.TONES_PER_SECOND)
+        self.reset()
+
+    def reset(self):
+        # Search for a new start marker. Filter and PLL state are kept, they
+        # are not specific to a packet.
+        self.marker_register = 0
+        self.marker_bit_count = 0
+        self.receiving = False
+        self.parser = None
+        self.current_byte = 0
+        self.current_bit_count = 0
+
+    def feed(self, samples: np.ndarray) -> list[bytes]:
+        # Demodulate samples following previously fed samples. Returns all
+        # messages that were completed in these samples.
+        config = self.config
+        delay = config.SAMPLES_PER_TONE // 2
+
+        if self.channel_filter is not None:
+            samples = self.channel_filter.process(samples)
+
+        # Comb filter, using the last `delay` samples of the previous chunk
+        audio_is_positive = np.concatenate((self.positive_history, samples > 0))
+        self.positive_history = audio_is_positive[-delay:]
+        xored = np.logical_xor(audio_is_positive[:-delay], audio_is_positive[delay:])
+
+        # Low pass filter, continuing with filter state of previous chunk
+        normalized = (xored - 0.5) * 2.0
+        filtered, self.low_pass_state = lfilter(config.low_pass_coeffs, config.OUTPUT_MAX, normalized, -1, self.low_pass_state)
+        bits_signal = filtered > 0
+
+        messages = []
+        bits = bits_signal[self.pll.process(bits_signal)].tolist()
+        metrics.count('tones_decoded', len(bits))
+        for bit in bits:
+            messages.extend(self.add_bit(int(bit)))
+        return messages
+
+    def add_bit(self, bit: int) -> list[bytes]:
+        # Returns messages of the packet completed by this bit, if any. A
+        # packet may contain multiple messages, see packet.pack_many().
+        if not self.receiving:
+            # Search for start marker
+            self.marker_register = (self.marker_register << 1 | bit) & self.config.start_marker_mask
+            self.marker_bit_count += 1
+            if self.marker_register == self.config.start_marker_int and self.marker_bit_count >= self.config.start_marker_bit_count:
+                self.receiving = True
+                self.parser = PacketParser()
+                metrics.count('sync_locks')
+            return []
+
+        self.current_byte = self.current_byte << 1 | bit
+        self.current_bit_count += 1
+        if self.current_bit_count < 8:
+            return []
+
+        byte = self.current_byte
+        self.current_byte = 0
+        self.current_bit_count = 0
+
+        try:
+            # Raises as soon as the header turns out to be corrupt
+            messages = self.parser.feed(bytes([byte]))
+            if messages is None:
+                return []
+            metrics.count('packets_received')
+            self.reset()
+            return messages
+        except PacketCorruptError as ex:
+            log.info('corrupt packet: %s', ex)
+            packet.count_error(ex)
+            self.reset()
+            return []
+
+
+def audio_to_bytes(samples: np.ndarray, plot_option: list[str] = [], config: Optional[ModemConfig] = None) -> bytes:
+    # Received bytes after the start marker, up to the end of the recording
+    config = modem.get(config)
+    assert not config.MFSK
 
     if plot_option:
         from matplotlib import pyplot as plt
 
+    if config.BAND_PASS is not None:
+        # Remove other channels
+        samples = ChannelFilter(config).process(samples)
+
     if 'audio' in plot_option:
         plt.plot(samples / 32768)
 
@@ -58,7 +196,7 @@ def decode(samples: np.ndarray, plot_option: list[str] = []) -> bytes:
         plt.plot(audio_is_positive)
 
     # Delay for comb filter should be half the sample rate
-    delay = settings.SAMPLES_PER_TONE // 2
+    delay = config.SAMPLES_PER_TONE // 2
 
     # Comb filter using delay. Results in a spikey signal, with more spikes in
     # higher frequency areas.
@@ -71,7 +209,7 @@ def decode(samples: np.ndarray, plot_option: list[str] = []) -> bytes:
     # Run spikey signal through low pass filter. Sections with many spikes
     # will result in a high signal, sections with few spikes in a low signal.
     normalized = (xored - 0.5) * 2.0
-    filtered = low_pass(normalized)
+    filtered = low_pass(normalized, config)
     if 'filtered' in plot_option:
         plt.plot(filtered)
 
@@ -84,17 +222,15 @@ def decode(samples: np.ndarray, plot_option: list[str] = []) -> bytes:
 
     # Recover timing information using code from the internet which I have
     # not attempted to understand.
-    pll = DigitalPLL(settings.SAMPLE_RATE, settings.TONES_PER_SECOND)
-    clock = np.zeros(len(bits_signal), dtype=int)
+    pll = DigitalPLL(config.SAMPLE_RATE, config.TONES_PER_SECOND)
+    sample_indices = pll.process(bits_signal)
 
     # Whenever the clock signal is on, save a 1 or 0 bit depending on whether
     # bits_signal has a True or False boolean at that time position
-    bits = []
-    for i in range(len(bits_signal)):
-        is_sample = pll(bits_signal[i])
-        clock[i] = is_sample
-        if is_sample:
-            bits.append(int(bits_signal[i]))
+    bits = bits_signal[sample_indices].astype(int).tolist()
+
+    clock = np.zeros(len(bits_signal), dtype=int)
+    clock[sample_indices] = 1
 
     if 'clock' in plot_option:
         plt.plot(clock)
@@ -105,13 +241,16 @@ def decode(samples: np.ndarray, plot_option: list[str] = []) -> bytes:
     # print(bits)
 
     # Try to find start marker (magic bit sequence) in bits list
-    start = find_start(bits)
+    start = find_start(bits, config)
     if start is None:
         raise NoStartMarkerError()
 
-    message_bytes = tone_conversion.tones_to_bytes(bits[start:])
+    return tone_conversion.tones_to_bytes(bits[start:], config)
+
 
-    return packet.unpack(message_bytes)
+def decode(samples: np.ndarray, plot_option: list[str] = [], config: Optional[ModemConfig] = None) -> bytes:
+    # Decode a recording containing a single transmission
+    return packet.unpack(audio_to_bytes(samples, plot_option, config))
 
 
 if __name__ == '__main__':
@@ -1,81 +1,98 @@
+import logging
 from threading import Thread
+from typing import Callable, Optional
 import time
 
 import sounddevice as sd
 import numpy as np
 
-import settings
-from packet import NoStartMarkerError, PacketIncompleteError, PacketCorruptError
 import decode_fsk
+import metrics
+import modem
+from modem import ModemConfig
+from ring_buffer import RingBuffer, RingBufferOverrunError
 
 
-START_MARKER_SAMPLES = int(len(settings.START_MARKER) * 8 / settings.TONES_PER_SECOND * settings.SAMPLE_RATE)
+log = logging.getLogger(__name__)
 
 
 class AudioProcessor(Thread):
-    buffer: np.ndarray
-    buffer_pos: int
+    config: ModemConfig
+    buffer: RingBuffer
     processed_to_pos: int
+    demodulator: decode_fsk.StreamingDemodulator
+    on_message: Optional[Callable[[bytes], None]]
 
-    def __init__(self):
+    def __init__(self, config: Optional[ModemConfig] = None, buffer: Optional[RingBuffer] = None,
+                 on_message: Optional[Callable[[bytes], None]] = None):
         super().__init__(daemon=True)
-        self.buffer = np.zeros(settings.REALTIME_PROCESS_BUFFER_SIZE, dtype='i2')
-        self.buffer_pos = 0
+        self.config = modem.get(config)
+        # Called with every received message, from the processing thread
+        self.on_message = on_message
+        # Buffer may be shared with processors for other channels
+        self.buffer = buffer if buffer is not None else RingBuffer(self.config.REALTIME_PROCESS_BUFFER_SIZE)
         self.processed_to_pos = 0
+        self.demodulator = decode_fsk.StreamingDemodulator(self.config)
 
     def run(self):
         while True:
             self.process()
-            time.sleep(settings.REALTIME_PROCESS_SLEEP)
+            time.sleep(self.config.REALTIME_PROCESS_SLEEP)
 
     def add_samples(self, samples: np.ndarray):
-        # Add samples to our buffer, and move buffer_pos accordingly
-        for i in range(len(samples)):
-            self.buffer[self.buffer_pos % settings.REALTIME_PROCESS_BUFFER_SIZE] = samples[i] * settings.OUTPUT_MAX
-            self.buffer_pos += 1
+        # Add samples to our buffer. Input is float32 samples for a single
+        # channel, convert to 16 bit integers.
+        self.buffer.write((samples[:, 0] * self.config.OUTPUT_MAX).astype('i2'))
+        metrics.count('samples_captured', len(samples))
 
     def get_buffer_as_continuous_array(self, start: int, count: int) -> np.ndarray:
-        # Convert buffer to an array with oldest sample at 0.
-        copy = np.zeros(count, dtype='i2')
-        for i in range(0, count):
-            copy[i] = self.buffer[(start + i) % settings.REALTIME_PROCESS_BUFFER_SIZE]
-        return copy
+        # View of buffer with oldest sample at 0.
+        return self.buffer.read(start, count)
 
     def process(self):
-        start_time = time.time_ns()
-        print('start processing')
+        with metrics.timer('process_time'):
+            try:
+                self.process_buffer()
+            except RingBufferOverrunError as ex:
+                # The writer overwrote samples after the check below
+                log.warning('processing did not keep up with incoming audio! RESET %s', ex)
+                self.skip_overrun(self.buffer.pos)
+
+    def skip_overrun(self, buffer_pos: int):
+        # Processing did not keep up, the oldest samples have been
+        # overwritten. Skip to recent samples, leaving room for samples that
+        # arrive while processing.
+        metrics.count('buffer_overruns')
+        self.processed_to_pos = buffer_pos - self.buffer.size // 2
+        self.demodulator.reset()
+
+    def process_buffer(self):
+        log.debug('start processing')
 
         # New data samples may be added while this function is running, remember current pos
-        buffer_pos = self.buffer_pos
+        buffer_pos = self.buffer.pos
+        if self.processed_to_pos < buffer_pos - self.buffer.size:
+            log.warning('buffer overrun')
+            self.skip_overrun(buffer_pos)
         samples = self.get_buffer_as_continuous_array(self.processed_to_pos, buffer_pos - self.processed_to_pos)
 
-        if len(samples) < settings.REALTIME_PROCESS_MINIMUM:
-            print('waiting for more samples')
+        if len(samples) < self.config.REALTIME_PROCESS_MINIMUM:
+            log.debug('waiting for more samples')
             return
 
-        print(f'processing {len(samples)} samples ({len(samples)/settings.SAMPLE_RATE:.1f} seconds), from pos', self.processed_to_pos)
-
-        # Try to decode samples into a message
-        try:
-            message = decode_fsk.decode(samples)
-            print('=> RECEIVED MESSAGE', message)
-            self.processed_to_pos = buffer_pos
-        except NoStartMarkerError:
-            # No start marker was found. End of our buffer may contain start marker.
-            # Keep end of buffer, the size of a start marker, and discard everything else.
-            self.processed_to_pos = max(0, buffer_pos - START_MARKER_SAMPLES)
-            print('=> no start marker')
-        except PacketIncompleteError:
-            # Packet is incomplete, wait for more data
-            print('=> incomplete')
-            pass
-        except PacketCorruptError:
-            # Packet is corrupt, discard received data by marking all as processed
-            print('=> corrupt')
-            self.processed_to_pos = buffer_pos
-
-        print('done processing, took', (time.time_ns() - start_time) // 1000000, 'ms')
-        self.need_process = False
+        log.debug('processing %d samples (%.1f seconds), from pos %d',
+                  len(samples), len(samples) / self.config.SAMPLE_RATE, self.processed_to_pos)
+
+        # Only new samples are demodulated, the demodulator remembers its state
+        # from previously processed samples
+        with metrics.timer('demodulation_time'):
+            messages = self.demodulator.feed(samples)
+        for message in messages:
+            log.info('RECEIVED MESSAGE: %s', message)
+            metrics.count('messages_received')
+            if self.on_message is not None:
+                self.on_message(message)
+        self.processed_to_pos = buffer_pos
 
 
 class AudioReceiver:
@@ -88,20 +105,25 @@ class AudioReceiver:
         self.processor.add_samples(samples)
 
     def run(self):
-        def callback(indata, _frames, _time, _status):
+        def callback(indata, _frames, _time, status):
+            if status:
+                log.warning('%s', status)
+                metrics.count('audio_status')
             self.process(indata)
 
         # Listen to audio input indefinitely. A high latency means a larger
         # buffer is used, so a smaller chance of data being lost if the
         # program or audio backend briefly hangs. The callback function is
         # called repeatedly (many times per second) with incoming data.
-        with sd.InputStream(samplerate=settings.SAMPLE_RATE, latency='high', channels=1, callback=callback):
+        with sd.InputStream(samplerate=self.processor.config.SAMPLE_RATE, latency='high', channels=1, callback=callback):
             while True:
                 sd.sleep(1000)
 
 
 if __name__ == '__main__':
-    audio_processor = AudioProcessor()
+    metrics.setup()
+    modem.DEFAULT.precompute()
+    audio_processor = AudioProcessor(modem.DEFAULT)
     audio_processor.start()
     audio_receiver = AudioReceiver(audio_processor)
     audio_receiver.run()
@@ -1,114 +1,450 @@
+import logging
+import math
 import traceback
 import sys
+from collections import deque
 from typing import Optional, Tuple
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
+import modem
+from modem import ModemConfig
 import packet
 from packet import BasePacketDecodeError
-import settings
 import tone_conversion
 import test_wav
 
 
 LJUST = 20
 
+log = logging.getLogger(__name__)
 
-def generate_frequencies():
+
+def generate_frequencies(config: Optional[ModemConfig] = None):
+    config = modem.get(config)
     f_list = []
-    for i in range(2**settings.TONE_BITS):
-        f_list.append(settings.FREQ_BASE + settings.FREQ_SPACE * i)
+    for i in range(2**config.TONE_BITS):
+        f_list.append(config.FREQ_BASE + config.FREQ_SPACE * i)
     return f_list
 
 
-def fft(x):
+def candidate_frequencies(config: Optional[ModemConfig] = None) -> np.ndarray:
+    # All frequencies that may be received: one for every tone, plus end tone
+    return modem.get(config).candidate_frequencies
+
+
+def fft_frequencies(size: int, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Frequency axis for the FFT of a window with the given number of samples.
+    # Only calculated once for every window size.
+    return modem.get(config).fft_frequencies(size)
+
+
+def fft(x, config: Optional[ModemConfig] = None):
     y_fft = np.fft.rfft(x)
     y_fft = y_fft[:round(len(x)/2)]
     y_fft = np.abs(y_fft)
-    y_fft = y_fft/max(y_fft)
-    freq_x_axis = np.linspace(0, settings.SAMPLE_RATE / 2, len(y_fft))
-    return [y_fft, freq_x_axis]
+    y_fft = y_fft/np.max(y_fft)
+    return [y_fft, fft_frequencies(len(x), config)]
 
 
-def primary_freq(samples):
-    s_fft = fft(samples)
+def primary_freq(samples, config: Optional[ModemConfig] = None):
+    s_fft = fft(samples, config)
     f_loc = np.argmax(s_fft[0])
     return s_fft[1][f_loc]
 
 
-def audio_to_tone(samples: np.ndarray) -> list[int]:
-    f = primary_freq(samples)
-    tone = (f - settings.FREQ_BASE) / settings.FREQ_SPACE + settings.TONE_CALIBRATION_OFFSET
-    # print(round(tone), tone, str(f).ljust(10))
-    return round(tone)
-
-
-def audio_to_tones(samples: np.ndarray, start: int) -> list[int]:
-    tones = []
-    for sample in range(start, len(samples), settings.SAMPLES_PER_TONE):
-        tone_samples = samples[sample-settings.INPUT_READ_SIZE:sample+settings.INPUT_READ_SIZE]
-        tone = audio_to_tone(tone_samples)
-        if tone == settings.SYNC_END_TONE:
-            print('end tone')
-            break
-        tones.append(tone)
-    return tones
-
-
-def find_first_tone_midpoint(samples: np.ndarray) -> Optional[int]:
-    fft_size = settings.SYNC_SWEEP_SAMPLES // settings.SYNC_FFT_SPLIT
-    expected_slope = settings.SYNC_SWEEP_SAMPLES / (settings.SYNC_SWEEP_BEGIN - settings.SYNC_SWEEP_END)
-    # print('expected_slope', expected_slope)
-    x_list = []
-    y_list = []
-    for i in range(0, len(samples) - fft_size, fft_size):
-        window = samples[i:i+fft_size]
-        window_center = i + fft_size // 2
-        f = primary_freq(window)
-        x_list.append(f)
-        y_list.append(window_center)
-
-        if len(x_list) >= settings.SYNC_FFT_SPLIT * 0.9:
-            # Fit line y = mx + c through x and y points using least squares
-            # https://numpy.org/doc/stable/reference/generated/numpy.linalg.lstsq.html
-            x = np.array(x_list)
-            y = np.array(y_list)
-            A = np.vstack([x, np.ones(len(x))]).T
-            m, c = np.linalg.lstsq(A, y, rcond=None)[0]
-            # print('pos', str(window_center / settings.SAMPLE_RATE).ljust(20), 'slope', m)
-            if np.isclose(m, expected_slope, atol=0.05):
-                # print('found matching slope')
-                sweep_end = m * settings.SYNC_SWEEP_BEGIN + c
-                # c_adj = -(expected_slope * settings.SYNC_SWEEP_BEGIN - sweep_end)
-                # sweep_end_adj = expected_slope * settings.SYNC_SWEEP + c_adj
-                return int(sweep_end + settings.SAMPLES_PER_TONE / 2 + settings.SYNC_CALIBRATION_OFFSET)
-            x_list.pop(0)
-            y_list.pop(0)
-    return None
+def tone_windows(samples: np.ndarray, start: int, size: int, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Two dimensional view of samples, with one row for every complete window
+    # of `size` samples centered around a tone midpoint (start, start +
+    # SAMPLES_PER_TONE, ...). The view shares memory with samples, nothing is
+    # copied.
+    config = modem.get(config)
+    first = start - size // 2
+    assert first >= 0
+    if len(samples) - first < size:
+        return np.empty((0, size), dtype=samples.dtype)
+    return sliding_window_view(samples[first:], size)[::config.SAMPLES_PER_TONE]
+
+
+def windows_to_tones(windows: np.ndarray, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Find primary frequency for all windows at once, using a single FFT over
+    # the last axis, then convert frequencies to tones
+    config = modem.get(config)
+    size = windows.shape[-1]
+    y_fft = np.abs(np.fft.rfft(windows, axis=-1)[..., :round(size/2)])
+    f = config.fft_frequencies(size)[np.argmax(y_fft, axis=-1)]
+    tones = (f - config.FREQ_BASE) / config.FREQ_SPACE + config.TONE_CALIBRATION_OFFSET
+    return np.round(tones).astype(int)
+
+
+def audio_to_tone(samples: np.ndarray, config: Optional[ModemConfig] = None) -> int:
+    return int(windows_to_tones(samples[np.newaxis], config)[0])
+
+
+def fft_detector(samples: np.ndarray, start: int, config: ModemConfig) -> Tuple[np.ndarray, np.ndarray]:
+    # Tone is strongest frequency in entire spectrum. Energies are read from
+    # the FFT bins closest to the candidate frequencies.
+    size = config.INPUT_READ_SIZE * 2
+    windows = tone_windows(samples, start, size, config)
+    y_fft = np.fft.rfft(windows, axis=-1)[..., :round(size/2)]
+    freq_x_axis = config.fft_frequencies(size)
+    bins = np.round(config.candidate_frequencies / freq_x_axis[-1] * (len(freq_x_axis) - 1)).astype(int)
+    energies = np.abs(y_fft[..., np.minimum(bins, len(freq_x_axis) - 1)])**2
+    if config.CARRIERS == 1:
+        tones = windows_to_tones(windows, config)[:, np.newaxis]
+    else:
+        # Strongest frequency in entire spectrum only finds one carrier, use
+        # strongest candidate frequency of every carrier instead
+        tones = np.argmax(carrier_energies(energies, config), axis=-1)
+    return tones, energies
+
+
+def carrier_energies(energies: np.ndarray, config: ModemConfig) -> np.ndarray:
+    # Split energies of candidate frequencies over carriers, the last axis
+    # contains the energy of every tone (and end tone) of a single carrier
+    return energies.reshape(energies.shape[:-1] + (config.CARRIERS, config.SYNC_END_TONE + 1))
+
+
+def tone_bank(size: int, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Matrix with a windowed complex exponential for every candidate
+    # frequency in its columns, see ModemConfig.tone_bank()
+    return modem.get(config).tone_bank(size)
+
+
+def bank_detector(samples: np.ndarray, start: int, config: ModemConfig) -> Tuple[np.ndarray, np.ndarray]:
+    # Tone is candidate frequency with the most energy. Only the candidate
+    # frequencies are evaluated, over all usable samples of a tone.
+    size = config.TONE_BANK_READ_SIZE
+    windows = tone_windows(samples, start, size, config)
+    energies = np.abs(windows @ config.tone_bank(size))**2
+    return np.argmax(carrier_energies(energies, config), axis=-1), energies
+
+
+TONE_DETECTORS = {
+    'fft': (fft_detector, lambda config: config.INPUT_READ_SIZE * 2),
+    'bank': (bank_detector, lambda config: config.TONE_BANK_READ_SIZE),
+}
+
+
+def tone_read_size(config: Optional[ModemConfig] = None) -> int:
+    # Number of samples around a tone midpoint used by the configured detector
+    config = modem.get(config)
+    _detector, read_size = TONE_DETECTORS[config.TONE_DETECTOR]
+    return read_size(config)
+
+
+def detect_tones(samples: np.ndarray, start: int, config: Optional[ModemConfig] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Detect all complete tones with midpoints start, start + SAMPLES_PER_TONE,
+    # ... Returns the detected tones, with a row for every symbol and a column
+    # for every carrier, and for every symbol an array with the energy of
+    # every candidate frequency (see candidate_frequencies()).
+    config = modem.get(config)
+    detector, _read_size = TONE_DETECTORS[config.TONE_DETECTOR]
+    return detector(samples, start, config)
+
+
+def tone_confidence(energies: np.ndarray, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Fraction of energy in strongest candidate frequency, between 0 and 1.
+    # With multiple carriers, the lowest confidence of all carriers.
+    energies = carrier_energies(energies, modem.get(config))
+    total = np.sum(energies, axis=-1)
+    confidence = np.divide(np.max(energies, axis=-1), total, out=np.zeros_like(total), where=total > 0)
+    return np.min(confidence, axis=-1)
+
+
+def is_end_symbol(tones: np.ndarray, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # True for symbols where most carriers send the end tone
+    config = modem.get(config)
+    return np.sum(tones == config.SYNC_END_TONE, axis=-1) * 2 > config.CARRIERS
+
+
+def bit_llrs(energies: np.ndarray, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Soft decision for every bit of every tone, as log-likelihood ratio:
+    # positive if the bit is probably 0, negative if it is probably 1. Uses
+    # the max-log approximation: the amplitude of the strongest tone sending
+    # a 0 bit minus the amplitude of the strongest tone sending a 1 bit.
+    # Amplitudes are relative to the average amplitude of all tones in the
+    # transmission, which is mostly noise, so a tone that is barely louder
+    # than the noise results in a small ratio.
+    config = modem.get(config)
+    tone_count = 2**config.TONE_BITS
+    energies = carrier_energies(energies, config)[..., :tone_count].reshape(-1, tone_count)
+    amplitudes = np.sqrt(energies)
+    mean = np.mean(amplitudes)
+    if mean > 0:
+        amplitudes = amplitudes / mean
+    bit_set = config.tone_bit_table.T[np.newaxis] == 1
+    amplitudes = amplitudes[:, np.newaxis, :]
+    zero = np.max(np.where(bit_set, -np.inf, amplitudes), axis=-1)
+    one = np.max(np.where(bit_set, amplitudes, -np.inf), axis=-1)
+    return (zero - one).ravel()
+
+
+def symbol_count(tones: np.ndarray, config: Optional[ModemConfig] = None) -> int:
+    # Number of symbols before the first end symbol
+    end = np.flatnonzero(is_end_symbol(tones, config))
+    if len(end) > 0:
+        log.debug('end tone')
+        return int(end[0])
+    return len(tones)
+
+
+def audio_to_tones(samples: np.ndarray, start: int, config: Optional[ModemConfig] = None) -> list[int]:
+    config = modem.get(config)
+    tones, _energies = detect_tones(samples, start, config)
+    return tones[:symbol_count(tones, config)].ravel().tolist()
+
+
+def audio_to_bytes(samples: np.ndarray, start: int, config: Optional[ModemConfig] = None) -> bytes:
+    # Received bytes, from detected tones or from soft decisions when
+    # convolutional coding is enabled
+    config = modem.get(config)
+    tones, energies = detect_tones(samples, start, config)
+    count = symbol_count(tones, config)
+    if config.CONVOLUTIONAL_CODING:
+        return tone_conversion.soft_bits_to_bytes(bit_llrs(energies[:count], config), config)
+    # In noise, some tones send no value: the end tone on only some of the
+    # carriers, or any frequency with the fft detector. They are wrong tones
+    # either way, replaced by a valid tone so the checksum or FEC deals with
+    # them like with other wrong tones.
+    tones = np.clip(tones[:count], 0, 2**config.TONE_BITS - 1)
+    return tone_conversion.tones_to_bytes(tones.ravel().tolist(), config)
+
+
+class SyncDetector:
+    """
+    Finds the sync sweep in a stream of samples. Samples are fed as they
+    arrive, windows that have already been analysed are remembered between
+    calls, so every sample is only analysed once. A line is fit through the
+    (frequency, time) points of recent windows using least squares. The sums
+    required for the fit are updated when a window is added or removed,
+    instead of fitting from scratch for every window.
+    """
+    config: ModemConfig
+    fft_size: int
+    fit_size: int
+    position: int
+    pending: np.ndarray
+    points: deque
+    sum_x: int
+    sum_y: int
+    sum_xx: int
+    sum_xy: int
+
+    def __init__(self, position: int = 0, config: Optional[ModemConfig] = None):
+        self.config = modem.get(config)
+        self.fft_size = self.config.SYNC_SWEEP_SAMPLES // self.config.SYNC_FFT_SPLIT
+        self.fit_size = math.ceil(self.config.SYNC_FFT_SPLIT * 0.9)
+        self.reset(position)
+
+    def reset(self, position: int = 0):
+        # Forget all samples and windows, continue with samples starting at
+        # the given stream position.
+        self.position = position
+        self.pending = np.empty(0, dtype='i2')
+        self.points = deque()
+        self.sum_x = 0
+        self.sum_y = 0
+        self.sum_xx = 0
+        self.sum_xy = 0
+
+    def feed(self, samples: np.ndarray) -> Optional[int]:
+        # Add samples following previously fed samples. Returns stream position
+        # of first tone midpoint if the end of a sync sweep was found.
+        config = self.config
+        samples = np.concatenate((self.pending, samples))
+        samples_end = self.position + len(samples)
+        window_count = len(samples) // self.fft_size
+        windows = samples[:window_count * self.fft_size].reshape(window_count, self.fft_size)
+        self.pending = samples[window_count * self.fft_size:]
+
+        # Primary frequency of every window, as FFT bin index. Bin indices are
+        # integers, so all sums stay exact no matter how long the stream is.
+        y_fft = np.abs(np.fft.rfft(windows, axis=-1)[..., :round(self.fft_size/2)])
+        bins = np.argmax(y_fft, axis=-1).tolist()
+        bin_width = config.SAMPLE_RATE / 2 / (round(self.fft_size/2) - 1)
+
+        expected_slope = config.SYNC_SWEEP_SAMPLES / (config.SYNC_SWEEP_BEGIN - config.SYNC_SWEEP_END)
+        for x in bins:
+            y = self.position + self.fft_size // 2
+            self.position += self.fft_size
+            self.points.append((x, y))
+            self.sum_x += x
+            self.sum_y += y
+            self.sum_xx += x * x
+            self.sum_xy += x * y
+
+            if len(self.points) < self.fit_size:
+                continue
+
+            # Fit line y = mx + c through points using least squares
+            n = len(self.points)
+            denominator = n * self.sum_xx - self.sum_x * self.sum_x
+            if denominator != 0:
+                m_bins = (n * self.sum_xy - self.sum_x * self.sum_y) / denominator
+                c = (self.sum_y - m_bins * self.sum_x) / n
+                m = m_bins / bin_width
+                if np.isclose(m, expected_slope, atol=0.05):
+                    sweep_end = m * config.SYNC_SWEEP_BEGIN + c
+                    self.reset(samples_end)
+                    return int(sweep_end + config.SAMPLES_PER_TONE / 2 + config.SYNC_CALIBRATION_OFFSET)
+
+            old_x, old_y = self.points.popleft()
+            self.sum_x -= old_x
+            self.sum_y -= old_y
+            self.sum_xx -= old_x * old_x
+            self.sum_xy -= old_x * old_y
+
+        return None
+
+    @property
+    def end(self) -> int:
+        # Stream position of the sample after the last fed sample
+        return self.position + len(self.pending)
+
+    def flush(self) -> Optional[int]:
+        # No more samples will follow. A partial window is not useful, so
+        # there is nothing left to analyse.
+        return None
+
+
+class CorrelationSyncDetector:
+    """
+    Finds the sync sweep in a stream of samples using a matched filter. The
+    stream is cross-correlated with the known sweep signal using overlap-save
+    FFT convolution: blocks of block_size samples overlapping by the sweep
+    length, each producing `step` correlation values. The correlation is
+    normalized by the energy of the received signal, so the quality of a
+    match is between 0 and 1 regardless of volume.
+    """
+    config: ModemConfig
+    block_size: int
+    step: int
+    position: int
+    pending: np.ndarray
+    best_position: Optional[int]
+    best_quality: float
+
+    def __init__(self, position: int = 0, config: Optional[ModemConfig] = None):
+        self.config = modem.get(config)
+        self.block_size = self.config.sync_block_size
+        self.step = self.block_size - self.config.SYNC_SWEEP_SAMPLES + 1
+        self.reset(position)
+
+    def reset(self, position: int = 0):
+        # Forget all samples, continue with samples starting at the given
+        # stream position.
+        self.position = position
+        self.pending = np.empty(0, dtype='i2')
+        self.best_position = None
+        self.best_quality = 0.0
+
+    def feed(self, samples: np.ndarray) -> Optional[int]:
+        # Add samples following previously fed samples. Returns stream position
+        # of first tone midpoint if a sync sweep was found.
+        config = self.config
+        sweep_samples = config.SYNC_SWEEP_SAMPLES
+        samples = np.concatenate((self.pending, samples))
+        samples_end = self.position + len(samples)
+        reference_fft = config.sync_reference_fft(self.block_size)
+
+        offset = 0
+        while len(samples) - offset >= self.block_size:
+            block = samples[offset:offset+self.block_size].astype(np.float64)
+            correlation = np.fft.ifft(np.fft.fft(block) * reference_fft)[:self.step]
+            # Energy of received signal for each correlation value, from the
+            # cumulative sum of squared samples
+            energy_sum = np.concatenate(([0], np.cumsum(block**2)))
+            energy = (energy_sum[sweep_samples:sweep_samples+self.step] - energy_sum[:self.step]) * sweep_samples
+            # A perfect match has |correlation| = sqrt(energy / 2)
+            quality = np.divide(np.sqrt(2) * np.abs(correlation), np.sqrt(energy),
+                                out=np.zeros(self.step), where=energy > 0)
+            i = np.argmax(quality)
+            if quality[i] >= config.SYNC_CORRELATION_THRESHOLD and quality[i] > self.best_quality:
+                self.best_position = int(self.position + offset + i)
+                self.best_quality = quality[i]
+            offset += self.step
+
+            # Only accept the best match when no better match can follow, the
+            # signal after the sweep is not a sweep.
+            if self.best_position is not None and self.position + offset >= self.best_position + config.SAMPLES_PER_TONE:
+                first_tone_midpoint = self.best_position + sweep_samples + config.SAMPLES_PER_TONE // 2
+                self.reset(samples_end)
+                return first_tone_midpoint
+
+        self.pending = samples[offset:]
+        self.position += offset
+        return None
+
+    def flush(self) -> Optional[int]:
+        # No more samples will follow. Pad with silence so all remaining
+        # samples are analysed.
+        return self.feed(np.zeros(self.block_size, dtype='i2'))
+
+    @property
+    def end(self) -> int:
+        # Stream position of the sample after the last fed sample
+        return self.position + len(self.pending)
+
+
+SYNC_DETECTORS = {
+    'correlation': CorrelationSyncDetector,
+    'regression': SyncDetector,
+}
+
+
+def sync_detector(position: int = 0, config: Optional[ModemConfig] = None):
+    config = modem.get(config)
+    return SYNC_DETECTORS[config.SYNC_DETECTOR](position, config)
+
+
+def find_first_tone_midpoint(samples: np.ndarray, config: Optional[ModemConfig] = None) -> Optional[int]:
+    detector = sync_detector(0, config)
+    first_tone_midpoint = detector.feed(samples)
+    if first_tone_midpoint is None:
+        first_tone_midpoint = detector.flush()
+    return first_tone_midpoint
+
+
+def decode(samples: np.ndarray, config: Optional[ModemConfig] = None) -> bytes:
+    # Decode a recording containing a single transmission
+    config = modem.get(config)
+    assert config.MFSK
+
+    first_tone_midpoint = find_first_tone_midpoint(samples, config)
+    if first_tone_midpoint is None:
+        raise ValueError('could not identify start')
+
+    return packet.unpack(audio_to_bytes(samples, first_tone_midpoint, config))
 
 
 if __name__ == '__main__':
-    if not settings.MFSK:
+    config = modem.DEFAULT
+    if not config.MFSK:
         print('this script can only decode MFSK')
         sys.exit(1)
 
     samples = test_wav.read()
 
-    print('audio duration'.ljust(LJUST), f'{len(samples) / settings.SAMPLE_RATE:.1f} seconds')
+    print('audio duration'.ljust(LJUST), f'{len(samples) / config.SAMPLE_RATE:.1f} seconds')
 
     try:
-        first_tone_midpoint = find_first_tone_midpoint(samples)
+        first_tone_midpoint = find_first_tone_midpoint(samples, config)
 
         if first_tone_midpoint is None:
             raise ValueError('could not identify start')
 
-        print('first tone midpoint'.ljust(LJUST), f'{first_tone_midpoint / settings.SAMPLE_RATE:.4f} seconds')
+        print('first tone midpoint'.ljust(LJUST), f'{first_tone_midpoint / config.SAMPLE_RATE:.4f} seconds')
 
-        tones = audio_to_tones(samples, first_tone_midpoint)
+        tones = audio_to_tones(samples, first_tone_midpoint, config)
         print('tones:'.ljust(LJUST), tones)
+        _tones, energies = detect_tones(samples, first_tone_midpoint, config)
+        confidence = tone_confidence(energies[:len(tones) // config.CARRIERS], config)
+        if len(confidence) > 0:
+            print('min confidence:'.ljust(LJUST), f'{np.min(confidence):.2f}')
 
-        # Convert bytes to 4 bit integer list
-        data_bytes = tone_conversion.tones_to_bytes(tones)
+        data_bytes = audio_to_bytes(samples, first_tone_midpoint, config)
         print('data_bytes:'.ljust(LJUST), data_bytes)
 
         try:
@@ -123,8 +459,8 @@ if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'plot':
         from matplotlib import pyplot as plt
         ax = plt.gca()
-        ax.specgram(samples, Fs=settings.SAMPLE_RATE, scale='dB')
+        ax.specgram(samples, Fs=config.SAMPLE_RATE, scale='dB')
         if first_tone_midpoint is not None:
-            for i in range(first_tone_midpoint, len(samples) - settings.SAMPLES_PER_TONE, settings.SAMPLES_PER_TONE):
-                ax.axvline(i / settings.SAMPLE_RATE, color='orange', alpha=0.5)
+            for i in range(first_tone_midpoint, len(samples) - config.SAMPLES_PER_TONE, config.SAMPLES_PER_TONE):
+                ax.axvline(i / config.SAMPLE_RATE, color='orange', alpha=0.5)
         plt.show()
@@ -1,14 +1,25 @@
 from enum import Enum
+import logging
+import math
 from threading import Thread
+from typing import Callable, Optional
 import time
 
 import sounddevice as sd
 import numpy as np
 
-import settings
+import convolutional
 import decode_mfsk
-from decode_mfsk import ReceivedMessage, ChecksumError
+import metrics
+import modem
+from modem import ModemConfig
+import packet
+from packet import BasePacketDecodeError, PacketParser
 import tone_conversion
+from ring_buffer import RingBuffer, RingBufferOverrunError
+
+
+log = logging.getLogger(__name__)
 
 
 class InputState(Enum):
@@ -17,18 +28,35 @@ class InputState(Enum):
 
 
 class AudioProcessor(Thread):
+    config: ModemConfig
     need_process: bool
-    buffer: np.ndarray
+    buffer: RingBuffer
     buffer_pos: int
     input_state: InputState
     next_tone_mid_pos: int
     tones: list[int]
+    energies: list[np.ndarray]
+    parser: PacketParser
+    bits: np.ndarray
+    tones_converted: int
+    packet_symbols: Optional[int]
+    on_message: Optional[Callable[[bytes], None]]
 
-    def __init__(self):
+    def __init__(self, buffer: RingBuffer, config: Optional[ModemConfig] = None,
+                 on_message: Optional[Callable[[bytes], None]] = None):
         super().__init__(daemon=True)
+        self.config = modem.get(config)
+        # Called with every valid message, from the processing thread
+        self.on_message = on_message
         self.need_process = False
+        self.buffer = buffer
+        self.buffer_pos = 0
+        self.next_tone_mid_pos = 0
         self.input_state = InputState.WAITING
         self.tones = []
+        self.energies = []
+        self.clear_packet()
+        self.sync_detector = decode_mfsk.sync_detector(0, self.config)
 
     def run(self):
         while True:
@@ -36,108 +64,235 @@ class AudioProcessor(Thread):
                 self.process()
             time.sleep(0.01)
 
-    def update_buffer(self, buffer: np.ndarray, buffer_pos: int):
-        self.buffer = buffer
+    def update_buffer(self, buffer_pos: int):
         self.buffer_pos = buffer_pos
         self.need_process = True
 
     def get_buffer_as_array(self, start, count):
-        copy = np.zeros(count, dtype='i2')
-        for i in range(0, count):
-            copy[i] = self.buffer[(start + i) % settings.RECORD_BUFFER_SIZE]
-        return copy
+        return self.buffer.read(start, count)
 
     def process(self):
-        # start_time = time.time_ns()
         self.need_process = False
+        log.debug('buffer_pos: %d', self.buffer_pos)
 
-        if self.buffer_pos < settings.RECORD_BUFFER_SIZE:
-            print('waiting to fill buffer', self.buffer_pos / settings.RECORD_BUFFER_SIZE)
-            return
-
-        # print('buffer_pos:', self.buffer_pos, self.buffer_pos % settings.RECORD_BUFFER_SIZE)
+        with metrics.timer('process_time'):
+            try:
+                self.process_buffer()
+            except RingBufferOverrunError as ex:
+                log.warning('processing did not keep up with incoming audio! RESET %s', ex)
+                metrics.count('buffer_overruns')
+                self.reset()
 
+    def process_buffer(self):
         if self.input_state == InputState.WAITING:
-            samples = self.get_buffer_as_array(self.buffer_pos, settings.RECORD_BUFFER_SIZE)
-            first_midpoint = decode_mfsk.find_first_tone_midpoint(samples)
+            # Only pass samples to the sync detector that it has not seen before
+            if not self.buffer.available(self.sync_detector.end):
+                log.warning('samples were overwritten before sync detector could process them')
+                metrics.count('buffer_overruns')
+                self.sync_detector.reset(self.buffer_pos - self.buffer.size)
+            start = self.sync_detector.end
+            samples = self.get_buffer_as_array(start, self.buffer_pos - start)
+            metrics.count('sync_attempts')
+            with metrics.timer('sync_time'):
+                first_midpoint = self.sync_detector.feed(samples)
             if first_midpoint is not None:
-                self.next_tone_mid_pos = self.buffer_pos - settings.RECORD_BUFFER_SIZE + first_midpoint
-                print('> found first midpoint at', '0-indexed', first_midpoint, 'midpoint pos in buffer', self.next_tone_mid_pos)
+                self.next_tone_mid_pos = first_midpoint
+                log.info('found first midpoint at pos in buffer %d', self.next_tone_mid_pos)
+                metrics.count('sync_locks')
                 self.input_state = InputState.RECEIVING
+                # Tones may already have been received, do not wait until the next
+                # time process() is called to read them
+                self.process_buffer()
             else:
-                print('> waiting for sync')
+                log.debug('waiting for sync')
         elif self.input_state == InputState.RECEIVING:
-            print('receiving', 'buf_pos', self.buffer_pos, 'tone_pos', self.next_tone_mid_pos)
+            log.debug('receiving, buf_pos %d tone_pos %d', self.buffer_pos, self.next_tone_mid_pos)
             # Check if we have received a full tone (half tone length past midpoint)
-            # We may have even received multiple tones since the last time process_recording() was called
-            while self.buffer_pos > self.next_tone_mid_pos + settings.INPUT_READ_SIZE:
-                tone_start = self.next_tone_mid_pos - settings.INPUT_READ_SIZE
-                samples = self.get_buffer_as_array(tone_start, settings.INPUT_READ_SIZE * 2)
-                tone = decode_mfsk.audio_to_tone(samples)
-                print('tones', self.tones)
-                if tone == settings.SYNC_END_TONE:
-                    print('...end tone!')
-                    self.input_state = InputState.WAITING
+            # We may have even received multiple tones since the last time process_recording() was called,
+            # decode all of them at once.
+            config = self.config
+            read_size = decode_mfsk.tone_read_size(config)
+            received = self.buffer_pos - (self.next_tone_mid_pos - read_size // 2 + read_size)
+            if received < 0:
+                return
+            count = received // config.SAMPLES_PER_TONE + 1
+            tone_start = self.next_tone_mid_pos - read_size // 2
+            samples = self.get_buffer_as_array(tone_start, (count - 1) * config.SAMPLES_PER_TONE + read_size)
+            with metrics.timer('demodulation_time'):
+                tones, energies = decode_mfsk.detect_tones(samples, read_size // 2, config)
+                confidences = decode_mfsk.tone_confidence(energies, config)
+                end_symbols = decode_mfsk.is_end_symbol(tones, config)
+            # Every symbol has a tone for every carrier
+            for symbol, symbol_energies, confidence, end in zip(tones, energies, confidences, end_symbols):
+                if end:
+                    # Normally the packet is complete before its end tone,
+                    # unless it is too short for the header to be decoded
+                    # early, or its header was received wrong
+                    log.info('end tone before end of packet')
+                    metrics.count('end_tones')
                     self.decode_message()
-                    print('bytes', )
-                    self.tones = []
+                    self.reset()
+                    break
+                elif np.any(symbol < 0) or np.any(symbol >= 2**config.TONE_BITS):
+                    log.info('illegal tone! RESET %s', symbol)
+                    metrics.count('illegal_tones')
+                    self.reset()
+                    break
+                elif confidence < config.TONE_MIN_CONFIDENCE:
+                    log.info('low confidence tone! RESET %s %.2f', symbol, confidence)
+                    metrics.count('low_confidence_tones')
+                    self.reset()
                     break
-                elif tone < 0 or tone > 2**settings.TONE_BITS:
-                    print('illegal tone! RESET', tone)
-                    self.input_state = InputState.WAITING
-                    self.tones = []
+                self.tones.extend(symbol.tolist())
+                metrics.count('tones_decoded', len(symbol))
+                if config.CONVOLUTIONAL_CODING:
+                    self.energies.append(symbol_energies)
+                self.next_tone_mid_pos += config.SAMPLES_PER_TONE
+                try:
+                    with metrics.timer('decode_time'):
+                        complete = self.receive_packet()
+                except BasePacketDecodeError as ex:
+                    log.info('corrupt packet! RESET %s', ex)
+                    packet.count_error(ex)
+                    self.reset()
                     break
-                self.tones.append(tone)
-                self.next_tone_mid_pos += settings.SAMPLES_PER_TONE
+                if complete:
+                    self.reset()
+                    break
+            log.debug('%d tones received', len(self.tones))
         else:
             raise ValueError(self.input_state)
 
-        # print('took', (time.time_ns() - start_time) // 1000000, 'ms')
+    def reset(self):
+        # Go back to waiting for a sync sweep, starting at the current tone
+        self.input_state = InputState.WAITING
+        self.tones = []
+        self.energies = []
+        self.clear_packet()
+        self.sync_detector.reset(self.next_tone_mid_pos)
+
+    def clear_packet(self):
+        self.parser = PacketParser()
+        # Bits of received tones that do not form a complete byte yet
+        self.bits = np.zeros(0, dtype='u1')
+        self.tones_converted = 0
+        # Number of symbols of the packet, once its header is decoded
+        self.packet_symbols = None
+
+    def receive_packet(self) -> bool:
+        # Decodes the packet header as soon as its tones are received, the
+        # size in the header tells how many more tones the packet has. Returns
+        # True when the packet is complete and its messages were delivered.
+        # Raises BasePacketDecodeError for a corrupt packet, or a header that
+        # can not be valid, so the receiver can return to waiting for a sync
+        # sweep right away.
+        if self.config.CONVOLUTIONAL_CODING:
+            return self.receive_coded_packet()
+
+        # Every tone is decoded once, only complete bytes are fed
+        bits = tone_conversion.tones_to_bitstream(self.tones[self.tones_converted:], self.config)
+        self.tones_converted = len(self.tones)
+        self.bits = np.concatenate((self.bits, bits))
+        byte_bits = len(self.bits) // 8 * 8
+        messages = self.parser.feed(np.packbits(self.bits[:byte_bits]).tobytes())
+        self.bits = self.bits[byte_bits:]
+        if messages is None:
+            return False
+        self.deliver(messages)
+        return True
+
+    def receive_coded_packet(self) -> bool:
+        config = self.config
+        symbols = len(self.energies)
+        if self.packet_symbols is None:
+            # The decoder needs some bits after the header before decisions
+            # for the header bits are final
+            header_bits = packet.header_size() * 8
+            coded_bits = 2 * (header_bits + convolutional.DECISION_DEPTH)
+            if symbols < math.ceil(math.ceil(coded_bits / config.TONE_BITS) / config.CARRIERS):
+                return False
+            llrs = decode_mfsk.bit_llrs(np.array(self.energies), config)
+            bits = convolutional.decode(llrs, terminated=False)[:header_bits]
+            self.parser.feed(np.packbits(bits).tobytes())
+            self.packet_symbols = config.symbol_count(self.parser.total_size)
+            log.info('packet of %d bytes, %d symbols', self.parser.total_size, self.packet_symbols)
+
+        if symbols < self.packet_symbols:
+            return False
+        llrs = decode_mfsk.bit_llrs(np.array(self.energies), config)
+        data_bytes = tone_conversion.soft_bits_to_bytes(llrs, config)
+        self.deliver(packet.unpack_many(data_bytes[:self.parser.total_size]))
+        return True
+
+    def deliver(self, messages: list[bytes]):
+        # Latency is the audio that arrived after the last tone of the packet
+        last_tone_end = self.next_tone_mid_pos - self.config.SAMPLES_PER_TONE // 2
+        metrics.observe('receive_latency', max(self.buffer_pos - last_tone_end, 0) / self.config.SAMPLE_RATE)
+        metrics.count('packets_received')
+        for message in messages:
+            log.info('VALID MESSAGE: %s', message)
+            metrics.count('messages_received')
+            if self.on_message is not None:
+                self.on_message(message)
 
     def decode_message(self):
-        data_bytes = tone_conversion.tones_to_bytes(self.tones)
-        print('received', len(data_bytes), 'bytes', '-', data_bytes)
+        if self.config.CONVOLUTIONAL_CODING:
+            llrs = decode_mfsk.bit_llrs(np.array(self.energies), self.config)
+            data_bytes = tone_conversion.soft_bits_to_bytes(llrs, self.config)
+        else:
+            data_bytes = tone_conversion.tones_to_bytes(self.tones, self.config)
+        log.debug('received %d bytes - %s', len(data_bytes), data_bytes)
         if len(data_bytes) < 3:
-            print('too short')
+            log.info('too short')
+            metrics.count('packets_corrupt')
         else:
             try:
-                message = ReceivedMessage(data_bytes)
-                print('VALID MESSAGE:', message.content.decode())
-            except ChecksumError as ex:
-                print('corrupt message:', ex)
+                # A packet may contain multiple messages, see packet.pack_many()
+                self.deliver(packet.unpack_many(data_bytes))
+            except BasePacketDecodeError as ex:
+                log.info('corrupt message: %s', ex)
+                packet.count_error(ex)
 
 
 class AudioReceiver:
-    buffer: np.ndarray
-    buffer_pos: int
+    processor: AudioProcessor
+    config: ModemConfig
+    buffer: RingBuffer
     samples_since_process: int
 
-    def __init__(self):
-        self.buffer = np.zeros(settings.RECORD_BUFFER_SIZE, dtype='i2')
-        self.buffer_pos = 0
-        self.samples_since_process = settings.RECORD_PROCESS_SIZE * settings.SAMPLE_RATE
+    def __init__(self, processor: AudioProcessor):
+        self.processor = processor
+        self.config = processor.config
+        self.buffer = processor.buffer
+        self.samples_since_process = 0
 
     def process(self, samples: np.ndarray) -> None:
-        for i in range(len(samples)):
-            self.buffer[self.buffer_pos % settings.RECORD_BUFFER_SIZE] = samples[i] * settings.OUTPUT_MAX
-            self.buffer_pos += 1
+        # Input is float32 samples for a single channel, convert to 16 bit integers
+        self.buffer.write((samples[:, 0] * self.config.OUTPUT_MAX).astype('i2'))
+        metrics.count('samples_captured', len(samples))
 
         self.samples_since_process += len(samples)
-        if self.samples_since_process > settings.RECORD_PROCESS_SIZE:
-            audio_processor.update_buffer(np.copy(self.buffer), self.buffer_pos)
+        if self.samples_since_process > self.config.RECORD_PROCESS_SIZE:
+            self.processor.update_buffer(self.buffer.pos)
             self.samples_since_process = 0
 
     def run(self):
         def callback(indata, frames, time, status):
+            if status:
+                log.warning('%s', status)
+                metrics.count('audio_status')
             self.process(indata)
 
-        with sd.InputStream(samplerate=settings.SAMPLE_RATE, latency='high', channels=1, callback=callback):
+        with sd.InputStream(samplerate=self.config.SAMPLE_RATE, latency='high', channels=1, callback=callback):
             while True:
                 sd.sleep(1000)
 
 
 if __name__ == '__main__':
-    audio_processor = AudioProcessor()
+    metrics.setup()
+    config = modem.DEFAULT
+    config.precompute()
+    audio_processor = AudioProcessor(RingBuffer(config.RECORD_BUFFER_SIZE), config)
     audio_processor.start()
-    audio_receiver = AudioReceiver()
+    audio_receiver = AudioReceiver(audio_processor)
     audio_receiver.run()
@@ -0,0 +1,79 @@
+import logging
+from typing import Optional, Union
+
+import sounddevice as sd
+import numpy as np
+
+import decode_fsk_realtime
+import decode_mfsk_realtime
+import metrics
+import modem
+from modem import ModemConfig
+from ring_buffer import RingBuffer
+
+
+log = logging.getLogger(__name__)
+
+
+class MultiChannelReceiver:
+    """
+    Receives all channels (see CHANNELS setting) from a single audio input
+    stream. Incoming audio is converted once and written to a single ring
+    buffer. Every channel has its own processor thread, reading the shared
+    buffer from its own position. Processors never modify the buffer, so
+    channels are demodulated in parallel without locking.
+    """
+    config: ModemConfig
+    buffer: RingBuffer
+    processors: list[Union[decode_fsk_realtime.AudioProcessor, decode_mfsk_realtime.AudioProcessor]]
+    samples_since_process: int
+
+    def __init__(self, config: Optional[ModemConfig] = None):
+        self.config = modem.get(config)
+        channels = self.config.channels()
+        for channel in channels:
+            channel.precompute()
+        if self.config.MFSK:
+            self.buffer = RingBuffer(self.config.RECORD_BUFFER_SIZE)
+            self.processors = [decode_mfsk_realtime.AudioProcessor(self.buffer, channel) for channel in channels]
+        else:
+            self.buffer = RingBuffer(self.config.REALTIME_PROCESS_BUFFER_SIZE)
+            self.processors = [decode_fsk_realtime.AudioProcessor(channel, self.buffer) for channel in channels]
+        self.samples_since_process = 0
+
+    def start(self):
+        for processor in self.processors:
+            processor.start()
+
+    def process(self, samples: np.ndarray) -> None:
+        # Input is float32 samples for a single channel, convert to 16 bit integers
+        self.buffer.write((samples[:, 0] * self.config.OUTPUT_MAX).astype('i2'))
+        metrics.count('samples_captured', len(samples))
+
+        # FSK processors check the buffer by themselves, MFSK processors are
+        # notified when enough new samples have arrived
+        if self.config.MFSK:
+            self.samples_since_process += len(samples)
+            if self.samples_since_process > self.config.RECORD_PROCESS_SIZE:
+                for processor in self.processors:
+                    processor.update_buffer(self.buffer.pos)
+                self.samples_since_process = 0
+
+    def run(self):
+        def callback(indata, _frames, _time, status):
+            if status:
+                log.warning('%s', status)
+                metrics.count('audio_status')
+            self.process(indata)
+
+        with sd.InputStream(samplerate=self.config.SAMPLE_RATE, latency='high', channels=1, callback=callback):
+            while True:
+                sd.sleep(1000)
+
+
+if __name__ == '__main__':
+    metrics.setup()
+    receiver = MultiChannelReceiver(modem.DEFAULT)
+    print('receiving', len(receiver.processors), 'channels')
+    receiver.start()
+    receiver.run()
@@ -24,17 +24,24 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from scipy.signal import lfiltic, lfilter, firwin
+import math
+
 import numpy as np
 
 class iir_filter(object):
     def __init__(self, b, a):
-        self.b = b
-        self.a = a
-        self.zl = lfiltic(self.b, self.a, [], [])
+        # Normalized coefficients, a[0] == 1
+        self.b = [x / a[0] for x in b]
+        self.a = [x / a[0] for x in a]
+        self.zl = [0.0] * (max(len(self.a), len(self.b)) - 1)
     def __call__(self, data):
-        result, self.zl = lfilter(self.b, self.a, [data], -1, self.zl)
-        return result[0]
+        # Transposed direct form II, same as lfilter() but without the overhead
+        # of calling it for a single value
+        result = self.b[0] * data + self.zl[0]
+        for i in range(1, len(self.zl)):
+            self.zl[i-1] = self.b[i] * data + self.zl[i] - self.a[i] * result
+        self.zl[-1] = self.b[-1] * data - self.a[-1] * result
+        return result
 
 class Hysteresis:
 
@@ -99,26 +106,29 @@ class DigitalPLL:
         self.jitter_ = 10.0
         self.bits_ = 1.0
 
-    def __call__(self, input):
+    def transition(self, input):
+        # Record transition.
+        self.last_ = input
 
-        self.sample_ = False;
+        if (self.count_ > self.limit_):
+            self.count_ -= self.sps_
 
-        if (input != self.last_ or self.bits_ > 127.0):
-            # Record transition.
-            self.last_ = input
+        offset = self.count_ / self.bits_
 
-            if (self.count_ > self.limit_):
-                self.count_ -= self.sps_
+        j = self.loop_lowpass(offset)
+        self.jitter_ = self.lock_lowpass(abs(offset))
 
-            offset = self.count_ / self.bits_
+        # Advance or retard if not near a bit boundary.
+        self.count_ -=  j * self.sps_ * (0.012 if self.locked() else 0.048)
 
-            j = self.loop_lowpass(offset)
-            self.jitter_ = self.lock_lowpass(abs(offset))
+        self.bits_ = 1.0
+
+    def __call__(self, input):
 
-            # Advance or retard if not near a bit boundary.
-            self.count_ -=  j * self.sps_ * (0.012 if self.locked() else 0.048)
+        self.sample_ = False;
 
-            self.bits_ = 1.0
+        if (input != self.last_ or self.bits_ > 127.0):
+            self.transition(input)
         else:
             if (self.count_ > self.limit_):
                 self.sample_ = True
@@ -128,6 +138,75 @@ class DigitalPLL:
         self.count_ += 1.0
         return self.sample_
 
+    def process(self, signal):
+        """
+        Block version of __call__. Returns indices of all samples in signal
+        (array of booleans) for which __call__ would return True, and leaves
+        the PLL in the same state.
+
+        Only transitions in the input need to be handled one by one. In
+        between transitions the counter increases by one every sample, so the
+        samples where it crosses the limit are calculated directly.
+        """
+        signal = np.asarray(signal, dtype=bool)
+        previous = np.concatenate(([bool(self.last_)], signal[:-1]))
+        transitions = np.flatnonzero(signal != previous).tolist()
+
+        indices = []
+        start = 0
+        for end in transitions + [len(signal)]:
+            self._run(start, end, indices)
+            if end < len(signal):
+                self.transition(signal[end])
+                self.count_ += 1.0
+            start = end + 1
+
+        self.sample_ = len(indices) > 0 and indices[-1] == len(signal) - 1
+        return np.array(indices, dtype=int)
+
+    def _run(self, start, end, indices):
+        # Process samples start..end-1, the input does not change
+        if end - start < self.sps_:
+            # Short run, calculating directly is not worth the overhead
+            for i in range(start, end):
+                if self.bits_ > 127.0:
+                    self.transition(self.last_)
+                elif self.count_ > self.limit_:
+                    indices.append(i)
+                    self.count_ -= self.sps_
+                    self.bits_ += 1
+                self.count_ += 1.0
+            return
+
+        while start < end:
+            if self.bits_ > 127.0:
+                # No transition for a long time, treat as transition
+                self.transition(self.last_)
+                self.count_ += 1.0
+                start += 1
+                continue
+
+            length = end - start
+            # Maximum number of samples before bits_ exceeds 127
+            allowed = math.floor(127.0 - self.bits_) + 1
+            # Offsets (from start) of samples where counter exceeds limit
+            n = np.arange(min(allowed, math.ceil(length / self.sps_) + 1))
+            offsets = np.floor(self.limit_ + n * self.sps_ - self.count_).astype(int) + 1
+            offsets = np.maximum(offsets, n + max(0, offsets[0]))
+            offsets = offsets[offsets < length]
+            count = len(offsets)
+            indices.extend((offsets + start).tolist())
+            self.bits_ += count
+
+            if count == allowed and offsets[-1] + 1 < length:
+                # The sample after the last sample is a forced transition
+                processed = offsets[-1] + 1
+                self.count_ += processed - count * self.sps_
+                start += processed
+            else:
+                self.count_ += length - count * self.sps_
+                start = end
+
     def locked(self):
         return self.lock_(self.jitter_)
 
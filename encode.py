@@ -1,13 +1,19 @@
+import logging
 import sys
-from typing import Union
+import threading
+import time
+from typing import Iterator, Optional, Union
 
 import numpy as np
 
+import modem
+from modem import ModemConfig
 import packet
 import tone_conversion
-import settings
 
 
+log = logging.getLogger(__name__)
+
 # def reduce_click(samples: np.ndarray):
 #     if settings.ANTICLICK_STOP_AT_FULL_PERIOD:
 #         # Ensure sine wave ends at approx zero, at the end of a period
@@ -41,72 +47,314 @@ import settings
 #     return np.array(data, dtype='i2') # signed 16-bit integers
 
 
-def gauss_kernel() -> np.ndarray:
-    # Convolution with cosine kernel, centered with peak at x=0
-    # Not exactly guassian, but close enough?
-    kernel_x = np.linspace(-np.pi, np.pi, settings.GUASSIAN_KERNEL_SIZE)
-    kernel_y = np.cos(kernel_x) + 1  # cosine in range to [0, 2] (adjusted from [-1, 1])
-    return kernel_y / np.sum(kernel_y)  # normalize, for consistent amplitude after convolution
+def gauss_kernel(config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Kernel is only calculated once per configuration, see ModemConfig
+    return modem.get(config).gauss_kernel
 
 
-def tone_frequencies(tones: Union[int, np.ndarray]) -> np.ndarray:
-    if settings.MFSK:
+def tone_frequencies(tones: Union[int, np.ndarray], config: Optional[ModemConfig] = None, carrier: int = 0) -> np.ndarray:
+    config = modem.get(config)
+    if config.MFSK:
         # Calculate frequency for all tones, then repeat according to
         # SAMPLES_PER_TONE setting
-        return np.repeat(tones * settings.FREQ_SPACE + settings.FREQ_BASE, settings.SAMPLES_PER_TONE)
+        return np.repeat(tones * config.FREQ_SPACE + config.carrier_bases[carrier], config.SAMPLES_PER_TONE)
     else:
         # Convert 0/1 bit list into space/mark frequency list
         freqs = np.zeros_like(tones, dtype='i2')
-        freqs[tones == 1] = settings.FREQ_MARK
-        freqs[tones == 0] = settings.FREQ_SPACE
+        freqs[tones == 1] = config.FREQ_MARK
+        freqs[tones == 0] = config.FREQ_SPACE
         # Repeat each frequency SAMPLES_PER_TONE times
-        return np.repeat(freqs, settings.SAMPLES_PER_TONE)
-
-
-def tones_to_sine_gauss(tones: np.ndarray) -> np.ndarray:
-    if settings.MFSK:
-        # Create repeated frequencies array for tones
-        freqs = tone_frequencies(tones)
-        # Create sync signal, linear sweep from one frequency to another
-        sync = np.linspace(settings.SYNC_SWEEP_END, settings.SYNC_SWEEP_BEGIN,
-                           settings.SYNC_SWEEP_SAMPLES)
-        # Create end tone signal
-        end = tone_frequencies(settings.SYNC_END_TONE)
-        # Join the above three arrays
-        freqs = np.concatenate((sync, freqs, end))
-    else:
-        freqs = tone_frequencies(tones)
+        return np.repeat(freqs, config.SAMPLES_PER_TONE)
+
+
+def sync_frequencies(config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Sync signal, linear sweep from one frequency to another
+    return modem.get(config).sync_frequencies
+
+
+def tones_to_symbols(tones: np.ndarray, config: ModemConfig) -> np.ndarray:
+    # Split tones over carriers: row i contains the tones sent at the same
+    # time in symbol i, one for every carrier. The last symbol is padded with
+    # zero tones, the receiver ignores the resulting partial byte or extra
+    # bytes after the packet.
+    padding = -len(tones) % config.CARRIERS
+    tones = np.concatenate((tones, np.zeros(padding, dtype=int)))
+    return tones.reshape(-1, config.CARRIERS)
+
+
+class Synthesizer:
+    """
+    Phase continuous synthesis of a transmission, from tables. Frequency
+    transitions are smoothed by convolution with the Gaussian kernel. This
+    reduces "sideband power" as it is called in the RF world, or in the case
+    of audio it is audible as loud clicking. The kernel is not longer than a
+    tone, so the smoothed frequency of a tone only depends on its own
+    frequency and the frequencies of the previous and next tone, and it
+    does so linearly. The phase of every tone is therefore a weighted sum of
+    three precomputed phase curves (ModemConfig.tone_phase_response) and the
+    phase at the end of the previous tone. The sync sweep is precomputed
+    entirely, except for its last tone time.
+
+    Samples are written to int16 buffers provided by the caller, a block at
+    a time, so a transmission can be played while it is synthesized.
+    """
+    config: ModemConfig
+    frequencies: np.ndarray
+    phases: np.ndarray
+    volumes: Optional[np.ndarray]
+    sync_volumes: Optional[np.ndarray]
+    prefix: np.ndarray
+    size: int
+    position: int
+
+    def __init__(self, tones: np.ndarray, config: Optional[ModemConfig] = None):
+        config = modem.get(config)
+        self.config = config
+        tone_size = config.SAMPLES_PER_TONE
+        if config.MFSK:
+            # Frequency of every carrier for every symbol, and the end tone
+            symbols = tones_to_symbols(np.asarray(tones), config)
+            symbols = np.concatenate((symbols, np.full((1, config.CARRIERS), config.SYNC_END_TONE)))
+            self.frequencies = symbols * config.FREQ_SPACE + config.carrier_bases
+        else:
+            # Convert 0/1 bit list into space/mark frequency list
+            self.frequencies = np.where(np.asarray(tones) == 1, config.FREQ_MARK, config.FREQ_SPACE)[:, np.newaxis]
+        self.frequencies = self.frequencies.astype(np.float64)
+
+        if config.MFSK and config.CARRIERS > 1:
+            # Every carrier is sent at a lower volume, so the sum does not
+            # clip. Only the first carrier sends the sync signal, other
+            # carriers start after it. Volume changes are smoothed like
+            # frequency changes.
+            self.volumes = np.full_like(self.frequencies, 1 / config.CARRIERS)
+            self.sync_volumes = np.zeros(config.CARRIERS)
+            self.sync_volumes[0] = 1
+        else:
+            self.volumes = None
+            self.sync_volumes = None
+
+        # Phase change during every tone, then phase at the start of every tone
+        spread_back, own, spread_forward = config.tone_phase_response[:, -1]
+        previous, following = self.neighbours(self.frequencies, 0, len(self.frequencies))
+        changes = self.frequencies * own + previous * spread_forward + following * spread_back
+        if config.MFSK:
+            self.prefix = self.synthesize_prefix()
+            sync_end = config.sync_phase[config.SYNC_SWEEP_SAMPLES - 1]
+            changes[0] += config.sync_phase[-1] - sync_end
+            start = sync_end + self.frequencies[0] * spread_back
+        else:
+            self.prefix = np.zeros(0, dtype='i2')
+            start = np.zeros(1)
+        self.phases = (start + np.cumsum(changes, axis=0) - changes) % (2 * np.pi)
 
-    # Convolve frequencies with guassian kernel to smooth transition from
-    # one frequency to another. This reduces "sideband power" as it is called
-    # in the RF world, or in the case of audio it is audible as loud clicking
-    freqs_smooth = np.convolve(freqs, gauss_kernel(), mode='same')
-    # Convert frequency list to a sine wave signal with those frequencies
-    sine = np.sin(np.cumsum(2 * np.pi * freqs_smooth) / settings.SAMPLE_RATE)
-    # Scale sine wave with amplitude 1 to the maximum 2 byte integer value
-    return (sine * settings.OUTPUT_MAX).astype(dtype='i2')
+        self.size = len(self.prefix) + len(self.frequencies) * tone_size
+        self.position = 0
 
+    def neighbours(self, values: np.ndarray, first: int, last: int) -> tuple[np.ndarray, np.ndarray]:
+        # Values of the previous and next tone for tones first up to last,
+        # silence (0) before the first tone and after the last tone
+        zero = np.zeros((1, values.shape[1]))
+        previous = values[max(first - 1, 0):last - 1] if first > 0 else np.concatenate((zero, values[:last - 1]))
+        following = values[first + 1:last + 1] if last < len(values) else np.concatenate((values[first + 1:], zero))
+        return previous, following
 
-def data_to_audio(data: bytes) -> np.ndarray:
+    def synthesize_prefix(self) -> np.ndarray:
+        # Sync sweep, the first carrier sends the sweep with a precomputed
+        # table. During the last tone time of the sweep, the first tone of
+        # every carrier is spread into the sweep.
+        config = self.config
+        tone_size = config.SAMPLES_PER_TONE
+        tail_start = config.SYNC_SWEEP_SAMPLES - tone_size
+        assert tail_start >= tone_size
+        phase = config.sync_phase[tail_start:config.SYNC_SWEEP_SAMPLES] \
+            + self.frequencies[0, :, np.newaxis] * config.tone_phase_response[0]
+        sine = np.sin(phase)
+        if self.volumes is not None:
+            sine *= self.sync_volumes[:, np.newaxis] * (1 - config.tone_response[0]) \
+                + self.volumes[0, :, np.newaxis] * config.tone_response[0]
+        tail = (np.sum(sine, axis=0) * config.OUTPUT_MAX).astype('i2')
+        return np.concatenate((config.sync_samples, tail))
+
+    def synthesize_tones(self, first: int, last: int) -> np.ndarray:
+        # Samples of tones first up to last, shape (tones, carriers, samples)
+        config = self.config
+        spread_back, own, spread_forward = config.tone_phase_response
+        frequencies = self.frequencies[first:last, :, np.newaxis]
+        previous, following = self.neighbours(self.frequencies, first, last)
+        phase = self.phases[first:last, :, np.newaxis] + frequencies * own \
+            + previous[:, :, np.newaxis] * spread_forward + following[:, :, np.newaxis] * spread_back
+        if first == 0 and config.MFSK:
+            # End of the sync sweep spread into the first tone
+            sync_start = config.SYNC_SWEEP_SAMPLES
+            phase[0] += config.sync_phase[sync_start:] - config.sync_phase[sync_start - 1]
+        sine = np.sin(phase, out=phase)
+
+        if self.volumes is not None:
+            spread_back, own, spread_forward = config.tone_response
+            previous, following = self.neighbours(self.volumes, first, last)
+            if first == 0 and config.MFSK:
+                previous[0] = self.sync_volumes
+            sine *= self.volumes[first:last, :, np.newaxis] * own \
+                + previous[:, :, np.newaxis] * spread_forward + following[:, :, np.newaxis] * spread_back
+        return sine
+
+    def fill(self, out: np.ndarray) -> int:
+        # Write the next samples to int16 array out. Returns the number of
+        # samples written, which is less than the size of out at the end of
+        # the transmission.
+        count = min(len(out), self.size - self.position)
+        written = 0
+        if self.position < len(self.prefix):
+            written = min(count, len(self.prefix) - self.position)
+            out[:written] = self.prefix[self.position:self.position+written]
+            self.position += written
+
+        if written < count:
+            tone_size = self.config.SAMPLES_PER_TONE
+            offset = self.position - len(self.prefix)
+            first = offset // tone_size
+            last = -(-(offset + count - written) // tone_size)
+            sine = self.synthesize_tones(first, last)
+            samples = np.sum(sine, axis=1) if self.volumes is not None else sine[:, 0]
+            samples = samples.ravel()[offset - first * tone_size:]
+            # Scale sine wave with amplitude 1 to the maximum 2 byte integer
+            # value, conversion to int16 truncates like astype()
+            np.multiply(samples[:count - written], self.config.OUTPUT_MAX, out=samples[:count - written])
+            out[written:count] = samples[:count - written]
+            self.position += count - written
+        return count
+
+
+# Number of samples synthesized at once, limits the size of temporary arrays
+SYNTHESIS_BLOCK_SIZE = 16384
+
+
+def tones_to_sine_gauss(tones: np.ndarray, config: Optional[ModemConfig] = None) -> np.ndarray:
+    synthesizer = Synthesizer(tones, config)
+    samples = np.empty(synthesizer.size, dtype='i2')
+    for start in range(0, synthesizer.size, SYNTHESIS_BLOCK_SIZE):
+        synthesizer.fill(samples[start:start+SYNTHESIS_BLOCK_SIZE])
+    return samples
+
+
+def data_to_audio(data: bytes, config: Optional[ModemConfig] = None) -> np.ndarray:
     # Convert message to a packet. This adds a header with message size
     # and checksum. It also compresses the message, if enabled.
-    send_data = packet.pack(data)
-    print('header_bytes', send_data[:settings.PACKET_HEADER_SIZE])
+    return packet_to_audio(packet.pack(data), config)
+
+
+def packet_to_tones(send_data: bytes, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Tones for a packet created by packet.pack() or packet.pack_many()
+    config = modem.get(config)
+    log.debug('header_bytes %s', send_data[:packet.header_size()])
 
     # MFSK uses sync sweep to find start, but non-M FSK has no such thing.
     # Prepend start marker to bitstream
-    if not settings.MFSK:
-        send_data = settings.START_MARKER + send_data
-
-    print('size:', len(send_data))
-    print('transmission:', send_data)
-    tones = tone_conversion.bytes_to_tones(send_data)
-    print('tones:', tones)
-    if settings.GAUSSIAN:
-        return tones_to_sine_gauss(np.array(tones))
-    else:
+    if not config.MFSK:
+        send_data = config.START_MARKER + send_data
+
+    log.debug('size: %d', len(send_data))
+    log.debug('transmission: %s', send_data)
+    tones = tone_conversion.bytes_to_tones(send_data, config)
+    log.debug('tones: %s', tones)
+    if not config.GAUSSIAN:
         raise ValueError('non-gauss code is no longer up-to-date and temporarily disabled')
-        # return tones_to_sine(tones)
+    return np.array(tones)
+
+
+def packet_to_audio(send_data: bytes, config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Audio for a packet created by packet.pack() or packet.pack_many()
+    return tones_to_sine_gauss(packet_to_tones(send_data, config), config)
+
+
+class Transmission:
+    """
+    Streaming audio for a packet: noise, the packet, and noise again, or
+    only the packet. Nothing is synthesized until samples are requested with
+    fill(), so playback can start when the first block is ready, and only a
+    block of samples is in memory at a time.
+    """
+    synthesizer: Synthesizer
+    noise_size: int
+    noise_level: float
+    rng: np.random.Generator
+    size: int
+    position: int
+
+    def __init__(self, send_data: bytes, config: Optional[ModemConfig] = None, noise: bool = True):
+        config = modem.get(config)
+        self.synthesizer = Synthesizer(packet_to_tones(send_data, config), config)
+        # Short, quiet noise to wake up audio interface and prevent artifacts
+        # at start and end of transmission
+        self.noise_size = config.NOISE_SAMPLES if noise else 0
+        self.noise_level = config.NOISE_LEVEL
+        self.rng = np.random.default_rng()
+        self.size = self.synthesizer.size + 2 * self.noise_size
+        self.position = 0
+
+    @property
+    def done(self) -> bool:
+        return self.position == self.size
+
+    def fill_noise(self, out: np.ndarray, end: int) -> int:
+        # Noise up to position end
+        count = max(min(len(out), end - self.position), 0)
+        out[:count] = self.rng.uniform(-self.noise_level, self.noise_level, count)
+        self.position += count
+        return count
+
+    def fill(self, out: np.ndarray) -> int:
+        # Same as Synthesizer.fill()
+        written = self.fill_noise(out, self.noise_size)
+        count = self.synthesizer.fill(out[written:])
+        self.position += count
+        written += count
+        written += self.fill_noise(out[written:], self.size)
+        return written
+
+
+def blocks(transmission: Transmission, block_size: int = SYNTHESIS_BLOCK_SIZE) -> Iterator[np.ndarray]:
+    # Samples of a transmission in blocks of block_size samples, the last
+    # block may be smaller. Every block is synthesized when it is requested.
+    while not transmission.done:
+        block = np.empty(min(block_size, transmission.size - transmission.position), dtype='i2')
+        transmission.fill(block)
+        yield block
+
+
+def play(transmission: Transmission, config: Optional[ModemConfig] = None, volume_divisor: int = 2):
+    # Play a transmission, synthesizing samples in the output stream
+    # callback. Returns when the last sample has been played.
+    import sounddevice as sd
+
+    config = modem.get(config)
+    finished = threading.Event()
+
+    def callback(outdata: np.ndarray, frames: int, _time, status):
+        if status:
+            log.warning('%s', status)
+        out = outdata[:, 0]
+        filled = transmission.fill(out)
+        out[filled:] = 0
+        np.floor_divide(out, volume_divisor, out=out)
+        if transmission.done:
+            raise sd.CallbackStop()
+
+    with sd.OutputStream(samplerate=config.SAMPLE_RATE, latency='high', channels=1, dtype='int16',
+                         callback=callback, finished_callback=finished.set):
+        finished.wait()
+
+
+def channels_to_audio(messages: list[bytes], config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Send one message on every channel at the same time. Audio of all
+    # channels is added, at a lower volume so the sum does not clip.
+    channels = modem.get(config).channels()
+    assert len(messages) == len(channels)
+    audio = [data_to_audio(data, channel) for data, channel in zip(messages, channels)]
+    mixed = np.zeros(max(len(samples) for samples in audio))
+    for samples in audio:
+        mixed[:len(samples)] += samples
+    return (mixed / len(channels)).astype('i2')
 
 
 if __name__ == '__main__':
@@ -114,38 +362,59 @@ if __name__ == '__main__':
         print('Please provide write/plot/play and message as command line argument')
         sys.exit(1)
 
+    config = modem.DEFAULT
     data = ' '.join(sys.argv[2:]).encode()
-    noise = np.random.uniform(low=-settings.NOISE_LEVEL,
-                              high=settings.NOISE_LEVEL,
-                              size=settings.NOISE_SAMPLES).astype('i2')
-    samples = np.concatenate((noise, data_to_audio(data), noise))
 
-    print('sample count', len(samples))
+    if config.MFSK:
+        first_tone_midpoint = config.NOISE_SAMPLES + config.SYNC_SWEEP_SAMPLES + config.SAMPLES_PER_TONE // 2
+    else:
+        first_tone_midpoint = config.NOISE_SAMPLES + config.SAMPLES_PER_TONE // 2
+    print(f'first tone midpoint: ', first_tone_midpoint, f'{first_tone_midpoint/config.SAMPLE_RATE:.4f}')
 
-    if settings.MFSK:
-        first_tone_midpoint = len(noise) + settings.SYNC_SWEEP_SAMPLES + settings.SAMPLES_PER_TONE // 2
+    if config.CHANNELS == 1 and sys.argv[1] in ('write', 'play'):
+        # Synthesize while writing or playing
+        if sys.argv[1] == 'write':
+            import test_wav
+            test_wav.write_blocks(blocks(Transmission(packet.pack(data), config)))
+        else:
+            while True:
+                print('play')
+                play(Transmission(packet.pack(data), config), config)
+                print('done')
+                time.sleep(2)
+        sys.exit(0)
+
+    noise = np.random.uniform(low=-config.NOISE_LEVEL,
+                              high=config.NOISE_LEVEL,
+                              size=config.NOISE_SAMPLES).astype('i2')
+    if config.CHANNELS == 1:
+        audio = data_to_audio(data, config)
     else:
-        first_tone_midpoint = len(noise) + settings.SAMPLES_PER_TONE // 2
-    print(f'first tone midpoint: ', first_tone_midpoint, f'{first_tone_midpoint/settings.SAMPLE_RATE:.4f}')
+        # Split message in a part for every channel
+        part_size = -(-len(data) // config.CHANNELS)
+        audio = channels_to_audio([data[i*part_size:(i+1)*part_size] for i in range(config.CHANNELS)], config)
+    samples = np.concatenate((noise, audio, noise))
+
+    print('sample count', len(samples))
 
     if sys.argv[1] == 'write':
         import test_wav
         test_wav.write(samples)
     elif sys.argv[1] == 'plot':
         from matplotlib import pyplot as plt
-        samples_x = np.linspace(0, len(samples) / settings.SAMPLE_RATE, num=len(samples))
+        samples_x = np.linspace(0, len(samples) / config.SAMPLE_RATE, num=len(samples))
         ax1 = plt.subplot(1, 2, 1)
-        ax1.specgram(samples, Fs=settings.SAMPLE_RATE, scale='dB')
+        ax1.specgram(samples, Fs=config.SAMPLE_RATE, scale='dB')
         ax1.set_ylim(top=10000)
         ax2 = plt.subplot(1, 2, 2, sharex=ax1)
-        ax2.plot(samples_x, samples / settings.OUTPUT_MAX)
+        ax2.plot(samples_x, samples / config.OUTPUT_MAX)
         plt.show()
     elif sys.argv[1] == 'play':
         import sounddevice as sd
 
         while True:
             print('play')
-            sd.play(samples // 2, latency='high', samplerate=settings.SAMPLE_RATE, blocking=True)
+            sd.play(samples // 2, latency='high', samplerate=config.SAMPLE_RATE, blocking=True)
             print('done')
             sd.sleep(2000)
     else:
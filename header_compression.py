@@ -0,0 +1,417 @@
+# Header compression for IP packets sent by bridge.py, in the style of Van
+# Jacobson TCP/IP header compression (RFC 1144), also used for UDP and IPv6.
+# The 40 to 60 bytes of IP and TCP headers are often larger than the payload
+# of interactive traffic, and every byte costs airtime.
+#
+# Packets of the same flow (addresses, protocol and ports) share a context,
+# which holds a reference header. The first packet of a flow is sent in full
+# and becomes the reference. Following packets only contain the header fields
+# that differ from the reference: a bitmap of changed fields, followed by the
+# new value of every changed field. Fields that always increase (sequence
+# numbers, IP identification, TCP timestamps) are sent as the difference with
+# the reference. Lengths and the IP header checksum are not sent at all, the
+# decompressor calculates them.
+#
+# Unlike RFC 1144, fields are relative to the reference header instead of the
+# previous packet, so a lost packet does not affect the packets after it.
+# Only a lost full packet does, because the decompressor then has an older
+# reference than the compressor. Every full packet of a context increments
+# the context generation, which is sent with compressed packets, so the
+# decompressor can tell it has the wrong reference and drops the packet
+# instead of writing a packet with wrong headers. The compressor sends a full
+# packet every HEADER_COMPRESSION_REFRESH packets, which resynchronizes the
+# context.
+#
+# Compressed packet layout:
+#   1 byte type (upper 2 bits) and context id (lower 6 bits)
+#   if TYPE_RAW: packet (not compressed, context id is 0)
+#   if TYPE_FULL: 1 byte generation, packet
+#   if TYPE_COMPRESSED: 1 byte generation, bitmap of changed fields, value of
+#             every changed field, payload
+# The bitmap and differences are variable length integers (see
+# write_varint()).
+
+import struct
+import sys
+from collections import OrderedDict
+from typing import Optional
+
+import settings
+
+
+TYPE_RAW = 0
+TYPE_FULL = 1
+TYPE_COMPRESSED = 2
+
+MAX_CONTEXTS = 64
+
+PROTOCOL_TCP = 6
+PROTOCOL_UDP = 17
+
+# Field kinds. The value of a RAW field is sent as is, the value of a DELTA
+# field as the difference with the reference, which is usually small.
+RAW = 0
+DELTA = 1
+
+IPV4_HEADER_SIZE = 20
+IPV6_HEADER_SIZE = 40
+TCP_HEADER_SIZE = 20
+UDP_HEADER_SIZE = 8
+
+# Header fields that can change within a flow, as (offset, size, kind).
+# Other bytes either identify the flow, so they are equal to the reference, or
+# are calculated by the decompressor.
+IPV4_FIELDS = [
+    (1, 1, RAW),  # type of service
+    (4, 2, DELTA),  # identification
+    (6, 2, RAW),  # flags, fragment offset
+    (8, 1, RAW),  # time to live
+]
+IPV6_FIELDS = [
+    (0, 4, RAW),  # version, traffic class, flow label
+    (7, 1, RAW),  # hop limit
+]
+TCP_FIELDS = [
+    (4, 4, DELTA),  # sequence number
+    (8, 4, DELTA),  # acknowledgement number
+    (12, 2, RAW),  # data offset, flags
+    (14, 2, DELTA),  # window
+    (16, 2, RAW),  # checksum
+    (18, 2, RAW),  # urgent pointer
+]
+UDP_FIELDS = [
+    (6, 2, RAW),  # checksum
+]
+
+
+class HeaderDecompressError(Exception):
+    """
+    Compressed packet is invalid, it is dropped
+    """
+    pass
+
+
+class ContextError(HeaderDecompressError):
+    """
+    Compressed packet refers to a context the decompressor does not have, or
+    to an older or newer reference header, because a full packet was lost.
+    Packets of the flow are dropped until the next full packet.
+    """
+    pass
+
+
+def write_varint(value: int) -> bytes:
+    # 7 bits per byte, least significant first, the high bit is set on all
+    # bytes except the last
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    # Value and offset after the value
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise HeaderDecompressError('Truncated value')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+
+def internet_checksum(data: bytes) -> int:
+    # Checksum of the IPv4 header, data has an even number of bytes
+    total = sum(struct.unpack(f'>{len(data) // 2}H', data))
+    while total > 0xffff:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def parse(data: bytes) -> Optional[tuple[bytes, int, list[tuple[int, int, int]]]]:
+    # Flow key, header size and fields that can change within a flow (with
+    # offsets in the packet) for packets that can be compressed. Returns None
+    # for other packets: other protocols, IP options, fragments, or lengths
+    # and checksums that the decompressor would not calculate the same way.
+    if len(data) == 0:
+        return None
+    version = data[0] >> 4
+    if version == 4:
+        if len(data) < IPV4_HEADER_SIZE or data[0] != 0x45:
+            return None
+        total_length, flags_fragment, protocol = struct.unpack_from('>H2xHxB', data, 2)
+        if total_length != len(data) or flags_fragment & 0x3fff \
+                or internet_checksum(data[:IPV4_HEADER_SIZE]) != 0:
+            return None
+        ip_size = IPV4_HEADER_SIZE
+        ip_fields = IPV4_FIELDS
+        addresses = data[12:20]
+    elif version == 6:
+        if len(data) < IPV6_HEADER_SIZE:
+            return None
+        payload_length, protocol = struct.unpack_from('>HB', data, 4)
+        if payload_length != len(data) - IPV6_HEADER_SIZE:
+            return None
+        ip_size = IPV6_HEADER_SIZE
+        ip_fields = IPV6_FIELDS
+        addresses = data[8:40]
+    else:
+        return None
+
+    if protocol == PROTOCOL_TCP:
+        if len(data) < ip_size + TCP_HEADER_SIZE:
+            return None
+        transport_size = (data[ip_size + 12] >> 4) * 4
+        if transport_size < TCP_HEADER_SIZE or len(data) < ip_size + transport_size:
+            return None
+        # Options are split in 32 bit words, the timestamp option changes with
+        # every packet but only increases by a small amount
+        transport_fields = TCP_FIELDS + [(offset, 4, DELTA) for offset in range(TCP_HEADER_SIZE, transport_size, 4)]
+    elif protocol == PROTOCOL_UDP:
+        transport_size = UDP_HEADER_SIZE
+        if len(data) < ip_size + transport_size \
+                or struct.unpack_from('>H', data, ip_size + 4)[0] != len(data) - ip_size:
+            return None
+        transport_fields = UDP_FIELDS
+    else:
+        return None
+
+    key = bytes([version, protocol]) + addresses + data[ip_size:ip_size+4]
+    fields = ip_fields + [(ip_size + offset, size, kind) for offset, size, kind in transport_fields]
+    return key, ip_size + transport_size, fields
+
+
+def complete(data: bytearray):
+    # Calculate the fields the compressor did not send: lengths and the IPv4
+    # header checksum
+    if data[0] >> 4 == 4:
+        ip_size = IPV4_HEADER_SIZE
+        struct.pack_into('>H', data, 2, len(data))
+        struct.pack_into('>H', data, 10, 0)
+        struct.pack_into('>H', data, 10, internet_checksum(data[:IPV4_HEADER_SIZE]))
+        protocol = data[9]
+    else:
+        ip_size = IPV6_HEADER_SIZE
+        struct.pack_into('>H', data, 4, len(data) - IPV6_HEADER_SIZE)
+        protocol = data[6]
+    if protocol == PROTOCOL_UDP:
+        struct.pack_into('>H', data, ip_size + 4, len(data) - ip_size)
+
+
+def field_value(data: bytes, offset: int, size: int) -> int:
+    return int.from_bytes(data[offset:offset+size], 'big')
+
+
+class Context:
+    id: int
+    generation: int
+    reference: bytes
+    header_size: int
+    fields: list[tuple[int, int, int]]
+    packets: int
+
+    def __init__(self, id: int):
+        self.id = id
+        self.generation = 0
+        self.packets = 0
+
+
+class HeaderCompressor:
+    """
+    Compresses headers of packets that are sent in order to a single
+    HeaderDecompressor. At most HEADER_COMPRESSION_CONTEXTS flows are
+    compressed at the same time, the least recently used context is reused
+    for a new flow.
+    """
+    context_count: int
+    refresh: int
+    contexts: OrderedDict  # flow key -> Context
+    full: int
+    compressed: int
+    raw: int
+    saved: int
+
+    def __init__(self, context_count: int = settings.HEADER_COMPRESSION_CONTEXTS,
+                 refresh: int = settings.HEADER_COMPRESSION_REFRESH):
+        assert 0 < context_count <= MAX_CONTEXTS
+        self.context_count = context_count
+        self.refresh = refresh
+        self.contexts = OrderedDict()
+        # Statistics: number of packets of every type, and bytes saved
+        self.full = 0
+        self.compressed = 0
+        self.raw = 0
+        self.saved = 0
+
+    def context(self, key: bytes) -> Context:
+        # Context of a flow, the least recently used context is taken over
+        # by a new flow
+        context = self.contexts.get(key)
+        if context is not None:
+            self.contexts.move_to_end(key)
+            return context
+        if len(self.contexts) < self.context_count:
+            context = Context(len(self.contexts))
+        else:
+            _key, context = self.contexts.popitem(last=False)
+            context.packets = 0
+            context.reference = b''
+        self.contexts[key] = context
+        return context
+
+    def compress(self, data: bytes) -> bytes:
+        parsed = parse(data)
+        if parsed is None:
+            self.raw += 1
+            return bytes([TYPE_RAW << 6]) + data
+        key, header_size, fields = parsed
+
+        context = self.context(key)
+        if context.packets == 0 or header_size != context.header_size:
+            # New flow, refresh, or a different header layout (TCP options)
+            context.generation = (context.generation + 1) % 256
+            context.reference = data[:header_size]
+            context.header_size = header_size
+            context.fields = fields
+            context.packets = self.refresh
+            self.full += 1
+            return bytes([TYPE_FULL << 6 | context.id, context.generation]) + data
+        context.packets -= 1
+
+        changed = 0
+        values = bytearray()
+        for i, (offset, size, kind) in enumerate(fields):
+            value = field_value(data, offset, size)
+            reference = field_value(context.reference, offset, size)
+            if value == reference:
+                continue
+            changed |= 1 << i
+            if kind == DELTA:
+                # Difference as a signed number, zigzag encoded (0, -1, 1,
+                # -2, ...) so small decreases are small as well
+                bits = 8 * size
+                delta = (value - reference) % (1 << bits)
+                if delta >= 1 << (bits - 1):
+                    delta -= 1 << bits
+                values += write_varint(2 * delta if delta >= 0 else -2 * delta - 1)
+            else:
+                values += data[offset:offset+size]
+
+        header = bytes([TYPE_COMPRESSED << 6 | context.id, context.generation]) + write_varint(changed) + values
+        self.compressed += 1
+        self.saved += header_size - len(header)
+        return header + data[header_size:]
+
+
+class HeaderDecompressor:
+    """
+    Restores packets created by a HeaderCompressor
+    """
+    contexts: dict[int, tuple[int, bytes, list[tuple[int, int, int]]]]
+    dropped: int
+
+    def __init__(self):
+        # Context id -> generation, reference header and fields
+        self.contexts = {}
+        self.dropped = 0
+
+    def decompress(self, data: bytes) -> bytes:
+        if len(data) == 0:
+            raise HeaderDecompressError('Empty packet')
+        packet_type = data[0] >> 6
+        context_id = data[0] & 0x3f
+        if packet_type == TYPE_RAW:
+            return data[1:]
+        if len(data) < 2:
+            raise HeaderDecompressError('Truncated packet')
+        generation = data[1]
+
+        if packet_type == TYPE_FULL:
+            packet = data[2:]
+            parsed = parse(packet)
+            if parsed is None:
+                raise HeaderDecompressError('Full packet can not be compressed')
+            _key, header_size, fields = parsed
+            self.contexts[context_id] = (generation, packet[:header_size], fields)
+            return packet
+
+        if packet_type != TYPE_COMPRESSED:
+            raise HeaderDecompressError(f'Unknown packet type {packet_type}')
+        if context_id not in self.contexts:
+            self.dropped += 1
+            raise ContextError(f'Unknown context {context_id}')
+        context_generation, reference, fields = self.contexts[context_id]
+        if generation != context_generation:
+            self.dropped += 1
+            raise ContextError(f'Context {context_id} has generation {context_generation}, packet has {generation}')
+
+        changed, offset = read_varint(data, 2)
+        header = bytearray(reference)
+        for i, (field_offset, size, kind) in enumerate(fields):
+            if not changed >> i & 1:
+                continue
+            if kind == DELTA:
+                value, offset = read_varint(data, offset)
+                delta = value // 2 if value % 2 == 0 else -(value + 1) // 2
+                value = (field_value(reference, field_offset, size) + delta) % (1 << (8 * size))
+                header[field_offset:field_offset+size] = value.to_bytes(size, 'big')
+            else:
+                if offset + size > len(data):
+                    raise HeaderDecompressError('Truncated field')
+                header[field_offset:field_offset+size] = data[offset:offset+size]
+                offset += size
+
+        packet = header + data[offset:]
+        complete(packet)
+        return bytes(packet)
+
+
+if __name__ == '__main__':
+    import random
+
+    def ipv4_tcp(seq: int, ack: int, ident: int, timestamp: int, payload: bytes) -> bytes:
+        # TCP packet with timestamp option, as sent by Linux
+        tcp = struct.pack('>HHIIHHHH', 40000, 22, seq, ack, (8 << 12) | 0x18, 502, random.randrange(65536), 0)
+        tcp += struct.pack('>BBBBII', 1, 1, 8, 10, timestamp, timestamp - 20)
+        ip = bytearray(struct.pack('>BBHHHBBH4s4s', 0x45, 0, IPV4_HEADER_SIZE + len(tcp) + len(payload),
+                                   ident, 0x4000, 64, PROTOCOL_TCP, 0, bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2])))
+        struct.pack_into('>H', ip, 10, internet_checksum(bytes(ip)))
+        return bytes(ip) + tcp + payload
+
+    packets = []
+    seq = 1000
+    for i in range(200):
+        payload = bytes(random.randrange(1, 40))
+        packets.append(ipv4_tcp(seq, 5000 + 3 * i, 100 + i, 70000 + 25 * i, payload))
+        seq += len(payload)
+    packets.append(b'\x45not an ip packet')
+
+    for loss in [0, 0.1]:
+        compressor = HeaderCompressor()
+        decompressor = HeaderDecompressor()
+        original_size = 0
+        compressed_size = 0
+        delivered = 0
+        for data in packets:
+            compressed = compressor.compress(data)
+            original_size += len(data)
+            compressed_size += len(compressed)
+            if random.random() < loss:
+                continue
+            try:
+                decompressed = decompressor.decompress(compressed)
+            except ContextError:
+                continue
+            if decompressed != data:
+                print('packet changed by compression')
+                sys.exit(1)
+            delivered += 1
+        print(f'loss {loss}: {original_size} bytes compressed to {compressed_size}, '
+              f'{compressor.saved / max(compressor.compressed, 1):.1f} bytes saved per compressed packet, '
+              f'{delivered}/{len(packets)} delivered, {decompressor.dropped} dropped after a lost full packet')
@@ -0,0 +1,461 @@
+# Selective repeat ARQ link layer. Frames are sent as packet messages (see
+# packet.py), corrupt frames are already discarded by the packet checksum, so
+# the link layer only has to deal with lost frames.
+#
+# Frame layout:
+#   1 byte flags (FLAG_DATA, FLAG_ACK)
+#   1 byte base: oldest sequence number the sender is still trying to send.
+#             Frames before it were acknowledged or given up on.
+#   if FLAG_DATA:
+#     1 byte sequence number
+#   if FLAG_ACK:
+#     1 byte ack: next sequence number the receiver expects
+#     2 bytes selective acknowledgement bitmap: bit i is set if frame
+#             ack + 1 + i was received. Missing frames before a received
+#             frame are negatively acknowledged.
+#   if FLAG_DATA:
+#     payload
+
+import random
+import struct
+import sys
+from collections import deque
+from typing import Optional
+
+import metrics
+import modem
+from modem import ModemConfig
+import packet
+from packet import BasePacketDecodeError
+import settings
+
+
+FLAG_DATA = 0x01
+FLAG_ACK = 0x02
+
+# Sequence numbers are a single byte
+SEQUENCE_MODULO = 256
+# Number of frames after ack in the selective acknowledgement bitmap, this is
+# also the maximum window size
+SACK_BITS = 16
+
+BASE_HEADER = struct.Struct('>BB')
+DATA_HEADER = struct.Struct('>B')
+ACK_HEADER = struct.Struct('>BH')
+MAX_HEADER_SIZE = BASE_HEADER.size + DATA_HEADER.size + ACK_HEADER.size
+MAX_PAYLOAD_SIZE = settings.MAX_PACKET_SIZE - MAX_HEADER_SIZE
+
+
+class LinkFrameError(Exception):
+    """
+    Received frame is too short to contain the header its flags announce
+    """
+    pass
+
+
+class Frame:
+    flags: int
+    base: int
+    seq: Optional[int]
+    ack: Optional[int]
+    sack: int
+    payload: bytes
+
+    def __init__(self, flags: int, base: int, seq: Optional[int] = None, ack: Optional[int] = None,
+                 sack: int = 0, payload: bytes = b''):
+        self.flags = flags
+        self.base = base
+        self.seq = seq
+        self.ack = ack
+        self.sack = sack
+        self.payload = payload
+
+    def to_bytes(self) -> bytes:
+        data = BASE_HEADER.pack(self.flags, self.base)
+        if self.flags & FLAG_DATA:
+            data += DATA_HEADER.pack(self.seq)
+        if self.flags & FLAG_ACK:
+            data += ACK_HEADER.pack(self.ack, self.sack)
+        return data + self.payload
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Frame':
+        if len(data) < BASE_HEADER.size:
+            raise LinkFrameError('Frame shorter than header')
+        flags, base = BASE_HEADER.unpack_from(data)
+        offset = BASE_HEADER.size
+        frame = Frame(flags, base)
+        if flags & FLAG_DATA:
+            if len(data) < offset + DATA_HEADER.size:
+                raise LinkFrameError('Data frame shorter than header')
+            frame.seq, = DATA_HEADER.unpack_from(data, offset)
+            offset += DATA_HEADER.size
+        if flags & FLAG_ACK:
+            if len(data) < offset + ACK_HEADER.size:
+                raise LinkFrameError('Acknowledgement frame shorter than header')
+            frame.ack, frame.sack = ACK_HEADER.unpack_from(data, offset)
+            offset += ACK_HEADER.size
+        if flags & FLAG_DATA:
+            frame.payload = data[offset:]
+        return frame
+
+
+class SentFrame:
+    seq: int
+    payload: bytes
+    order: int
+    deadline: float
+    retries: int
+
+    def __init__(self, seq: int, payload: bytes):
+        self.seq = seq
+        self.payload = payload
+        self.order = -1
+        self.deadline = 0.0
+        self.retries = 0
+
+
+def sequence_offset(seq: int, start: int) -> int:
+    # Number of frames from start to seq, modulo sequence number size
+    return (seq - start) % SEQUENCE_MODULO
+
+
+class LinkEndpoint:
+    """
+    One end of a selective repeat ARQ link. Payloads passed to send() are
+    delivered in order and without duplicates by the receive() method of the
+    other end, unless a frame is lost ARQ_MAX_RETRIES times.
+
+    The endpoint does not send or receive audio itself, and does not keep
+    time: poll() is called with the current time when the transmitter is
+    free, and returns the next frame to send. Frames received from the other
+    end are passed to receive(). This way, the same code runs with sound
+    cards and with a simulated channel (see LoopbackChannel).
+
+    Retransmit timers are derived from the airtime of a frame and its
+    acknowledgement, see ModemConfig.airtime(). A frame is also retransmitted
+    as soon as a frame sent after it is acknowledged, since frames can not
+    overtake each other.
+    """
+    config: ModemConfig
+    window: int
+    queue: deque
+    next_seq: int
+    in_flight: dict[int, SentFrame]
+    send_order: int
+    announce_base: bool
+    expected: int
+    received: dict[int, bytes]
+    ack_due: Optional[float]
+    retransmissions: int
+    given_up: int
+    duplicates: int
+    skipped: int
+
+    def __init__(self, config: Optional[ModemConfig] = None, window: int = settings.ARQ_WINDOW):
+        assert 0 < window <= SACK_BITS
+        self.config = modem.get(config)
+        self.window = window
+        # Sender state
+        self.queue = deque()
+        self.next_seq = 0
+        self.in_flight = {}
+        self.send_order = 0
+        self.announce_base = False
+        # Receiver state
+        self.expected = 0
+        self.received = {}
+        self.ack_due = None
+        # Statistics
+        self.retransmissions = 0
+        self.given_up = 0
+        self.duplicates = 0
+        self.skipped = 0
+
+    @property
+    def base(self) -> int:
+        # Oldest sequence number that is not acknowledged yet
+        return next(iter(self.in_flight), self.next_seq)
+
+    @property
+    def idle(self) -> bool:
+        # True if all payloads were sent and acknowledged (or given up on)
+        return not self.queue and not self.in_flight
+
+    def send(self, payload: bytes):
+        # Queue payload for sending
+        if len(payload) > MAX_PAYLOAD_SIZE:
+            raise ValueError('payload too long')
+        self.queue.append(payload)
+
+    def timeout(self, frame_size: int, retries: int) -> float:
+        # Time from start of sending a frame until it should have been
+        # acknowledged: airtime of the frame and of an acknowledgement frame.
+        # Frames are lost because of noise rather than congestion, so the
+        # timeout only backs off a little.
+        airtime = self.config.airtime(packet.packed_size(frame_size)) + \
+            self.config.airtime(packet.packed_size(BASE_HEADER.size + ACK_HEADER.size))
+        return (airtime + settings.ARQ_ACK_DELAY + settings.ARQ_TIMEOUT_MARGIN) * 2**min(retries, 2)
+
+    def frame_size(self, payload: Optional[bytes]) -> int:
+        # Size of the data frame for payload, or of an acknowledgement frame if
+        # payload is None, see build_frame()
+        size = BASE_HEADER.size
+        if payload is not None:
+            size += DATA_HEADER.size + len(payload)
+        if payload is None or self.ack_due is not None:
+            size += ACK_HEADER.size
+        return size
+
+    def poll(self, now: float, max_size: Optional[int] = None) -> Optional[bytes]:
+        # Next frame to send, starting now, or None if there is nothing to
+        # send. Retransmissions go first, then new frames, then a separate
+        # acknowledgement if no data frame could carry it. Frames larger than
+        # max_size are not returned, they are sent later.
+        def fits(payload: Optional[bytes]) -> bool:
+            return max_size is None or self.frame_size(payload) <= max_size
+
+        for sent in list(self.in_flight.values()):
+            if sent.deadline > now:
+                continue
+            if sent.retries >= settings.ARQ_MAX_RETRIES:
+                del self.in_flight[sent.seq]
+                self.given_up += 1
+                metrics.count('arq_given_up')
+                self.announce_base = True
+                continue
+            if not fits(sent.payload):
+                return None
+            sent.retries += 1
+            self.retransmissions += 1
+            metrics.count('arq_retransmissions')
+            return self.transmit(sent, now)
+
+        if self.queue and sequence_offset(self.next_seq, self.base) < self.window and fits(self.queue[0]):
+            sent = SentFrame(self.next_seq, self.queue.popleft())
+            self.in_flight[sent.seq] = sent
+            self.next_seq = (self.next_seq + 1) % SEQUENCE_MODULO
+            return self.transmit(sent, now)
+
+        if (self.announce_base or (self.ack_due is not None and self.ack_due <= now)) and fits(None):
+            return self.build_frame(None)
+
+        return None
+
+    def sent_together(self, first_order: int, now: float, size: int):
+        # Frames from send order first_order (send_order before the first
+        # frame was polled) were sent in a single transmission of size bytes,
+        # starting at now. They are only received at the end of the
+        # transmission, so their timers are based on its total size.
+        for sent in self.in_flight.values():
+            if sent.order >= first_order:
+                sent.deadline = now + self.timeout(size, sent.retries)
+
+    def next_event(self, now: float) -> Optional[float]:
+        # Earliest time poll() returns a frame, if nothing is received before
+        # that time. None if there is nothing to send.
+        times = [sent.deadline for sent in self.in_flight.values()]
+        if self.ack_due is not None:
+            times.append(self.ack_due)
+        if self.announce_base or (self.queue and sequence_offset(self.next_seq, self.base) < self.window):
+            times.append(now)
+        return max(now, min(times)) if times else None
+
+    def transmit(self, sent: SentFrame, now: float) -> bytes:
+        sent.order = self.send_order
+        self.send_order += 1
+        frame = self.build_frame(sent)
+        sent.deadline = now + self.timeout(len(frame), sent.retries)
+        return frame
+
+    def build_frame(self, sent: Optional[SentFrame]) -> bytes:
+        # Data frame for sent, or acknowledgement frame if sent is None.
+        # Pending acknowledgements are added to data frames.
+        frame = Frame(0, self.base)
+        if sent is not None:
+            frame.flags |= FLAG_DATA
+            frame.seq = sent.seq
+            frame.payload = sent.payload
+        if sent is None or self.ack_due is not None:
+            frame.flags |= FLAG_ACK
+            frame.ack = self.expected
+            for i in range(SACK_BITS):
+                if (self.expected + 1 + i) % SEQUENCE_MODULO in self.received:
+                    frame.sack |= 1 << i
+            self.ack_due = None
+        self.announce_base = False
+        return frame.to_bytes()
+
+    def receive(self, data: bytes, now: float) -> list[bytes]:
+        # Process a frame received from the other end. Returns payloads that
+        # can be delivered, in order.
+        frame = Frame.from_bytes(data)
+        if frame.flags & FLAG_ACK:
+            self.process_ack(frame.ack, frame.sack, now)
+
+        delivered = []
+        # The sender gave up on frames before its base, skip them
+        if 0 < sequence_offset(frame.base, self.expected) <= SACK_BITS:
+            while self.expected != frame.base:
+                if self.expected in self.received:
+                    delivered.append(self.received.pop(self.expected))
+                else:
+                    self.skipped += 1
+                self.expected = (self.expected + 1) % SEQUENCE_MODULO
+
+        if frame.flags & FLAG_DATA:
+            # Frames within the window are stored until all frames before them
+            # have arrived. Older frames were delivered before, their
+            # acknowledgement must have been lost.
+            if sequence_offset(frame.seq, self.expected) <= SACK_BITS and frame.seq not in self.received:
+                self.received[frame.seq] = frame.payload
+            else:
+                self.duplicates += 1
+            if self.ack_due is None:
+                self.ack_due = now + settings.ARQ_ACK_DELAY
+
+        while self.expected in self.received:
+            delivered.append(self.received.pop(self.expected))
+            self.expected = (self.expected + 1) % SEQUENCE_MODULO
+        return delivered
+
+    def process_ack(self, ack: int, sack: int, now: float):
+        # Remove acknowledged frames. Frames sent before an acknowledged frame
+        # that are still not acknowledged were lost, retransmit them now.
+        acked_order = -1
+        for sent in list(self.in_flight.values()):
+            offset = sequence_offset(sent.seq, ack)
+            if offset >= SEQUENCE_MODULO // 2 or (0 < offset <= SACK_BITS and sack >> (offset - 1) & 1):
+                acked_order = max(acked_order, sent.order)
+                del self.in_flight[sent.seq]
+        for sent in self.in_flight.values():
+            if sent.order < acked_order:
+                sent.deadline = min(sent.deadline, now)
+
+
+class LoopbackChannel:
+    """
+    Simulated one way channel between two link endpoints, for testing without
+    sound cards. Frames arrive in order, after their airtime. Frames are lost
+    with the given probability. If noise is given, frames are also sent
+    through the modem: encoded to audio, noise with the given standard
+    deviation is added, and the audio is decoded again, so frames are lost
+    when the modem fails to decode them.
+    """
+    config: ModemConfig
+    loss: float
+    noise: Optional[float]
+    rng: random.Random
+    busy_until: float
+    arrivals: deque
+
+    def __init__(self, loss: float = 0.0, noise: Optional[float] = None,
+                 config: Optional[ModemConfig] = None, seed: Optional[int] = None):
+        self.config = modem.get(config)
+        self.loss = loss
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self.busy_until = 0.0
+        self.arrivals = deque()
+
+    def transmit(self, frame: bytes, now: float):
+        # Start sending frame, the transmitter is busy until it is sent
+        self.busy_until = now + self.config.airtime(packet.packed_size(len(frame)))
+        if self.rng.random() < self.loss:
+            return
+        if self.noise is not None:
+            frame = self.modulate(frame)
+            if frame is None:
+                return
+        self.arrivals.append((self.busy_until, frame))
+
+    def modulate(self, frame: bytes) -> Optional[bytes]:
+        # Send frame through encoder and decoder, returns None if it could not
+        # be decoded
+        import numpy as np
+        import encode
+        import decode_fsk
+        import decode_mfsk
+
+        config = self.config
+        np_rng = np.random.default_rng(self.rng.getrandbits(32))
+        audio = encode.data_to_audio(frame, config) / 2
+        silence = np.zeros(config.NOISE_SAMPLES)
+        samples = np.concatenate((silence, audio, silence))
+        samples += np_rng.normal(0, self.noise, len(samples))
+        samples = np.clip(samples, -config.OUTPUT_MAX, config.OUTPUT_MAX).astype('i2')
+        if config.MFSK:
+            first_tone_midpoint = decode_mfsk.find_first_tone_midpoint(samples, config)
+            if first_tone_midpoint is None:
+                return None
+            try:
+                return packet.unpack(decode_mfsk.audio_to_bytes(samples, first_tone_midpoint, config))
+            except BasePacketDecodeError:
+                return None
+        messages = decode_fsk.StreamingDemodulator(config).feed(samples)
+        return messages[0] if messages else None
+
+    def deliver(self, now: float) -> list[bytes]:
+        # Frames that have completely arrived at the given time
+        frames = []
+        while self.arrivals and self.arrivals[0][0] <= now:
+            frames.append(self.arrivals.popleft()[1])
+        return frames
+
+
+def run_loopback(payloads: list[bytes], loss: float = 0.0, noise: Optional[float] = None,
+                 config: Optional[ModemConfig] = None, seed: int = 0, time_limit: float = 24*3600) -> tuple[list[bytes], float, LinkEndpoint]:
+    # Send payloads from one endpoint to another over simulated channels, in
+    # simulated time. Returns the delivered payloads, the time it took and the
+    # sending endpoint (for statistics).
+    sender = LinkEndpoint(config)
+    receiver = LinkEndpoint(config)
+    forward = LoopbackChannel(loss, noise, config, seed)
+    backward = LoopbackChannel(loss, noise, config, seed + 1)
+    for payload in payloads:
+        sender.send(payload)
+
+    delivered = []
+    now = 0.0
+    while not (sender.idle and not forward.arrivals) and now < time_limit:
+        for endpoint, channel in ((sender, forward), (receiver, backward)):
+            if channel.busy_until <= now:
+                frame = endpoint.poll(now)
+                if frame is not None:
+                    channel.transmit(frame, now)
+        for frame in forward.deliver(now):
+            delivered.extend(receiver.receive(frame, now))
+        for frame in backward.deliver(now):
+            sender.receive(frame, now)
+
+        # Continue at the next moment something happens
+        times = [time for time, _frame in forward.arrivals] + [time for time, _frame in backward.arrivals]
+        for endpoint, channel in ((sender, forward), (receiver, backward)):
+            event = endpoint.next_event(now)
+            if event is not None:
+                times.append(max(event, channel.busy_until))
+        if not times:
+            break
+        now = max(min(times), now + 1e-3)
+    return delivered, now, sender
+
+
+if __name__ == '__main__':
+    config = modem.DEFAULT
+    rng = random.Random(0)
+    payloads = [rng.randbytes(rng.randint(1, 100)) for _ in range(40)]
+    payload_bytes = sum(len(payload) for payload in payloads)
+    for loss in [0.0, 0.1, 0.3]:
+        delivered, duration, sender = run_loopback(payloads, loss, config=config, seed=1)
+        print(f'loss {loss:.1f}: delivered {len(delivered)}/{len(payloads)} in {duration:.0f} seconds,',
+              f'{payload_bytes / duration:.1f} bytes/s, {sender.retransmissions} retransmissions,',
+              f'{sender.given_up} given up')
+        if sender.given_up == 0:
+            assert delivered == payloads
+
+    if len(sys.argv) > 1:
+        # Frames sent through the modem with noise
+        noise = float(sys.argv[1])
+        delivered, duration, sender = run_loopback(payloads[:8], noise=noise, config=config, seed=1)
+        print(f'noise {noise:.0f}: delivered {len(delivered)}/8 in {duration:.0f} seconds,',
+              f'{sender.retransmissions} retransmissions, {sender.given_up} given up')
@@ -0,0 +1,195 @@
+# Counters and histograms of what the transmitter and receivers are doing,
+# instead of printing every step: samples captured, buffer overruns, sync
+# attempts, decoded tones, corrupt packets, processing time of every stage
+# and packet latency. Counting is cheap, so metrics are always collected.
+# They are exported as JSON, to a file every METRICS_INTERVAL seconds
+# (METRICS_FILE) or from an HTTP server on localhost (METRICS_PORT):
+#   curl http://localhost:8000/
+#
+# Programs that run continuously call setup(), which also applies LOG_LEVEL
+# to the log messages of all modules.
+
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+
+import settings
+
+
+# Upper bounds of histogram buckets for durations, in seconds
+TIME_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0, 25.0, 60.0]
+
+
+class Histogram:
+    """
+    Distribution of observed values, as the number of values in buckets with
+    fixed upper bounds. Values larger than the last bound are counted in an
+    extra bucket.
+    """
+    bounds: list[float]
+    counts: list[int]
+    count: int
+    total: float
+    minimum: Optional[float]
+    maximum: Optional[float]
+
+    def __init__(self, bounds: list[float] = TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.minimum,
+            'max': self.maximum,
+            'buckets': [[bound, count] for bound, count in zip(self.bounds + ['inf'], self.counts)],
+        }
+
+
+class Metrics:
+    """
+    Named counters and histograms. Audio callbacks, processing threads and
+    the event loop all update metrics, so every update takes a lock.
+    """
+    lock: threading.Lock
+    started: float
+    counters: dict[str, int]
+    histograms: dict[str, Histogram]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float, bounds: list[float] = TIME_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        # Observes the duration of the with block, in seconds
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+
+# Metrics of this process
+METRICS = Metrics()
+count = METRICS.count
+observe = METRICS.observe
+timer = METRICS.timer
+snapshot = METRICS.snapshot
+
+
+def write_snapshot(path: str):
+    # The file is replaced at once, readers never see a partial snapshot
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+    os.replace(temporary, path)
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Writes a snapshot of the metrics to a file at a fixed interval
+    """
+    path: str
+    interval: float
+
+    def __init__(self, path: str, interval: float):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                write_snapshot(self.path)
+            except OSError as ex:
+                logging.getLogger(__name__).warning('could not write metrics: %s', ex)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(snapshot(), indent=2).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are not logged
+        pass
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    # Serve metrics on localhost from a background thread
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def setup():
+    # Apply LOG_LEVEL and start the exporters enabled in settings.py
+    logging.basicConfig(level=settings.LOG_LEVEL, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    if settings.METRICS_FILE is not None:
+        SnapshotWriter(settings.METRICS_FILE, settings.METRICS_INTERVAL).start()
+    if settings.METRICS_PORT is not None:
+        serve(settings.METRICS_PORT)
+
+
+if __name__ == '__main__':
+    count('example_counter', 3)
+    for value in [0.0002, 0.003, 0.003, 0.2, 100.0]:
+        observe('example_time', value)
+    with timer('example_time'):
+        time.sleep(0.01)
+    result = snapshot()
+    assert result['counters']['example_counter'] == 3
+    assert result['histograms']['example_time']['count'] == 6
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,472 @@
+import math
+from functools import cached_property
+from typing import Optional
+
+import numpy as np
+from scipy.signal import butter, firwin
+
+import convolutional
+import gray
+import settings
+
+
+# Settings that are the same for all profiles, taken from settings.py
+COMMON_SETTINGS = [
+    'SAMPLE_RATE',
+    'GAUSSIAN',
+    'USE_GRAY_ENCODING',
+    'NOISE_SAMPLES',
+    'NOISE_LEVEL',
+    'OUTPUT_MAX',
+    'CHANNELS',
+]
+
+# Named modem configurations. Settings not listed here are taken from
+# COMMON_SETTINGS or derived from other settings, see ModemConfig.derive().
+PROFILES = {
+    # Default MFSK settings, see settings.py for a description of all values
+    'mfsk': {
+        'MFSK': True,
+        'TONES_PER_SECOND': 48,
+        'TONE_BITS': 4,
+        'FREQ_MIN': 500,
+        'FREQ_MAX': 6000,
+        'SYNC_SWEEP_DURATION': 1,
+        'SYNC_DETECTOR': 'correlation',
+        'SYNC_CORRELATION_THRESHOLD': 0.1,
+        'SYNC_FFT_SPLIT': 60,
+        'SYNC_CALIBRATION_TIME': 0.0005,
+        'TONE_DETECTOR': 'bank',
+        'TONE_MIN_CONFIDENCE': 0.3,
+        'INPUT_READ_FRACTION': 8,
+        'TONE_CALIBRATION_OFFSET': 0,
+        'RECORD_BUFFER_SIZE': 128*1024,
+    },
+    # Twice as many tones per second, with a shorter sync sweep
+    'mfsk-fast': {
+        'MFSK': True,
+        'TONES_PER_SECOND': 96,
+        'TONE_BITS': 4,
+        'FREQ_MIN': 500,
+        'FREQ_MAX': 6000,
+        'SYNC_SWEEP_DURATION': 0.5,
+        'SYNC_DETECTOR': 'correlation',
+        'SYNC_CORRELATION_THRESHOLD': 0.15,
+        'SYNC_FFT_SPLIT': 30,
+        'SYNC_CALIBRATION_TIME': 0.0005,
+        'TONE_DETECTOR': 'bank',
+        'TONE_MIN_CONFIDENCE': 0.3,
+        'INPUT_READ_FRACTION': 8,
+        'TONE_CALIBRATION_OFFSET': 0,
+        'RECORD_BUFFER_SIZE': 128*1024,
+    },
+    # Convolutional coding with more tone bits, three quarters of the data
+    # rate of 'mfsk-fast' but decodes with much more noise
+    'mfsk-coded': {
+        'MFSK': True,
+        'TONES_PER_SECOND': 96,
+        'TONE_BITS': 6,
+        'CONVOLUTIONAL_CODING': True,
+        'FREQ_MIN': 500,
+        'FREQ_MAX': 6000,
+        'SYNC_SWEEP_DURATION': 0.5,
+        'SYNC_DETECTOR': 'correlation',
+        'SYNC_CORRELATION_THRESHOLD': 0.15,
+        'SYNC_FFT_SPLIT': 30,
+        'SYNC_CALIBRATION_TIME': 0.0005,
+        'TONE_DETECTOR': 'bank',
+        # Weak tones are still useful to the soft decision decoder
+        'TONE_MIN_CONFIDENCE': 0,
+        'INPUT_READ_FRACTION': 8,
+        'TONE_CALIBRATION_OFFSET': 0,
+        'RECORD_BUFFER_SIZE': 128*1024,
+    },
+    # Four carriers at the same time, each sending one of four tones
+    'mfsk-multi': {
+        'MFSK': True,
+        'TONES_PER_SECOND': 48,
+        'TONE_BITS': 2,
+        'CARRIERS': 4,
+        'FREQ_MIN': 500,
+        'FREQ_MAX': 6000,
+        'SYNC_SWEEP_DURATION': 1,
+        'SYNC_DETECTOR': 'correlation',
+        'SYNC_CORRELATION_THRESHOLD': 0.1,
+        'SYNC_FFT_SPLIT': 60,
+        'SYNC_CALIBRATION_TIME': 0.0005,
+        'TONE_DETECTOR': 'bank',
+        'TONE_MIN_CONFIDENCE': 0.4,
+        'INPUT_READ_FRACTION': 8,
+        'TONE_CALIBRATION_OFFSET': 0,
+        'RECORD_BUFFER_SIZE': 128*1024,
+    },
+    # Fewer, more widely spaced tones for noisy channels
+    'mfsk-robust': {
+        'MFSK': True,
+        'TONES_PER_SECOND': 24,
+        'TONE_BITS': 2,
+        'FREQ_MIN': 500,
+        'FREQ_MAX': 6000,
+        'SYNC_SWEEP_DURATION': 1,
+        'SYNC_DETECTOR': 'correlation',
+        'SYNC_CORRELATION_THRESHOLD': 0.1,
+        'SYNC_FFT_SPLIT': 60,
+        'SYNC_CALIBRATION_TIME': 0.0005,
+        'TONE_DETECTOR': 'bank',
+        'TONE_MIN_CONFIDENCE': 0.4,
+        'INPUT_READ_FRACTION': 8,
+        'TONE_CALIBRATION_OFFSET': 0,
+        'RECORD_BUFFER_SIZE': 128*1024,
+    },
+    # Default FSK settings, see settings.py for a description of all values
+    'fsk': {
+        'MFSK': False,
+        'TONES_PER_SECOND': 1200,
+        'START_MARKER': b'RPHBN',
+        'REALTIME_PROCESS_SLEEP': 1,
+        'REALTIME_PROCESS_BUFFER_DURATION': 4,
+        'REALTIME_PROCESS_MINIMUM': 5000,
+    },
+    # Half the baud rate, with mark and space frequencies to match
+    'fsk-600': {
+        'MFSK': False,
+        'TONES_PER_SECOND': 600,
+        'START_MARKER': b'RPHBN',
+        'REALTIME_PROCESS_SLEEP': 1,
+        'REALTIME_PROCESS_BUFFER_DURATION': 4,
+        'REALTIME_PROCESS_MINIMUM': 5000,
+    },
+}
+
+
+class ModemConfig:
+    """
+    All settings for a modem configuration, with the same names as in
+    settings.py, and tables derived from these settings. Tables (filter
+    coefficients, kernels, frequency lists, reference signals) are calculated
+    the first time they are needed, then reused for every following packet.
+
+    Encode and decode functions take an optional config argument. When it is
+    not given, the configuration from settings.py is used. Multiple
+    configurations can be used at the same time, by passing different config
+    objects.
+    """
+
+    def __init__(self, name: str, values: dict):
+        self.name = name
+        self.values = values
+        for key, value in values.items():
+            setattr(self, key, value)
+        self.derive()
+        self._tables = {}
+
+    @staticmethod
+    def from_settings() -> 'ModemConfig':
+        # Configuration with all settings from settings.py
+        values = {key: getattr(settings, key) for key in dir(settings) if key.isupper()}
+        return ModemConfig('settings', values)
+
+    @staticmethod
+    def from_profile(name: str, **overrides) -> 'ModemConfig':
+        # Configuration from a named profile, optionally with some settings
+        # changed. Derived settings are calculated from the changed settings.
+        values = {key: getattr(settings, key) for key in COMMON_SETTINGS}
+        values.update(PROFILES[name])
+        values.update(overrides)
+        return ModemConfig(name, values)
+
+    def derive(self):
+        # Calculate values derived from other settings. Settings that have a
+        # default value derived from other settings are only set if they are
+        # missing. Durations are converted to samples here, so every setting
+        # follows SAMPLE_RATE.
+        self.SAMPLES_PER_TONE = self.SAMPLE_RATE // self.TONES_PER_SECOND
+        assert self.SAMPLE_RATE // self.TONES_PER_SECOND == self.SAMPLE_RATE / self.TONES_PER_SECOND
+        self.PACKET_HEADER_SIZE = settings.PACKET_HEADER_SIZE
+        self.set_default('CHANNEL_SHIFT', 0)
+        self.set_default('BAND_PASS', None)
+
+        if self.GAUSSIAN:
+            self.set_default('GUASSIAN_KERNEL_SIZE', self.SAMPLES_PER_TONE // 4)
+
+        if self.MFSK:
+            self.set_default('SYNC_SWEEP_BEGIN', self.FREQ_MAX)
+            self.set_default('SYNC_SWEEP_END', self.FREQ_MIN)
+            self.SYNC_SWEEP_SAMPLES = round(self.SYNC_SWEEP_DURATION * self.SAMPLE_RATE)
+            self.SYNC_CALIBRATION_OFFSET = int(self.SYNC_CALIBRATION_TIME * self.SAMPLE_RATE)
+            self.set_default('RECORD_PROCESS_SIZE', self.RECORD_BUFFER_SIZE // 8)
+            self.set_default('CARRIERS', 1)
+            self.set_default('CONVOLUTIONAL_CODING', False)
+            self.SYNC_END_TONE = 2**self.TONE_BITS
+            self.FREQ_BASE = self.FREQ_MIN
+            self.CARRIER_WIDTH = (self.FREQ_MAX - self.FREQ_MIN) / self.CARRIERS
+            if self.CARRIERS == 1:
+                self.FREQ_SPACE = (self.FREQ_MAX - self.FREQ_MIN) / (2**self.TONE_BITS - 1)
+            else:
+                # Leave room for the end tone and a gap to the next carrier
+                self.FREQ_SPACE = self.CARRIER_WIDTH / (2**self.TONE_BITS + 1)
+            self.INPUT_READ_SIZE = self.SAMPLE_RATE // self.TONES_PER_SECOND // self.INPUT_READ_FRACTION
+            self.TONE_BANK_READ_SIZE = self.SAMPLES_PER_TONE - self.GUASSIAN_KERNEL_SIZE if self.GAUSSIAN else self.SAMPLES_PER_TONE
+        else:
+            self.REALTIME_PROCESS_BUFFER_SIZE = round(self.REALTIME_PROCESS_BUFFER_DURATION * self.SAMPLE_RATE)
+            self.FREQ_MARK = self.TONES_PER_SECOND + self.CHANNEL_SHIFT
+            self.FREQ_SPACE = self.TONES_PER_SECOND*2 + self.CHANNEL_SHIFT
+
+    def set_default(self, key: str, value):
+        if not hasattr(self, key):
+            setattr(self, key, value)
+
+    def table(self, key, calculate):
+        # Cached table, calculate() is only called the first time
+        if key not in self._tables:
+            self._tables[key] = calculate()
+        return self._tables[key]
+
+    def airtime(self, byte_count: int) -> float:
+        # Duration in seconds of a transmission of byte_count bytes (packet
+        # bytes, see packet.packed_size()), including noise before and after
+        # the transmission, as produced by encode.py
+        if self.MFSK:
+            # Sync sweep, tones and end tone
+            samples = self.SYNC_SWEEP_SAMPLES + (self.symbol_count(byte_count) + 1) * self.SAMPLES_PER_TONE
+        else:
+            samples = (len(self.START_MARKER) * 8 + byte_count * 8) * self.SAMPLES_PER_TONE
+        return (samples + 2 * self.NOISE_SAMPLES) / self.SAMPLE_RATE
+
+    def symbol_count(self, byte_count: int) -> int:
+        # Number of MFSK symbols (tones of all carriers sent at the same time)
+        # for byte_count bytes, without the end tone
+        bits = byte_count * 8
+        if self.CONVOLUTIONAL_CODING:
+            bits = 2 * (bits + convolutional.CONSTRAINT_LENGTH - 1)
+        return math.ceil(math.ceil(bits / self.TONE_BITS) / self.CARRIERS)
+
+    def __repr__(self):
+        return f'ModemConfig({self.name})'
+
+    def channel(self, index: int) -> 'ModemConfig':
+        # Configuration for one of CHANNELS channels, which are sent at the
+        # same time in different frequency ranges.
+        values = dict(self.values, CHANNELS=1)
+        if self.MFSK:
+            # Split frequency range in equal parts. Tone frequencies are spaced
+            # so the end tone and a gap to the next channel fit in each part.
+            width = (self.FREQ_MAX - self.FREQ_MIN) / self.CHANNELS
+            space = width / (2**self.TONE_BITS + 1)
+            freq_min = self.FREQ_MIN + index * width
+            freq_max = freq_min + space * (2**self.TONE_BITS - 1)
+            values.update(FREQ_MIN=freq_min, FREQ_MAX=freq_max,
+                          SYNC_SWEEP_BEGIN=freq_max, SYNC_SWEEP_END=freq_min)
+            # The fft detector would find tones of other channels
+            values.update(TONE_DETECTOR='bank')
+        else:
+            # Mark and space frequencies are shifted up, leaving a gap of two
+            # times the baud rate between channels. The receiver removes other
+            # channels using a band pass filter, then shifts the channel back
+            # down to the usual mark and space frequencies.
+            shift = self.TONES_PER_SECOND * 4 * index
+            values.update(CHANNEL_SHIFT=shift,
+                          BAND_PASS=(self.TONES_PER_SECOND/2 + shift, self.TONES_PER_SECOND*2.5 + shift))
+        return ModemConfig(f'{self.name}-ch{index}', values)
+
+    def channels(self) -> list['ModemConfig']:
+        # Configurations for all channels, or only this configuration if there
+        # is a single channel
+        if self.CHANNELS == 1:
+            return [self]
+        return [self.channel(i) for i in range(self.CHANNELS)]
+
+    # Tables shared by encoder and decoder
+
+    @cached_property
+    def gauss_kernel(self) -> np.ndarray:
+        # Convolution with cosine kernel, centered with peak at x=0
+        # Not exactly guassian, but close enough?
+        kernel_x = np.linspace(-np.pi, np.pi, self.GUASSIAN_KERNEL_SIZE)
+        kernel_y = np.cos(kernel_x) + 1  # cosine in range to [0, 2] (adjusted from [-1, 1])
+        return kernel_y / np.sum(kernel_y)  # normalize, for consistent amplitude after convolution
+
+    @cached_property
+    def sync_frequencies(self) -> np.ndarray:
+        # Sync signal, linear sweep from one frequency to another
+        return np.linspace(self.SYNC_SWEEP_END, self.SYNC_SWEEP_BEGIN, self.SYNC_SWEEP_SAMPLES)
+
+    # Encoder tables, see encode.Synthesizer
+
+    @cached_property
+    def tone_response(self) -> np.ndarray:
+        # Smoothed frequency of a single tone with frequency 1 and silence
+        # around it, for the time of the previous tone, the tone itself and
+        # the next tone (rows). The kernel is not longer than a tone, so it
+        # only spreads a tone into its neighbours.
+        size = self.SAMPLES_PER_TONE
+        assert len(self.gauss_kernel) <= size
+        box = np.zeros(3 * size)
+        box[size:2*size] = 1
+        return np.convolve(box, self.gauss_kernel, mode='same').reshape(3, size)
+
+    @cached_property
+    def tone_phase_response(self) -> np.ndarray:
+        # Phase of tone_response rows, relative to the start of every row
+        return np.cumsum(2 * np.pi * self.tone_response / self.SAMPLE_RATE, axis=1)
+
+    @cached_property
+    def sync_phase(self) -> np.ndarray:
+        # Phase of the smoothed sync sweep, followed by the time of the first
+        # tone, into which the end of the sweep is spread
+        sweep = np.concatenate((self.sync_frequencies, np.zeros(self.SAMPLES_PER_TONE)))
+        return np.cumsum(2 * np.pi * np.convolve(sweep, self.gauss_kernel, mode='same') / self.SAMPLE_RATE)
+
+    @cached_property
+    def sync_samples(self) -> np.ndarray:
+        # Samples of the sync sweep, except for the part during the last tone
+        # time, which also depends on the first tone. Only the first carrier
+        # sends the sync sweep, it is faded in like the smoothed volume of
+        # multiple carriers.
+        size = self.SYNC_SWEEP_SAMPLES - self.SAMPLES_PER_TONE
+        sine = np.sin(self.sync_phase[:size])
+        if self.CARRIERS > 1:
+            sine[:self.SAMPLES_PER_TONE] *= 1 - self.tone_response[2]
+        return (sine * self.OUTPUT_MAX).astype('i2')
+
+    # MFSK decoder tables
+
+    @cached_property
+    def carrier_bases(self) -> np.ndarray:
+        # Frequency of tone 0 for every carrier
+        return self.FREQ_BASE + self.CARRIER_WIDTH * np.arange(self.CARRIERS)
+
+    @cached_property
+    def tone_values(self) -> np.ndarray:
+        # Value (TONE_BITS bits) sent by every tone. With Gray encoding, the
+        # values of adjacent tones differ in a single bit, so the most likely
+        # error, detecting a neighbouring tone, is a single bit error.
+        tones = np.arange(2**self.TONE_BITS)
+        if self.USE_GRAY_ENCODING:
+            return np.array([gray.to_gray(int(tone)) for tone in tones])
+        return tones
+
+    @cached_property
+    def value_tones(self) -> np.ndarray:
+        # Tone that sends every value, inverse of tone_values
+        return np.argsort(self.tone_values)
+
+    @cached_property
+    def tone_bit_table(self) -> np.ndarray:
+        # Bits sent by every tone, most significant bit first
+        values = self.tone_values[:, np.newaxis]
+        return (values >> np.arange(self.TONE_BITS - 1, -1, -1)) & 1
+
+    @cached_property
+    def candidate_frequencies(self) -> np.ndarray:
+        # All frequencies that may be received: one for every tone, plus end
+        # tone. Frequencies of all carriers are in a single array, carrier 0
+        # first.
+        tone_offsets = self.FREQ_SPACE * np.arange(self.SYNC_END_TONE + 1)
+        return (self.carrier_bases[:, np.newaxis] + tone_offsets).ravel()
+
+    def fft_frequencies(self, size: int) -> np.ndarray:
+        # Frequency axis for the FFT of a window with the given number of samples.
+        return self.table(('fft_frequencies', size),
+                          lambda: np.linspace(0, self.SAMPLE_RATE / 2, round(size/2)))
+
+    def tone_bank(self, size: int) -> np.ndarray:
+        # Matrix with a windowed complex exponential for every candidate
+        # frequency in its columns. Multiplying a window of samples with this
+        # matrix results in the DFT of the window at only these frequencies.
+        def calculate():
+            n = np.arange(size)[:, np.newaxis]
+            exponentials = np.exp(-2j * np.pi * self.candidate_frequencies * n / self.SAMPLE_RATE)
+            return exponentials * np.hanning(size)[:, np.newaxis]
+        return self.table(('tone_bank', size), calculate)
+
+    def sync_reference_fft(self, size: int) -> np.ndarray:
+        # Complex conjugate FFT of the sync sweep as an analytic signal (complex
+        # exponential with the same phase as the transmitted sweep), zero padded
+        # to the given size.
+        def calculate():
+            phase = np.cumsum(2 * np.pi * self.sync_frequencies) / self.SAMPLE_RATE
+            return np.conj(np.fft.fft(np.exp(1j * phase), size))
+        return self.table(('sync_reference_fft', size), calculate)
+
+    @cached_property
+    def sync_block_size(self) -> int:
+        # Block size for overlap-save correlation with the sync sweep, at
+        # least a quarter sweep longer than the sweep itself
+        return 2**math.ceil(math.log2(self.SYNC_SWEEP_SAMPLES + self.SYNC_SWEEP_SAMPLES // 4))
+
+    # FSK decoder tables
+
+    @cached_property
+    def low_pass_coeffs(self) -> np.ndarray:
+        # Low pass filter for comb filter output. Cutoff frequency of 760 Hz
+        # at 1200 baud, scaled with the baud rate.
+        cutoff = 760.0 * self.TONES_PER_SECOND / 1200
+        return np.array(firwin(101, [cutoff/(self.SAMPLE_RATE/2)],
+                               width=None,
+                               pass_zero=True,
+                               scale=True,
+                               window='hann') * self.OUTPUT_MAX,
+                        dtype='i2')
+
+    @cached_property
+    def band_pass_sos(self) -> np.ndarray:
+        # Band pass filter for input audio, only used with multiple channels
+        return butter(6, self.BAND_PASS, btype='bandpass', fs=self.SAMPLE_RATE, output='sos')
+
+    @cached_property
+    def shift_low_pass_sos(self) -> np.ndarray:
+        # Low pass filter after the band pass, removes the mirror image at the
+        # sum of the channel frequency and the shift, and other channels above
+        return butter(6, self.TONES_PER_SECOND*2.5, btype='lowpass', fs=self.SAMPLE_RATE, output='sos')
+
+    @cached_property
+    def start_marker_bit_count(self) -> int:
+        return len(self.START_MARKER) * 8
+
+    @cached_property
+    def start_marker_int(self) -> int:
+        return int.from_bytes(self.START_MARKER, 'big')
+
+    @cached_property
+    def start_marker_mask(self) -> int:
+        return (1 << self.start_marker_bit_count) - 1
+
+    def precompute(self):
+        # Calculate tables now, instead of while processing the first packet
+        if self.GAUSSIAN:
+            self.gauss_kernel
+            self.tone_phase_response
+        if self.MFSK:
+            self.sync_frequencies
+            if self.GAUSSIAN:
+                self.sync_samples
+            self.candidate_frequencies
+            self.tone_bank(self.TONE_BANK_READ_SIZE)
+            self.fft_frequencies(self.INPUT_READ_SIZE * 2)
+            self.sync_reference_fft(self.sync_block_size)
+            self.tone_values
+            self.value_tones
+            if self.CONVOLUTIONAL_CODING:
+                self.tone_bit_table
+        else:
+            self.low_pass_coeffs
+            if self.BAND_PASS is not None:
+                self.band_pass_sos
+                self.shift_low_pass_sos
+
+
+def load(profile: Optional[str] = None) -> ModemConfig:
+    # Configuration for the given profile name, or the configuration from
+    # settings.py if no profile is given
+    if profile is None:
+        return ModemConfig.from_settings()
+    return ModemConfig.from_profile(profile)
+
+
+DEFAULT = load(settings.PROFILE)
+
+
+def get(config: Optional[ModemConfig]) -> ModemConfig:
+    # Use default configuration if no configuration is given
+    return DEFAULT if config is None else config
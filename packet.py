@@ -1,8 +1,27 @@
+import logging
+import math
 import struct
+from typing import Optional
 
+import numpy as np
+
+import compression
+from compression import DecompressError
 import crc16
+import metrics
+import reed_solomon
+from reed_solomon import ReedSolomonError
 import settings
-import smallgzip
+
+
+# Flag in the size field of the packet header, set for packets containing
+# multiple messages (see pack_many())
+AGGREGATE_FLAG = 0x8000
+
+# Size and checksum of every message in a packet with multiple messages
+SUBPACKET_HEADER = struct.Struct('>HH')
+
+log = logging.getLogger(__name__)
 
 
 class BasePacketDecodeError(Exception):
@@ -34,18 +53,24 @@ class PacketCorruptError(BasePacketDecodeError):
     pass
 
 
+class PacketUncorrectableError(PacketCorruptError):
+    """
+    Packet contains more errors than forward error correction can correct
+    """
+    pass
+
+
 class PacketChecksumError(PacketCorruptError):
     def __init__(self, checksum_header: int, checksum_message: int, message: bytes):
         super().__init__(f'Expected checksum {checksum_header} but message has checksum {checksum_message}. Message: {message}')
 
 
 def pack(data: bytes) -> bytes:
-    # Compress data using modified gzip, if enabled
+    # Compress data using deflate with a preset dictionary, if enabled
     if settings.DO_COMPRESS:
-        print('original size:', len(data))
         original_size = len(data)
-        data = smallgzip.compress(data)
-        print(f'compressed from {original_size} to {len(data)}')
+        data = compression.compress(data)
+        log.debug('compressed from %d to %d bytes', original_size, len(data))
 
     # Ensure message is not larger than maximum size
     if len(data) > settings.MAX_PACKET_SIZE:
@@ -57,14 +82,40 @@ def pack(data: bytes) -> bytes:
 
     assert len(header_bytes) == settings.PACKET_HEADER_SIZE
 
+    if settings.FEC_PARITY > 0:
+        return fec_encode(header_bytes + data)
+
     return header_bytes + data
 
 
+def header_size() -> int:
+    # Number of bytes to receive before get_size() can be called
+    return settings.FEC_HEADER_SIZE if settings.FEC_PARITY > 0 else settings.PACKET_HEADER_SIZE
+
+
+def packed_size(size: int) -> int:
+    # Number of bytes returned by pack() for a message of the given size,
+    # when compression does not make it smaller
+    size += settings.PACKET_HEADER_SIZE
+    if settings.DO_COMPRESS:
+        size += 1
+    if settings.FEC_PARITY > 0:
+        block_count = math.ceil(size / settings.FEC_BLOCK_SIZE)
+        return settings.FEC_HEADER_SIZE + block_count * (math.ceil(size / block_count) + settings.FEC_PARITY)
+    return size
+
+
 def get_size(data: bytes) -> int:
-    if len(data) < settings.PACKET_HEADER_SIZE:
+    # Number of bytes following the header
+    if len(data) < header_size():
         raise PacketIncompleteError('Data smaller than header size')
 
-    size = struct.unpack('>H', data[:2])
+    if settings.FEC_PARITY > 0:
+        parity, block_count, size = fec_decode_header(data)
+        return block_count * (math.ceil(size / block_count) + parity)
+
+    size, = struct.unpack('>H', data[:2])
+    size &= ~AGGREGATE_FLAG
 
     if size > settings.MAX_PACKET_SIZE:
         raise PacketCorruptError('Size greater than maximum packet size')
@@ -72,32 +123,259 @@ def get_size(data: bytes) -> int:
     return size
 
 
-def unpack(data: bytes) -> bytes:
-    assert len(data) > settings.PACKET_HEADER_SIZE
+def read_packet(data: bytes) -> tuple[bool, int, bytes]:
+    # Correct errors, if enabled, and split packet in header values and
+    # message bytes. Returns whether the packet contains multiple messages
+    # (see pack_many()), the checksum and the message bytes.
+    if settings.FEC_PARITY > 0:
+        data = fec_decode(data)
+
+    assert len(data) >= settings.PACKET_HEADER_SIZE
     header_bytes = data[:settings.PACKET_HEADER_SIZE]
     message_bytes = data[settings.PACKET_HEADER_SIZE:]
 
     size, checksum = struct.unpack('>HH', header_bytes)
+    aggregate = bool(size & AGGREGATE_FLAG)
+    size &= ~AGGREGATE_FLAG
 
     # Size should never be larger than maximum, this indicates the size
     # got corrupted during transmission
     if size > settings.MAX_PACKET_SIZE:
         raise PacketCorruptError('Packet too large')
+    check_size(aggregate, size)
 
     # Make sure we have received enough bytes to contain the entire message
     if size > len(message_bytes):
         raise PacketIncompleteError('Packet header claims size ' + str(size) + ' but we have only received ' + str(len(message_bytes) - 4))
 
     # Truncate message to the size indicated in packet header
-    message_bytes = message_bytes[:size]
+    return aggregate, checksum, message_bytes[:size]
 
-    # Calculate message checksum, verify that it matches checksum in header
-    message_checksum = crc16.crc16(message_bytes)
+
+def check_size(aggregate: bool, size: int):
+    # Raises PacketCorruptError for sizes pack() and pack_many() never create
+    if aggregate and size < 2 * SUBPACKET_HEADER.size:
+        raise PacketCorruptError('Packet with multiple messages too small')
+    if settings.DO_COMPRESS and not aggregate and size == 0:
+        raise PacketCorruptError('Compressed message can not be empty')
+
+
+def verify(checksum: int, message_bytes: bytes, message_checksum: Optional[int] = None) -> bytes:
+    # Calculate message checksum, unless it was already calculated, verify
+    # that it matches checksum in header
+    if message_checksum is None:
+        message_checksum = crc16.crc16(message_bytes)
     if checksum != message_checksum:
         raise PacketChecksumError(checksum, message_checksum, message_bytes)
 
     # Decompress if compression was enabled
     if settings.DO_COMPRESS:
-        message_bytes = smallgzip.decompress(message_bytes)
+        try:
+            message_bytes = compression.decompress(message_bytes)
+        except DecompressError as ex:
+            raise PacketCorruptError('Decompression failed: ' + str(ex))
 
     return message_bytes
+
+
+def unpack(data: bytes) -> bytes:
+    aggregate, checksum, message_bytes = read_packet(data)
+    if aggregate:
+        raise PacketCorruptError('Packet contains multiple messages, use unpack_many()')
+    return verify(checksum, message_bytes)
+
+
+def pack_many(messages: list[bytes]) -> bytes:
+    # Multiple messages in a single packet, so they are sent in a single
+    # transmission. Every message is preceded by its size and checksum, so
+    # a corrupt message does not affect the other messages. A single message
+    # is packed as usual.
+    if len(messages) == 1:
+        return pack(messages[0])
+
+    body = bytearray()
+    for data in messages:
+        if settings.DO_COMPRESS:
+            data = compression.compress(data)
+        body += SUBPACKET_HEADER.pack(len(data), crc16.crc16(data)) + data
+
+    if len(body) > settings.MAX_PACKET_SIZE:
+        raise ValueError('messages too long')
+
+    header_bytes = struct.pack('>HH', len(body) | AGGREGATE_FLAG, crc16.crc16(body))
+
+    if settings.FEC_PARITY > 0:
+        return fec_encode(header_bytes + body)
+
+    return header_bytes + bytes(body)
+
+
+def unpack_many(data: bytes) -> list[bytes]:
+    # All messages in a packet created by pack() or pack_many()
+    return split_messages(*read_packet(data))
+
+
+def split_messages(aggregate: bool, checksum: int, body: bytes, body_checksum: Optional[int] = None) -> list[bytes]:
+    # Messages in a packet body (see read_packet()). When the packet checksum
+    # does not match, messages with a valid checksum of their own are still
+    # returned. body_checksum is the checksum of the body, if it was already
+    # calculated.
+    if body_checksum is None:
+        body_checksum = crc16.crc16(body)
+    if not aggregate:
+        return [verify(checksum, body, body_checksum)]
+
+    intact = body_checksum == checksum
+    messages = []
+    offset = 0
+    while offset + SUBPACKET_HEADER.size <= len(body):
+        size, message_checksum = SUBPACKET_HEADER.unpack_from(body, offset)
+        offset += SUBPACKET_HEADER.size
+        if offset + size > len(body):
+            # Size is corrupt, the position of following messages is unknown
+            break
+        try:
+            messages.append(verify(message_checksum, body[offset:offset+size]))
+        except PacketCorruptError as ex:
+            # A message with a valid checksum can still fail to decompress,
+            # the other messages are not affected
+            log.info('corrupt message in packet: %s', ex)
+            metrics.count('messages_corrupt')
+            if isinstance(ex, PacketChecksumError):
+                metrics.count('message_crc_failures')
+        offset += size
+
+    if not intact and not messages:
+        raise PacketChecksumError(checksum, body_checksum, body)
+    return messages
+
+
+def count_error(ex: BasePacketDecodeError):
+    # Count a packet that a receiver could not decode in the metrics
+    metrics.count('packets_corrupt')
+    if isinstance(ex, PacketChecksumError):
+        metrics.count('crc_failures')
+
+
+class PacketParser:
+    """
+    Parses a packet from bytes fed as they are received. The header is
+    checked as soon as it is complete, so a corrupt header aborts reception
+    right away instead of waiting for bytes that will never arrive. Without
+    forward error correction, the checksum is updated with every byte, so
+    the message bytes are not read again when the packet is complete.
+    """
+    received: bytearray
+    size: Optional[int]
+    aggregate: bool
+    checksum: int
+    body_checksum: int
+
+    def __init__(self):
+        self.received = bytearray()
+        self.size = None
+        self.aggregate = False
+        self.checksum = 0
+        self.body_checksum = crc16.INITIAL
+
+    @property
+    def total_size(self) -> Optional[int]:
+        # Number of bytes of the entire packet, once the header is complete
+        if self.size is None:
+            return None
+        return header_size() + self.size
+
+    def feed(self, data: bytes) -> Optional[list[bytes]]:
+        # Add received bytes, bytes after the end of the packet are ignored.
+        # Returns the messages in the packet (see unpack_many()) when it is
+        # complete, or None when more bytes are needed. Raises
+        # PacketCorruptError when the packet is corrupt, the parser should
+        # not be fed more bytes after that.
+        start = len(self.received)
+        self.received += data
+
+        if self.size is None:
+            if len(self.received) < header_size():
+                return None
+            self.parse_header()
+        end = self.total_size
+
+        if settings.FEC_PARITY == 0:
+            # Checksum of message bytes received in this call
+            first = max(start, settings.PACKET_HEADER_SIZE)
+            last = min(len(self.received), end)
+            if first < last:
+                self.body_checksum = crc16.crc16(memoryview(self.received)[first:last], self.body_checksum)
+
+        if len(self.received) < end:
+            return None
+
+        if settings.FEC_PARITY > 0:
+            return unpack_many(bytes(self.received[:end]))
+        return split_messages(self.aggregate, self.checksum,
+                              bytes(self.received[settings.PACKET_HEADER_SIZE:end]), self.body_checksum)
+
+    def parse_header(self):
+        # Raises PacketCorruptError for headers that can not be valid
+        self.size = get_size(self.received)
+        if settings.FEC_PARITY > 0:
+            # Size and checksum are only known after error correction
+            return
+        size, self.checksum = struct.unpack_from('>HH', self.received)
+        self.aggregate = bool(size & AGGREGATE_FLAG)
+        check_size(self.aggregate, self.size)
+
+
+def fec_encode(data: bytes) -> bytes:
+    # Split packet (header and message) in blocks of at most FEC_BLOCK_SIZE
+    # bytes, with byte i in block i % block_count, and add Reed-Solomon
+    # parity bytes to every block. Blocks are then interleaved: the first
+    # byte of every block, then the second byte of every block, etc.
+    parity = settings.FEC_PARITY
+    block_count = math.ceil(len(data) / settings.FEC_BLOCK_SIZE)
+    block_size = math.ceil(len(data) / block_count)
+    padded = np.zeros(block_count * block_size, dtype='u1')
+    padded[:len(data)] = np.frombuffer(data, dtype='u1')
+    blocks = padded.reshape(block_size, block_count).T
+
+    codewords = np.array([np.frombuffer(reed_solomon.encode(block.tobytes(), parity), dtype='u1')
+                          for block in blocks])
+
+    header = struct.pack('>BBH', parity, block_count, len(data))
+    header = reed_solomon.encode(header, settings.FEC_HEADER_PARITY)
+    assert len(header) == settings.FEC_HEADER_SIZE
+
+    return header + codewords.T.tobytes()
+
+
+def fec_decode_header(data: bytes) -> tuple[int, int, int]:
+    # Number of parity bytes per block, number of blocks and packet size
+    try:
+        header = reed_solomon.decode(data[:settings.FEC_HEADER_SIZE], settings.FEC_HEADER_PARITY)
+    except ReedSolomonError as ex:
+        raise PacketUncorrectableError('FEC header: ' + str(ex))
+    parity, block_count, size = struct.unpack('>BBH', header)
+    if parity == 0 or block_count == 0 or size < settings.PACKET_HEADER_SIZE \
+            or size > settings.MAX_PACKET_SIZE + settings.PACKET_HEADER_SIZE \
+            or math.ceil(size / block_count) + parity > 255:
+        raise PacketCorruptError('Invalid FEC header')
+    return parity, block_count, size
+
+
+def fec_decode(data: bytes) -> bytes:
+    # Reverse fec_encode(), correcting errors in every block
+    parity, block_count, size = fec_decode_header(data)
+    block_size = math.ceil(size / block_count)
+    body_size = block_count * (block_size + parity)
+    body = data[settings.FEC_HEADER_SIZE:settings.FEC_HEADER_SIZE + body_size]
+    if len(body) < body_size:
+        raise PacketIncompleteError(f'FEC header claims size {body_size} but we have only received {len(body)}')
+
+    codewords = np.frombuffer(body, dtype='u1').reshape(block_size + parity, block_count).T
+    try:
+        blocks = np.array([np.frombuffer(reed_solomon.decode(codeword.tobytes(), parity), dtype='u1')
+                           for codeword in codewords])
+    except ReedSolomonError as ex:
+        raise PacketUncorrectableError(str(ex))
+
+    return blocks.T.tobytes()[:size]
@@ -0,0 +1,222 @@
+# Reed-Solomon codes over GF(2^8), adapted from
+# https://en.wikiversity.org/wiki/Reed%E2%80%93Solomon_codes_for_coders
+
+from functools import lru_cache
+
+import numpy as np
+
+
+class ReedSolomonError(Exception):
+    """
+    Message contains more errors than can be corrected
+    """
+    pass
+
+
+# Exponent and logarithm tables for multiplication in GF(2^8), with
+# primitive polynomial x^8 + x^4 + x^3 + x^2 + 1. The exponent table is
+# doubled, so the sum of two logarithms never needs to be reduced.
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+GF_EXP_ARRAY = np.array(GF_EXP, dtype='u1')
+GF_LOG_ARRAY = np.array(GF_LOG, dtype=int)
+
+
+def gf_mul(x: int, y: int) -> int:
+    if x == 0 or y == 0:
+        return 0
+    return GF_EXP[GF_LOG[x] + GF_LOG[y]]
+
+
+def gf_div(x: int, y: int) -> int:
+    if y == 0:
+        raise ZeroDivisionError()
+    if x == 0:
+        return 0
+    return GF_EXP[(GF_LOG[x] + 255 - GF_LOG[y]) % 255]
+
+
+def gf_pow(x: int, power: int) -> int:
+    return GF_EXP[(GF_LOG[x] * power) % 255]
+
+
+def gf_inverse(x: int) -> int:
+    return GF_EXP[255 - GF_LOG[x]]
+
+
+# Polynomials are lists of coefficients, highest degree first
+
+def poly_scale(p: list[int], x: int) -> list[int]:
+    return [gf_mul(c, x) for c in p]
+
+
+def poly_add(p: list[int], q: list[int]) -> list[int]:
+    r = [0] * max(len(p), len(q))
+    for i in range(len(p)):
+        r[i + len(r) - len(p)] = p[i]
+    for i in range(len(q)):
+        r[i + len(r) - len(q)] ^= q[i]
+    return r
+
+
+def poly_mul(p: list[int], q: list[int]) -> list[int]:
+    r = [0] * (len(p) + len(q) - 1)
+    for j in range(len(q)):
+        for i in range(len(p)):
+            r[i + j] ^= gf_mul(p[i], q[j])
+    return r
+
+
+def poly_eval(p: list[int], x: int) -> int:
+    # Horner's method
+    y = p[0]
+    for c in p[1:]:
+        y = gf_mul(y, x) ^ c
+    return y
+
+
+def poly_div(dividend: list[int], divisor: list[int]) -> tuple[list[int], list[int]]:
+    # Synthetic division, returns quotient and remainder
+    out = list(dividend)
+    for i in range(len(dividend) - (len(divisor) - 1)):
+        coef = out[i]
+        if coef != 0:
+            for j in range(1, len(divisor)):
+                if divisor[j] != 0:
+                    out[i + j] ^= gf_mul(divisor[j], coef)
+    separator = -(len(divisor) - 1)
+    return out[:separator], out[separator:]
+
+
+@lru_cache(maxsize=None)
+def generator(parity: int) -> list[int]:
+    # Generator polynomial, only calculated once for every number of parity bytes
+    g = [1]
+    for i in range(parity):
+        g = poly_mul(g, [1, gf_pow(2, i)])
+    return g
+
+
+def encode(data: bytes, parity: int) -> bytes:
+    # Append parity bytes to data. At most 255 bytes (data and parity) fit
+    # in a single block.
+    assert len(data) + parity <= 255
+    gen = generator(parity)
+    out = list(data) + [0] * parity
+    for i in range(len(data)):
+        coef = out[i]
+        if coef != 0:
+            log_coef = GF_LOG[coef]
+            for j in range(1, len(gen)):
+                out[i + j] ^= GF_EXP[log_coef + GF_LOG[gen[j]]]
+    return bytes(data) + bytes(out[len(data):])
+
+
+def syndromes(message: bytes, parity: int) -> list[int]:
+    # Message evaluated at every root of the generator polynomial, all zero
+    # if there are no errors. Evaluated for all roots at once: the sum of
+    # message[i] * 2^(j*power[i]) using logarithms. A zero is prepended, as
+    # expected by the functions below.
+    values = np.frombuffer(message, dtype='u1')
+    nonzero = np.flatnonzero(values)
+    powers = len(values) - 1 - nonzero
+    logs = GF_LOG_ARRAY[values[nonzero]]
+    exponents = (logs + np.arange(parity)[:, np.newaxis] * powers) % 255
+    return [0] + np.bitwise_xor.reduce(GF_EXP_ARRAY[exponents], axis=1).tolist()
+
+
+def find_error_locator(synd: list[int], parity: int) -> list[int]:
+    # Berlekamp-Massey algorithm
+    err_loc = [1]
+    old_loc = [1]
+    for i in range(parity):
+        k = i + 1
+        delta = synd[k]
+        for j in range(1, len(err_loc)):
+            delta ^= gf_mul(err_loc[-(j + 1)], synd[k - j])
+        old_loc = old_loc + [0]
+        if delta != 0:
+            if len(old_loc) > len(err_loc):
+                new_loc = poly_scale(old_loc, delta)
+                old_loc = poly_scale(err_loc, gf_inverse(delta))
+                err_loc = new_loc
+            err_loc = poly_add(err_loc, poly_scale(old_loc, delta))
+
+    while len(err_loc) > 0 and err_loc[0] == 0:
+        del err_loc[0]
+    if (len(err_loc) - 1) * 2 > parity:
+        raise ReedSolomonError('Too many errors to correct')
+    return err_loc
+
+
+def find_errors(err_loc: list[int], length: int) -> list[int]:
+    # Chien search, positions where error locator polynomial is zero
+    positions = []
+    for i in range(length):
+        if poly_eval(err_loc, gf_pow(2, i)) == 0:
+            positions.append(length - 1 - i)
+    if len(positions) != len(err_loc) - 1:
+        raise ReedSolomonError('Could not locate errors')
+    return positions
+
+
+def correct_errors(message: list[int], synd: list[int], positions: list[int]) -> list[int]:
+    # Forney algorithm, calculate error values at known positions
+    coef_pos = [len(message) - 1 - p for p in positions]
+    err_loc = [1]
+    for i in coef_pos:
+        err_loc = poly_mul(err_loc, poly_add([1], [gf_pow(2, i), 0]))
+    _, err_eval = poly_div(poly_mul(synd[::-1], err_loc), [1] + [0] * len(err_loc))
+    err_eval = err_eval[::-1]
+
+    x_list = [gf_pow(2, -(255 - p)) for p in coef_pos]
+    errors = [0] * len(message)
+    for i, x in enumerate(x_list):
+        x_inv = gf_inverse(x)
+        err_loc_prime = 1
+        for j, other in enumerate(x_list):
+            if j != i:
+                err_loc_prime = gf_mul(err_loc_prime, 1 ^ gf_mul(x_inv, other))
+        if err_loc_prime == 0:
+            raise ReedSolomonError('Could not find error magnitude')
+        y = gf_mul(x, poly_eval(err_eval[::-1], x_inv))
+        errors[positions[i]] = gf_div(y, err_loc_prime)
+    return poly_add(message, errors)
+
+
+def decode(message: bytes, parity: int) -> bytes:
+    # Correct errors in message (data and parity bytes), returns data bytes
+    synd = syndromes(message, parity)
+    if max(synd) == 0:
+        return bytes(message[:-parity])
+
+    err_loc = find_error_locator(synd, parity)
+    positions = find_errors(err_loc[::-1], len(message))
+    corrected = correct_errors(list(message), synd, positions)
+
+    if max(syndromes(bytes(corrected), parity)) != 0:
+        raise ReedSolomonError('Could not correct message')
+    return bytes(corrected[:-parity])
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng()
+    for parity in [2, 4, 16, 32]:
+        for length in [1, 10, 200, 255 - parity]:
+            data = rng.integers(0, 256, length, dtype='u1').tobytes()
+            encoded = bytearray(encode(data, parity))
+            assert decode(bytes(encoded), parity) == data
+            for i in rng.choice(len(encoded), parity // 2, replace=False):
+                encoded[i] ^= rng.integers(1, 256)
+            assert decode(bytes(encoded), parity) == data
+            print('parity', parity, 'length', length, 'ok')
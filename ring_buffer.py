@@ -0,0 +1,65 @@
+import numpy as np
+
+
+class RingBufferOverrunError(Exception):
+    """
+    Requested samples are no longer in the ring buffer, they have already
+    been overwritten by newer samples. The reader did not keep up with the
+    writer.
+    """
+    pass
+
+
+class RingBuffer:
+    """
+    Fixed size sample buffer, written by an audio callback and read by a
+    processing thread. Every sample is stored twice: at its index and at its
+    index plus the buffer size. This way, any range of up to `size` samples is
+    available as a contiguous view, without copying.
+
+    Positions are counted from the first sample ever written and only
+    increase. The write position is updated after samples are written, so a
+    reader never sees a position for samples that are not in the buffer yet.
+    No lock is needed for a single writer and single reader.
+    """
+    size: int
+    data: np.ndarray
+    pos: int
+
+    def __init__(self, size: int, dtype='i2'):
+        self.size = size
+        self.data = np.zeros(size * 2, dtype=dtype)
+        self.pos = 0
+
+    def write(self, samples: np.ndarray) -> None:
+        count = len(samples)
+        # Samples older than the buffer size would be overwritten immediately
+        skip = max(0, count - self.size)
+        samples = samples[skip:]
+
+        start = (self.pos + skip) % self.size
+        end = start + len(samples)
+        self.data[start:end] = samples
+        # Write mirror copy
+        if end <= self.size:
+            self.data[start+self.size:end+self.size] = samples
+        else:
+            split = self.size - start
+            self.data[start+self.size:] = samples[:split]
+            self.data[:end-self.size] = samples[split:]
+
+        self.pos += count
+
+    def available(self, start: int) -> bool:
+        # True if the sample at the given position has not been overwritten
+        return start >= self.pos - self.size
+
+    def read(self, start: int, count: int) -> np.ndarray:
+        # View of `count` samples, starting at the given position. The view
+        # is only valid until the writer reaches start + size, copy it if it
+        # is needed for longer.
+        if not self.available(start) or count > self.size:
+            raise RingBufferOverrunError(f'Samples {start}-{start+count} not available, buffer is at {self.pos}')
+        assert start + count <= self.pos
+        begin = start % self.size
+        return self.data[begin:begin+count]
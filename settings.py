@@ -7,6 +7,11 @@ TEST_WAV = 'test.wav'
 # Sensible values are 48000 and 44100.
 SAMPLE_RATE = 48_000
 
+# Name of a modem profile (see PROFILES in modem.py) to use instead of the
+# modem settings in this file, for example 'mfsk-fast'. None uses the settings
+# in this file.
+PROFILE = None
+
 # Set to True to use MFSK, which transfers multiple bits per tone and uses a
 # Fourier transform to decode incoming data. Set to False to use FSK, which
 # transfers a single bit per tone and uses filters (band pass, comb, low pass)
@@ -18,8 +23,10 @@ if MFSK:
     # Run valid_speeds.py for list of valid speeds.
     TONES_PER_SECOND = 48
 
-    # Number of bits to transfer per tone. Valid values are 1, 2, 4, 8 for
-    # 2, 4, 16, 256 frequencies respectively.
+    # Number of bits to transfer per tone, 2**TONE_BITS frequencies are used.
+    # Any number of bits is valid, for example 3 for 8 frequencies or 5 for
+    # 32 frequencies, so the number of frequencies can be chosen to fit the
+    # available bandwidth. Bytes do not have to align with tones.
     TONE_BITS = 4
     # Minimum frequency and maximum frequency to use for data transfer.
     # A greater frequency range will produce better results, especially when
@@ -27,24 +34,59 @@ if MFSK:
     FREQ_MIN = 500
     FREQ_MAX = 6000
 
+    # Number of tones sent at the same time. The frequency range is split in
+    # equal parts, one for every carrier, and every carrier sends TONE_BITS
+    # bits per tone. More carriers transfer more bits per tone, but tones
+    # are closer together and each carrier is sent at a lower volume.
+    CARRIERS = 1
+
+    # Encode data with a convolutional code (rate 1/2, constraint length 7)
+    # before converting it to tones. This halves the data rate, but the
+    # receiver uses the energy of every tone frequency (soft decisions)
+    # instead of only the strongest tone, so it can correct many wrong tones.
+    # The extra margin can be spent on more tone bits or tones per second.
+    CONVOLUTIONAL_CODING = False
+
     # A sync signal is used to measure the start time of the first sample in
     # an incoming signal. A sweep is used, from one frequency
     # (SYNC_SWEEP_BEGIN) to another (SYNC_SWEEP_END)
     SYNC_SWEEP_BEGIN = FREQ_MAX
     SYNC_SWEEP_END = FREQ_MIN
 
-    # Number of samples, how long the sweep should be.
-    SYNC_SWEEP_SAMPLES = SAMPLE_RATE
+    # Number of seconds, how long the sweep should be. The 'correlation'
+    # sync detector also works well with a shorter sweep.
+    SYNC_SWEEP_DURATION = 1
+
+    # Method used to find the sync sweep. 'correlation' correlates incoming
+    # audio with the known sweep signal (matched filter), which finds the
+    # exact sample where the sweep starts. 'regression' fits a line through
+    # the primary frequencies of short windows.
+    SYNC_DETECTOR = 'correlation'
+    # Minimum correlation quality (between 0 and 1) of the 'correlation'
+    # sync detector. A clean sweep has a quality close to 1, noise and data
+    # tones stay well below 0.1 for a sweep of one second. A shorter sweep
+    # needs a higher threshold.
+    SYNC_CORRELATION_THRESHOLD = 0.1
 
     # In how many windows to split incoming sweep to calculate
-    # frequencies. Setting this too low or too high decreases accuracy.
+    # frequencies, for the 'regression' sync detector. Setting this too low
+    # or too high decreases accuracy.
     SYNC_FFT_SPLIT = 60
 
-    # Time offset for first tone (in number of samples)
-    SYNC_CALIBRATION_OFFSET = int(0.0005*SAMPLE_RATE)
+    # Time offset for first tone (in seconds), for the 'regression' sync
+    # detector. The 'correlation' sync detector needs no calibration.
+    SYNC_CALIBRATION_TIME = 0.0005
 
-    # Tone used to denote end of transmission
-    SYNC_END_TONE = 2**TONE_BITS
+    # Method used to detect tones. 'fft' finds the strongest frequency in the
+    # entire spectrum and rounds it to the nearest tone. 'bank' only measures
+    # the energy at frequencies that can actually be sent, over all samples of
+    # a tone that are not part of the transition to adjacent tones.
+    TONE_DETECTOR = 'bank'
+    # Minimum fraction of energy that should be in the strongest tone. The
+    # realtime receiver stops receiving when a tone is detected with a lower
+    # confidence, this usually means the transmission ended or got lost in
+    # noise. Set to 0 to accept any tone.
+    TONE_MIN_CONFIDENCE = 0.3
 
     # Fraction of tone to read for FFT. e.g. 4 means 1/4th of the tone (left
     # and right from the midpoint) is considered (so half in total). A smaller
@@ -59,10 +101,11 @@ if MFSK:
     # to fit the entire sync sweep tone, but it does not have to be large
     # enough to fit an entire transmission.
     RECORD_BUFFER_SIZE = 128*1024
-    # How often to process the buffer. Should always be smaller than
-    # RECORD_BUFFER_SIZE, or data is missed. Processing is resource-intensive and
-    # should not be done more frequently than necessary.
-    RECORD_PROCESS_SIZE = RECORD_BUFFER_SIZE // 2
+    # How often to process the buffer. Should be much smaller than
+    # RECORD_BUFFER_SIZE, or data is missed. Processing only looks at samples
+    # that arrived since the previous time, so processing more often does not
+    # use more resources.
+    RECORD_PROCESS_SIZE = RECORD_BUFFER_SIZE // 8
 else:
     # Number of tones per second, must be an integer divisor of sample rate.
     # Run valid_speeds.py for list of valid speeds.
@@ -77,24 +120,19 @@ else:
 
     # Number of seconds to wait between processing buffer (float)
     REALTIME_PROCESS_SLEEP = 1
-    # Buffer size, must fit entire transmission. Run stats.py to calculate
-    # maximum transmisison size
-    REALTIME_PROCESS_BUFFER_SIZE = 1*1024*1024
+    # Buffer size (in seconds), must fit all samples that arrive between
+    # processing runs. Received audio is demodulated as it arrives, so the
+    # buffer does not need to fit an entire transmission.
+    REALTIME_PROCESS_BUFFER_DURATION = 4
     # Minimum samples to process
     REALTIME_PROCESS_MINIMUM = 5000
 
-# Samples per tone, calculated from sample rate and tones per
-# second. Verified to integer divisible.
-SAMPLES_PER_TONE = SAMPLE_RATE // TONES_PER_SECOND
-assert SAMPLE_RATE // TONES_PER_SECOND == SAMPLE_RATE / TONES_PER_SECOND
-
 # Use convolution with Gaussian kernel for smoother frequency transitions.
+# The size of the kernel (GUASSIAN_KERNEL_SIZE, in number of samples) is a
+# quarter of a tone by default. Larger means larger (smoother) transitions,
+# but fewer samples for the actual tone itself.
 GAUSSIAN = True
-if GAUSSIAN:
-    # Size of Gaussian kernel. Larger means larger (smoother) transitions,
-    # but fewer samples for the actual tone itself.
-    GUASSIAN_KERNEL_SIZE = SAMPLES_PER_TONE // 4
-else:
+if not GAUSSIAN:
     # Reduce clicking by making sure the sine wave stops at the end of a period
     ANTICLICK_STOP_AT_FULL_PERIOD = True
     # Reduce clicking by adding a fade-in and fade-out to every tone
@@ -102,14 +140,28 @@ else:
     # e.g. 16 means 1/16th of a tone used for fade-in and fade-out
     ANTICLICK_FADE_AMOUNT = 8
 
-# Compress data using optimized gzip before sending. Data is transparently
-# decompressed after receiving. Useful for testing transmission stability,
-# since compressed bits are more "random" and more likely to include very
-# low and very high byte values, unlike ASCII.
+# Number of channels, sent at the same time in different frequency ranges.
+# With MFSK, the frequency range is split between channels. With FSK, every
+# channel uses higher mark and space frequencies than the previous one. More
+# channels transfer more data, but all channels must fit in the frequency
+# range of the audio hardware and noise affects more bits.
+CHANNELS = 1
+
+# Compress every message before sending, using deflate with a preset
+# dictionary (see compression.py). Data is transparently decompressed after
+# receiving. Messages that do not get smaller are sent uncompressed, so
+# compression adds at most a single byte.
 DO_COMPRESS = False
+# Version of the preset dictionary used for compression, dictionaries are
+# stored in the dictionaries directory. 0 uses no dictionary. The receiver
+# decompresses messages of any dictionary version it has.
+COMPRESSION_DICTIONARY = 1
 
-# Gray-encode bytes before sending, and gray-decode after receiving. Seems
-# to make no difference in transmission reliability.
+# Map values to MFSK tones using a Gray code, so adjacent tones send values
+# that differ in a single bit. The most likely tone error, detecting a
+# neighbouring tone, then corrupts a single bit instead of up to TONE_BITS
+# bits, which forward error correction can correct more easily. No effect
+# on FSK, which sends a single bit per tone.
 USE_GRAY_ENCODING = False
 
 # Short, quiet noise to wake up audio interface and prevent artifacts at start
@@ -120,6 +172,85 @@ NOISE_LEVEL = 1e4
 # Maximum size of packet, in bytes
 MAX_PACKET_SIZE = 1500
 
+# Forward error correction using Reed-Solomon codes. Number of parity bytes
+# added to every block, up to half this number of corrupt bytes per block
+# can be corrected. Bytes of all blocks are interleaved, so consecutive
+# corrupt bytes (a wrong tone, a short dropout) are spread over blocks. The
+# number of parity bytes is sent in the packet header, but the receiver
+# must also have FEC enabled. Set to 0 to disable.
+FEC_PARITY = 0
+# Maximum number of packet bytes per Reed-Solomon block. Smaller blocks mean
+# more blocks per packet, so more parity bytes in total and more interleaving.
+FEC_BLOCK_SIZE = 64
+
+# Selective repeat ARQ link layer (see link.py). Maximum number of frames
+# sent but not yet acknowledged, at most 16.
+ARQ_WINDOW = 8
+# Seconds to wait before sending an acknowledgement, so a single
+# acknowledgement can cover multiple frames that arrive shortly after each
+# other. Acknowledgements are sent immediately along with data frames.
+ARQ_ACK_DELAY = 0.5
+# Seconds to wait for an acknowledgement, in addition to the time it takes to
+# send a frame and receive the acknowledgement. The timeout is doubled after
+# the first and second retransmission of the same frame.
+ARQ_TIMEOUT_MARGIN = 1.0
+# Number of times a frame is retransmitted before giving up on it. The
+# receiver then skips the frame, higher layers (TCP) must recover.
+ARQ_MAX_RETRIES = 6
+
+# Name of TUN interface used by bridge.py
+TUN_NAME = 'tun0'
+# Maximum number of packets read from the TUN interface that are waiting to be
+# sent. When the queue is full, the interface is not read until there is room
+# again, and the kernel drops packets.
+BRIDGE_QUEUE_SIZE = 16
+# Send packets using the ARQ link layer (see link.py). Both ends must use the
+# same setting.
+BRIDGE_ARQ = True
+# Maximum number of bytes of frames combined in a single transmission by
+# bridge.py. Every transmission has a fixed cost (noise, sync sweep, end
+# tone), which is shared by combining frames. Larger transmissions mean
+# more delay for the first frame.
+AGGREGATE_MAX_SIZE = 1024
+# Seconds to wait for more frames before starting a transmission. Frames
+# that arrive while a transmission is being sent are combined in the next
+# transmission regardless of this delay.
+AGGREGATE_DELAY = 0
+# Compress IP, TCP and UDP headers of packets sent by bridge.py (see
+# header_compression.py). Both ends must use the same setting. Needs
+# BRIDGE_ARQ, because without it a lost packet with full headers causes up to
+# HEADER_COMPRESSION_REFRESH following packets of the flow to be dropped.
+HEADER_COMPRESSION = True
+# Maximum number of flows (addresses, protocol and ports) with compressed
+# headers at the same time, at most 64
+HEADER_COMPRESSION_CONTEXTS = 16
+# Number of compressed packets after which the full headers are sent again.
+# A lost packet with full headers causes the following packets of the flow
+# to be dropped, until the next packet with full headers. Use a lower value
+# if HEADER_COMPRESSION is used without BRIDGE_ARQ.
+HEADER_COMPRESSION_REFRESH = 16
+# Compress packets sent by bridge.py with a history shared between packets
+# (see StreamCompressor in compression.py), instead of every packet on its
+# own like DO_COMPRESS. Both ends must use the same setting. Works best with
+# BRIDGE_ARQ, because packets after a lost packet can not be decompressed
+# until the next stream starts.
+COMPRESSION_STREAM = False
+# Number of compressed packets after which a new stream starts
+COMPRESSION_STREAM_RESET = 32
+
+# Log messages of this level and above are shown. 'DEBUG' shows every step of
+# the receivers, 'INFO' shows received packets and receiver resets,
+# 'WARNING' only shows problems. Showing many messages costs CPU time.
+LOG_LEVEL = 'WARNING'
+# Counters and histograms of the transmitter and receivers (see metrics.py)
+# are written as JSON to this file every METRICS_INTERVAL seconds. None
+# disables the file.
+METRICS_FILE = None
+METRICS_INTERVAL = 10
+# Port of an HTTP server on localhost that returns the metrics as JSON. None
+# disables the server.
+METRICS_PORT = None
+
 # --------------------- Do not change --------------------- #
 # Constants and values derived from other settings
 
@@ -129,17 +260,11 @@ OUTPUT_MAX = np.iinfo(np.int16).max
 # Packet header size, in bytes
 PACKET_HEADER_SIZE = 4
 
-if MFSK:
-    # Base frequency and space between frequencies for each bit combination.
-    FREQ_BASE = FREQ_MIN
-    FREQ_SPACE = (FREQ_MAX - FREQ_MIN) / (2**TONE_BITS - 1)
+# Size of header for forward error correction, in bytes, including parity
+# bytes for the header itself
+FEC_HEADER_SIZE = 8
+FEC_HEADER_PARITY = 4
 
-    # Input read size, in samples
-    INPUT_READ_SIZE = SAMPLE_RATE // TONES_PER_SECOND // INPUT_READ_FRACTION
-else:
-    # Frequency used for mark (1-bit). Should generally be set to match the
-    # baud rate, or double
-    FREQ_MARK = TONES_PER_SECOND
-    # Frequency used for space (0-bit). Should generally be set to match the
-    # baud rate, or double (opposite of mark frequency)
-    FREQ_SPACE = TONES_PER_SECOND*2
+# Values derived from the settings above, like the number of samples per tone
+# and the tone frequencies, are calculated by ModemConfig.derive() in
+# modem.py. Use modem.DEFAULT to read them.
@@ -1,27 +1,33 @@
+import modem
 import settings
 
+config = modem.DEFAULT
+
 ljust = 25
 
-if settings.MFSK:
+if config.MFSK:
     print('mode:'.ljust(ljust), 'multiple bits, FFT')
-    rate = settings.TONE_BITS * settings.TONES_PER_SECOND
+    rate = config.TONE_BITS * config.TONES_PER_SECOND * config.CARRIERS * config.CHANNELS
+    if config.CONVOLUTIONAL_CODING:
+        # Two encoded bits for every data bit
+        rate //= 2
     print('data rate:'.ljust(ljust), str(rate), 'bits/s', str(rate//8), 'bytes/s')
-    overhead = (settings.NOISE_SAMPLES*2 + settings.SYNC_SWEEP_SAMPLES) / settings.SAMPLE_RATE
-    print('record buffer size:'.ljust(ljust), settings.RECORD_BUFFER_SIZE, 'samples')
-    print('record buffer time:'.ljust(ljust), f'{settings.RECORD_BUFFER_SIZE / settings.SAMPLE_RATE:.1f} seconds')
-    print('max process time:'.ljust(ljust), int(settings.RECORD_PROCESS_SIZE / settings.SAMPLE_RATE * 1000), 'ms')
+    overhead = (config.NOISE_SAMPLES*2 + config.SYNC_SWEEP_SAMPLES) / config.SAMPLE_RATE
+    print('record buffer size:'.ljust(ljust), config.RECORD_BUFFER_SIZE, 'samples')
+    print('record buffer time:'.ljust(ljust), f'{config.RECORD_BUFFER_SIZE / config.SAMPLE_RATE:.1f} seconds')
+    print('max process time:'.ljust(ljust), int(config.RECORD_PROCESS_SIZE / config.SAMPLE_RATE * 1000), 'ms')
 else:
     print('mode:'.ljust(ljust), 'single bit, comb filter')
-    rate = settings.TONES_PER_SECOND
+    rate = config.TONES_PER_SECOND * config.CHANNELS
     print('data rate:'.ljust(ljust), str(rate), 'bits/s', str(rate//8), 'bytes/s')
-    overhead = (settings.NOISE_SAMPLES*2 + len(settings.START_MARKER)*8*settings.SAMPLES_PER_TONE) / settings.SAMPLE_RATE
+    overhead = (config.NOISE_SAMPLES*2 + len(config.START_MARKER)*8*config.SAMPLES_PER_TONE) / config.SAMPLE_RATE
 
 print('max packet size:'.ljust(ljust), settings.MAX_PACKET_SIZE, '+', settings.PACKET_HEADER_SIZE, 'bytes')
-encoded_samples = (settings.MAX_PACKET_SIZE+settings.PACKET_HEADER_SIZE)*8*settings.SAMPLES_PER_TONE
+encoded_samples = (settings.MAX_PACKET_SIZE+settings.PACKET_HEADER_SIZE)*8*config.SAMPLES_PER_TONE
 print('max audio size:'.ljust(ljust), f'{encoded_samples} samples, {encoded_samples*2/1024/1024:.1f} MiB')
 # buf_size = round(math.log2(encoded_samples) + 1)
 # print('recommended buffer size:'.ljust(ljust), f'2**{buf_size} = {2**buf_size}')
-print('samples per tone:'.ljust(ljust), settings.SAMPLES_PER_TONE)
+print('samples per tone:'.ljust(ljust), config.SAMPLES_PER_TONE)
 print('transmission overhead:'.ljust(ljust), f'{overhead:.1f} seconds')
 print()
 print('----- TRANSFER DURATION -----')
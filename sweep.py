@@ -0,0 +1,123 @@
+# Monte Carlo simulation of the modem over a simulated channel (see
+# channel.py). Many random messages are sent for every combination of modem
+# settings and SNR, and the results are reported as bit error rate, packet
+# error rate and goodput: message bits received correctly per second of
+# airtime. The settings with the highest goodput at the SNR measured for a
+# real link give the highest throughput over that link. Trials are
+# distributed over a process pool, one process per CPU core by default.
+#
+#   python sweep.py                   100 trials per combination
+#   python sweep.py 1000 results.json more trials, also save results as JSON
+#
+# Change SETTINGS, SNRS and CHANNEL below to sweep other combinations.
+
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+import channel
+from channel import Channel
+import encode
+from modem import ModemConfig
+import packet
+
+
+# Profiles (see PROFILES in modem.py) and settings that override the profile
+SETTINGS = [('mfsk', {'TONES_PER_SECOND': tones_per_second, 'TONE_BITS': tone_bits})
+            for tones_per_second in (48, 96) for tone_bits in (2, 4, 6)]
+SETTINGS += [('mfsk-coded', {}), ('fsk', {})]
+
+# Signal to noise ratios in dB. The noise covers the whole band, while MFSK
+# tones only occupy a narrow part of it, so MFSK still works well below 0 dB.
+SNRS = [-25, -20, -15, -10, -5, 0, 10, 20]
+
+# Impairments other than noise, the same for every trial, see Channel
+CHANNEL = {
+    'frequency_offset': 0.0,
+    'clock_drift': 0.0,
+    'echoes': [],
+    'dropout_rate': 0.0,
+    'dropout_length': 0.01,
+    'clip_level': None,
+}
+
+MESSAGE_SIZE = 64
+
+
+def trial(profile: str, overrides: dict, snr: float, channel_options: dict, seed: int) -> tuple[int, int, bool, float]:
+    # Sends a random message, returns the number of wrong bits in the packet,
+    # the number of bits in the packet, whether the message was received,
+    # and the airtime of the transmission in seconds. Runs in a worker
+    # process.
+    config = ModemConfig.from_profile(profile, **overrides)
+    message = np.random.default_rng(seed).bytes(MESSAGE_SIZE)
+    send_data = packet.pack(message)
+    audio = encode.packet_to_audio(send_data, config) / 2
+    samples = Channel(snr, seed=seed, **channel_options).transmit(audio, config)
+    received = channel.receive_bytes(samples, config)
+
+    # Bits that were not received at all count as wrong
+    sent_bits = np.unpackbits(np.frombuffer(send_data, dtype='u1'))
+    received_bits = np.unpackbits(np.frombuffer(received[:len(send_data)], dtype='u1'))
+    errors = int(np.count_nonzero(sent_bits[:len(received_bits)] != received_bits))
+    errors += len(sent_bits) - len(received_bits)
+    ok = channel.unpack(received) == message
+    return errors, len(sent_bits), ok, config.airtime(len(send_data))
+
+
+def run_trial(task: tuple) -> tuple[int, int, bool, float]:
+    return trial(*task)
+
+
+def sweep(settings: list[tuple[str, dict]], snrs: list[float], trials: int,
+          channel_options: dict = CHANNEL, workers: Optional[int] = None) -> list[dict]:
+    tasks = [(profile, overrides, snr, channel_options, seed)
+             for profile, overrides in settings for snr in snrs for seed in range(trials)]
+    with ProcessPoolExecutor(workers) as executor:
+        outcomes = list(executor.map(run_trial, tasks, chunksize=max(1, trials // 4)))
+
+    results = []
+    for i, (profile, overrides, snr, _options, _seed) in enumerate(tasks[::trials]):
+        group = outcomes[i * trials:(i + 1) * trials]
+        errors = sum(outcome[0] for outcome in group)
+        bits = sum(outcome[1] for outcome in group)
+        received = sum(outcome[2] for outcome in group)
+        airtime = sum(outcome[3] for outcome in group)
+        results.append({
+            'profile': profile,
+            'overrides': overrides,
+            'snr': snr,
+            'trials': trials,
+            'ber': errors / bits,
+            'per': 1 - received / trials,
+            'goodput': received * MESSAGE_SIZE * 8 / airtime,
+        })
+    return results
+
+
+def describe(result: dict) -> str:
+    overrides = ' '.join(f'{key}={value}' for key, value in result['overrides'].items())
+    return f'{result["profile"]} {overrides}'.strip()
+
+
+if __name__ == '__main__':
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    results = sweep(SETTINGS, SNRS, trials)
+
+    print(f'{"settings":<40} {"snr":>5} {"ber":>9} {"per":>7} {"goodput":>12}')
+    for result in results:
+        print(f'{describe(result):<40} {result["snr"]:>5.1f} {result["ber"]:>9.2e} {result["per"]:>7.3f}'
+              f' {result["goodput"]:>7.1f} bit/s')
+
+    print()
+    for snr in SNRS:
+        best = max((result for result in results if result['snr'] == snr), key=lambda result: result['goodput'])
+        print(f'best at {snr:.1f} dB: {describe(best)}, {best["goodput"]:.1f} bit/s')
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as f:
+            json.dump({'channel': CHANNEL, 'message_size': MESSAGE_SIZE, 'results': results}, f, indent=2)
+        print('saved results to', sys.argv[2])
@@ -0,0 +1,49 @@
+import numpy as np
+
+import decode_fsk
+import encode
+from modem import ModemConfig
+
+
+def mixed_audio(profile: str, channels: int) -> tuple[ModemConfig, list[bytes], np.ndarray]:
+    # A different message on every channel, with silence before and after
+    config = ModemConfig.from_profile(profile, CHANNELS=channels)
+    messages = [f'message on channel {i} of {channels}'.encode() for i in range(channels)]
+    silence = np.zeros(config.SAMPLE_RATE // 4, dtype='i2')
+    return config, messages, np.concatenate((silence, encode.channels_to_audio(messages, config), silence))
+
+
+def test_decode_every_channel():
+    for profile in ['fsk', 'fsk-600']:
+        for channels in [2, 3]:
+            config, messages, audio = mixed_audio(profile, channels)
+            for message, channel in zip(messages, config.channels()):
+                assert decode_fsk.decode(audio, config=channel) == message, (profile, channel)
+
+
+def test_streaming_every_channel():
+    for profile in ['fsk', 'fsk-600']:
+        for channels in [2, 3]:
+            config, messages, audio = mixed_audio(profile, channels)
+            for message, channel in zip(messages, config.channels()):
+                demodulator = decode_fsk.StreamingDemodulator(channel)
+                received = []
+                for start in range(0, len(audio), 1000):
+                    received += demodulator.feed(audio[start:start+1000])
+                assert received == [message], (profile, channel)
+
+
+def test_louder_next_channel():
+    # The first channel still decodes when the next channel arrives 20 dB
+    # louder, as with a receiver that is more sensitive at higher frequencies
+    for profile in ['fsk', 'fsk-600']:
+        first, second = ModemConfig.from_profile(profile, CHANNELS=2).channels()
+        message = b'message on the first channel'
+        quiet = encode.data_to_audio(message, first) / 10
+        loud = encode.data_to_audio(b'louder message on the second channel', second).astype(float)
+        mixed = np.zeros(max(len(quiet), len(loud)))
+        mixed[:len(quiet)] += quiet
+        mixed[:len(loud)] += loud
+        silence = np.zeros(first.SAMPLE_RATE // 4)
+        audio = (np.concatenate((silence, mixed, silence)) / 2).astype('i2')
+        assert decode_fsk.decode(audio, config=first) == message, profile
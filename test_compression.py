@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import compression
+
+
+MESSAGES = [b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n',
+            b'GET /style.css HTTP/1.1\r\nHost: example.com\r\n\r\n',
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n<html></html>',
+            np.random.default_rng(0).bytes(100)]
+
+
+def test_round_trip():
+    for version in [0, 1]:
+        for message in MESSAGES:
+            assert compression.decompress(compression.compress(message, version)) == message
+
+
+def test_stream_round_trip():
+    compressor = compression.StreamCompressor(reset_interval=3)
+    decompressor = compression.StreamDecompressor()
+    for message in MESSAGES * 3:
+        assert decompressor.decompress(compressor.compress(message)) == message
+
+
+def test_stream_too_large_not_in_history():
+    # A message that does not fit in max_size compressed is dropped by the
+    # caller, the receiver never sees it. Messages after it must still
+    # decompress, also when they repeat the dropped message.
+    compressor = compression.StreamCompressor(version=0)
+    decompressor = compression.StreamDecompressor()
+    assert decompressor.decompress(compressor.compress(MESSAGES[0])) == MESSAGES[0]
+    dropped = b'repeated text, ' * 3 + np.random.default_rng(1).bytes(40)
+    assert len(compressor.compress(dropped, max_size=20)) > 20
+    for message in [dropped, MESSAGES[0]]:
+        assert decompressor.decompress(compressor.compress(message)) == message
+
+
+def test_stream_lost_message():
+    compressor = compression.StreamCompressor(reset_interval=2)
+    decompressor = compression.StreamDecompressor()
+    compressor.compress(MESSAGES[0])
+    with pytest.raises(compression.StreamError):
+        decompressor.decompress(compressor.compress(MESSAGES[1]))
+    # The next stream starts with the next message
+    assert decompressor.decompress(compressor.compress(MESSAGES[0])) == MESSAGES[0]
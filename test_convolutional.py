@@ -0,0 +1,61 @@
+import numpy as np
+
+import convolutional
+from convolutional import CONSTRAINT_LENGTH, DECISION_DEPTH
+
+
+def llrs(encoded: np.ndarray) -> np.ndarray:
+    # Certain log-likelihood ratios for encoded bits
+    return 1 - 2.0 * encoded
+
+
+def test_round_trip():
+    rng = np.random.default_rng(0)
+    for size in [1, 8, 100, 1000]:
+        bits = rng.integers(0, 2, size)
+        encoded = convolutional.encode(bits)
+        assert len(encoded) == 2 * (size + CONSTRAINT_LENGTH - 1)
+        decoded = convolutional.decode(llrs(encoded))
+        assert np.array_equal(decoded[:size], bits)
+        assert not decoded[size:].any()
+
+
+def test_padding():
+    # Encoded zero bits after the tail decode as extra zero bits
+    bits = np.random.default_rng(1).integers(0, 2, 50)
+    encoded = np.concatenate((convolutional.encode(bits), np.zeros(10, dtype='u1')))
+    decoded = convolutional.decode(llrs(encoded))
+    assert np.array_equal(decoded[:len(bits)], bits)
+    assert not decoded[len(bits):].any()
+
+
+def test_hard_errors():
+    # Free distance of the code is 10, so isolated wrong bits are corrected
+    rng = np.random.default_rng(2)
+    bits = rng.integers(0, 2, 500)
+    encoded = convolutional.encode(bits)
+    received = llrs(encoded)
+    received[::40] *= -1
+    assert np.array_equal(convolutional.decode(received)[:len(bits)], bits)
+
+
+def test_soft_decisions():
+    # Noise that flips several percent of the channel bits
+    rng = np.random.default_rng(3)
+    bits = rng.integers(0, 2, 2000)
+    encoded = convolutional.encode(bits)
+    received = llrs(encoded) + rng.normal(0, 0.6, len(encoded))
+    assert np.count_nonzero((received < 0) != encoded) > 0.03 * len(encoded)
+    assert np.array_equal(convolutional.decode(received)[:len(bits)], bits)
+
+
+def test_not_terminated():
+    # The start of a sequence that is still being received: bits up to
+    # DECISION_DEPTH steps before the end are already final
+    rng = np.random.default_rng(4)
+    bits = rng.integers(0, 2, 300)
+    encoded = convolutional.encode(bits)[:2 * 200]
+    received = llrs(encoded) + rng.normal(0, 0.5, len(encoded))
+    decoded = convolutional.decode(received, terminated=False)
+    assert len(decoded) == 200
+    assert np.array_equal(decoded[:200 - DECISION_DEPTH], bits[:200 - DECISION_DEPTH])
@@ -0,0 +1,41 @@
+import numpy as np
+
+from decode_fsk_realtime import AudioProcessor
+import encode
+import metrics
+from modem import ModemConfig
+from ring_buffer import RingBuffer
+
+
+class RacingBuffer(RingBuffer):
+    """
+    Ring buffer whose writer overwrites the whole buffer between the
+    reader's check of the write position and its read, once
+    """
+    raced: bool
+
+    def __init__(self, size: int):
+        super().__init__(size)
+        self.raced = False
+
+    def read(self, start: int, count: int) -> np.ndarray:
+        if not self.raced:
+            self.raced = True
+            self.write(np.zeros(self.size, dtype='i2'))
+        return super().read(start, count)
+
+
+def test_overrun_while_processing():
+    # The processor skips to recent samples and keeps receiving
+    config = ModemConfig.from_profile('fsk')
+    received = []
+    processor = AudioProcessor(config, RacingBuffer(config.SAMPLE_RATE * 4), received.append)
+    processor.buffer.write(np.zeros(config.SAMPLE_RATE, dtype='i2'))
+    overruns = metrics.snapshot()['counters'].get('buffer_overruns', 0)
+    processor.process()
+    assert metrics.snapshot()['counters']['buffer_overruns'] == overruns + 1
+
+    silence = np.zeros(config.SAMPLE_RATE // 4, dtype='i2')
+    processor.buffer.write(np.concatenate((silence, encode.data_to_audio(b'after the overrun', config), silence)))
+    processor.process()
+    assert received == [b'after the overrun']
@@ -0,0 +1,37 @@
+import channel
+from channel import Channel
+import encode
+from modem import ModemConfig
+
+
+MESSAGE = b'multi-carrier message through a noisy channel'
+
+
+def receive(config: ModemConfig, snr: float, seed: int) -> bytes:
+    samples = Channel(snr, seed=seed).transmit(encode.data_to_audio(MESSAGE, config) / 2, config)
+    return channel.receive_bytes(samples, config)
+
+
+def test_multi_carrier_round_trip():
+    config = ModemConfig.from_profile('mfsk-multi')
+    assert channel.unpack(receive(config, 10, 0)) == MESSAGE
+
+
+def test_noise():
+    # In noise, detected tones include the end tone on some carriers only,
+    # or frequencies that are no tone at all. Decoding returns wrong bytes,
+    # it does not fail.
+    configs = [ModemConfig.from_profile('mfsk-multi'), ModemConfig.from_profile('mfsk', TONE_DETECTOR='fft')]
+    for config in configs:
+        for snr in [-15, -10]:
+            for seed in range(3):
+                data = receive(config, snr, seed)
+                assert channel.unpack(data) in (None, MESSAGE)
+
+
+def test_sample_rate():
+    # Sync sweep and calibration offset follow the sample rate
+    config = ModemConfig.from_profile('mfsk-fast', SAMPLE_RATE=44_100, TONES_PER_SECOND=45)
+    assert config.SYNC_SWEEP_SAMPLES == 22_050
+    assert config.SYNC_CALIBRATION_OFFSET == 22
+    assert channel.unpack(receive(config, 10, 0)) == MESSAGE
@@ -0,0 +1,119 @@
+import struct
+
+from header_compression import (ContextError, HeaderCompressor, HeaderDecompressor, internet_checksum,
+                                IPV4_HEADER_SIZE, IPV6_HEADER_SIZE, PROTOCOL_TCP, PROTOCOL_UDP, TYPE_COMPRESSED,
+                                TYPE_FULL, TYPE_RAW)
+
+
+def ipv4(protocol: int, transport: bytes, ident: int = 1, source: int = 1) -> bytes:
+    ip = bytearray(struct.pack('>BBHHHBBH4s4s', 0x45, 0, IPV4_HEADER_SIZE + len(transport), ident, 0x4000, 64,
+                               protocol, 0, bytes([10, 0, 0, source]), bytes([10, 0, 0, 2])))
+    struct.pack_into('>H', ip, 10, internet_checksum(bytes(ip)))
+    return bytes(ip) + transport
+
+
+def ipv6(protocol: int, transport: bytes) -> bytes:
+    return struct.pack('>IHBB16s16s', 6 << 28, len(transport), protocol, 64,
+                       bytes(15) + b'\1', bytes(15) + b'\2') + transport
+
+
+def tcp(seq: int, ack: int, timestamp: int, payload: bytes, port: int = 40000) -> bytes:
+    # TCP segment with timestamp option, as sent by Linux
+    header = struct.pack('>HHIIHHHH', port, 22, seq, ack, (8 << 12) | 0x18, 502, (seq * 7) % 65536, 0)
+    return header + struct.pack('>BBBBII', 1, 1, 8, 10, timestamp, timestamp - 20) + payload
+
+
+def udp(payload: bytes, checksum: int = 0x1234) -> bytes:
+    return struct.pack('>HHHH', 5353, 53, 8 + len(payload), checksum) + payload
+
+
+def tcp_flow(count: int, seq: int = 1000) -> list[bytes]:
+    packets = []
+    for i in range(count):
+        payload = bytes(range(i % 30))
+        packets.append(ipv4(PROTOCOL_TCP, tcp(seq, 5000 + 3 * i, 70000 + 25 * i, payload), ident=100 + i))
+        seq = (seq + len(payload)) % 2**32
+    return packets
+
+
+def round_trip(packets: list[bytes], compressor: HeaderCompressor, decompressor: HeaderDecompressor) -> list[bytes]:
+    compressed = [compressor.compress(data) for data in packets]
+    for data, result in zip(packets, compressed):
+        assert decompressor.decompress(result) == data
+    return compressed
+
+
+def assert_sizes(packets: list[bytes], compressed: list[bytes], full_interval: int):
+    # Every full_interval packets a full packet, two bytes larger than the
+    # original. The 52 bytes of IP and TCP headers of other packets are
+    # compressed to a few bytes.
+    for i, (data, result) in enumerate(zip(packets, compressed)):
+        if i % full_interval == 0:
+            assert result[0] >> 6 == TYPE_FULL and len(result) == len(data) + 2
+        else:
+            assert result[0] >> 6 == TYPE_COMPRESSED and len(result) <= len(data) - 38
+
+
+def test_tcp_round_trip():
+    packets = tcp_flow(50)
+    compressed = round_trip(packets, HeaderCompressor(refresh=16), HeaderDecompressor())
+    assert_sizes(packets, compressed, 17)
+
+
+def test_sequence_wraparound():
+    # Sequence numbers that wrap around 2**32 are small differences
+    packets = tcp_flow(20, seq=2**32 - 100)
+    compressed = round_trip(packets, HeaderCompressor(refresh=16), HeaderDecompressor())
+    assert_sizes(packets, compressed, 17)
+
+
+def test_udp_and_ipv6():
+    packets = []
+    for i in range(10):
+        packets.append(ipv4(PROTOCOL_UDP, udp(bytes(i), checksum=i), ident=i))
+        packets.append(ipv6(PROTOCOL_UDP, udp(bytes(i))))
+        packets.append(ipv6(PROTOCOL_TCP, tcp(1000 + i, 1, 500 + i, bytes(i))))
+    compressed = round_trip(packets, HeaderCompressor(), HeaderDecompressor())
+    assert [result[0] >> 6 for result in compressed[:3]] == [TYPE_FULL] * 3
+    assert [result[0] >> 6 for result in compressed[3:6]] == [TYPE_COMPRESSED] * 3
+
+
+def test_raw():
+    # Packets that can not be compressed are sent as they are
+    fragment = bytearray(ipv4(PROTOCOL_UDP, udp(b'data')))
+    struct.pack_into('>H', fragment, 6, 0x2000)
+    struct.pack_into('>H', fragment, 10, 0)
+    struct.pack_into('>H', fragment, 10, internet_checksum(bytes(fragment[:IPV4_HEADER_SIZE])))
+    packets = [b'', b'\x45not an ip packet', bytes(fragment), ipv4(1, b'\x08\0icmp'),
+               ipv6(PROTOCOL_UDP, udp(b'data'))[:IPV6_HEADER_SIZE + 4]]
+    compressed = round_trip(packets, HeaderCompressor(), HeaderDecompressor())
+    assert all(result[0] >> 6 == TYPE_RAW for result in compressed)
+
+
+def test_lost_packets():
+    # A lost compressed packet does not affect the packets after it. After a
+    # lost full packet, packets are dropped until the next full packet.
+    compressor = HeaderCompressor(refresh=8)
+    decompressor = HeaderDecompressor()
+    packets = tcp_flow(40)
+    delivered = []
+    for i, data in enumerate(packets):
+        compressed = compressor.compress(data)
+        if i in (3, 9):
+            # Compressed packet 3 and full packet 9 are lost
+            continue
+        try:
+            assert decompressor.decompress(compressed) == data
+            delivered.append(i)
+        except ContextError:
+            pass
+    assert delivered == [0, 1, 2] + list(range(4, 9)) + list(range(18, 40))
+    assert decompressor.dropped == 8
+
+
+def test_contexts_reused():
+    # More flows than contexts, the least recently used context is reused
+    flows = [[ipv4(PROTOCOL_TCP, tcp(1000 + i, 1, 500 + i, b'x', port=port), ident=i) for i in range(3)]
+             for port in range(1000, 1006)]
+    packets = [flow[i] for i in range(3) for flow in flows]
+    round_trip(packets, HeaderCompressor(context_count=4), HeaderDecompressor())
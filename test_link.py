@@ -0,0 +1,101 @@
+import random
+
+import link
+from link import Frame, LinkEndpoint, LoopbackChannel
+from modem import ModemConfig
+import settings
+
+
+def payloads(count: int) -> list[bytes]:
+    return [bytes([i % 256]) * 10 for i in range(count)]
+
+
+def test_window_wrap_around():
+    # More frames than sequence numbers, with lost frames and acknowledgements
+    sent = payloads(link.SEQUENCE_MODULO + 60)
+    delivered, _duration, sender = link.run_loopback(sent, loss=0.1, seed=3)
+    assert sender.given_up == 0
+    assert sender.next_seq == len(sent) % link.SEQUENCE_MODULO
+    assert delivered == sent
+
+
+def test_sack_retransmits_lost_frame():
+    # A lost frame is retransmitted as soon as a frame sent after it is
+    # acknowledged, before its timer expires
+    sender = LinkEndpoint(window=4)
+    receiver = LinkEndpoint(window=4)
+    p = payloads(3)
+    for payload in p:
+        sender.send(payload)
+    frames = [sender.poll(0.0) for _ in p]
+    # The first frame is lost
+    assert receiver.receive(frames[1], 1.0) == []
+    assert receiver.receive(frames[2], 1.0) == []
+    ack = Frame.from_bytes(receiver.poll(1.0 + settings.ARQ_ACK_DELAY))
+    assert (ack.ack, ack.sack) == (0, 0b11)
+
+    now = 2.0
+    assert min(sent.deadline for sent in sender.in_flight.values()) > now
+    sender.receive(ack.to_bytes(), now)
+    assert list(sender.in_flight) == [0]
+    retransmission = sender.poll(now)
+    assert Frame.from_bytes(retransmission).seq == 0
+    assert sender.retransmissions == 1
+    assert receiver.receive(retransmission, now) == p
+
+
+def test_give_up_announces_base():
+    # After ARQ_MAX_RETRIES retransmissions the sender gives up on a frame,
+    # the next frame it sends moves the base of the receiver past it
+    sender = LinkEndpoint()
+    receiver = LinkEndpoint()
+    p = payloads(2)
+    for payload in p:
+        sender.send(payload)
+    sender.poll(0.0)  # lost, every time
+    assert receiver.receive(sender.poll(0.0), 0.0) == []
+    sender.receive(receiver.poll(settings.ARQ_ACK_DELAY), 1.0)
+    assert list(sender.in_flight) == [0]
+
+    now = 1.0
+    for _ in range(settings.ARQ_MAX_RETRIES):
+        now = sender.next_event(now)
+        assert Frame.from_bytes(sender.poll(now)).seq == 0
+    assert sender.given_up == 0
+
+    now = sender.next_event(now)
+    announcement = sender.poll(now)
+    assert sender.given_up == 1
+    assert sender.idle
+    assert Frame.from_bytes(announcement).base == 2
+    assert receiver.receive(announcement, now) == [p[1]]
+    assert receiver.skipped == 1
+    assert receiver.expected == 2
+
+
+def test_duplicates_delivered_once():
+    # Retransmissions of frames that already arrived (their acknowledgement
+    # was lost) are not delivered again
+    sender = LinkEndpoint()
+    receiver = LinkEndpoint()
+    p = payloads(2)
+    for payload in p:
+        sender.send(payload)
+    frames = [sender.poll(0.0) for _ in p]
+    assert receiver.receive(frames[1], 0.0) == []
+    # Stored but not delivered yet
+    assert receiver.receive(frames[1], 0.0) == []
+    assert receiver.receive(frames[0], 0.0) == p
+    # Already delivered
+    assert receiver.receive(frames[0], 0.0) == []
+    assert receiver.duplicates == 2
+
+
+def test_modem_loopback():
+    # Frames that the modem can not decode are lost, not an error
+    config = ModemConfig.from_profile('mfsk-fast')
+    frame = Frame(link.FLAG_DATA, 0, 0, payload=b'through the modem').to_bytes()
+    assert LoopbackChannel(noise=100, config=config, seed=0).modulate(frame) == frame
+    channel = LoopbackChannel(noise=1e5, config=config, seed=0)
+    for _ in range(3):
+        assert channel.modulate(frame) in (None, frame)
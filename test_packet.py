@@ -0,0 +1,144 @@
+import contextlib
+import struct
+from typing import Optional
+
+import numpy as np
+
+import crc16
+import metrics
+import packet
+from packet import PacketCorruptError, PacketIncompleteError, PacketParser
+import settings
+
+
+@contextlib.contextmanager
+def fec_parity(parity: int):
+    # Packets use the FEC settings from settings.py
+    previous = settings.FEC_PARITY
+    settings.FEC_PARITY = parity
+    try:
+        yield
+    finally:
+        settings.FEC_PARITY = previous
+
+
+def parse(data: bytes, chunk_sizes: list[int]) -> Optional[list[bytes]]:
+    # Feed data to a parser in chunks of the given sizes, repeated
+    parser = PacketParser()
+    offset = 0
+    i = 0
+    while offset < len(data):
+        size = chunk_sizes[i % len(chunk_sizes)]
+        result = parser.feed(data[offset:offset+size])
+        offset += size
+        i += 1
+        if result is not None:
+            return result
+    return None
+
+
+def outcome(function, *args) -> tuple:
+    # Messages, or the error that was raised
+    try:
+        return 'messages', function(*args)
+    except PacketIncompleteError:
+        return 'incomplete', None
+    except PacketCorruptError:
+        return 'corrupt', None
+
+
+def parser_outcome(data: bytes, chunk_sizes: list[int]) -> tuple:
+    # A parser that still needs more bytes has an incomplete packet
+    result = outcome(parse, data, chunk_sizes)
+    if result == ('messages', None):
+        return 'incomplete', None
+    return result
+
+
+def packets(rng: np.random.Generator) -> list[bytes]:
+    result = []
+    for size in [0, 1, 40, 300]:
+        result.append(packet.pack(rng.bytes(size)))
+    for count in [2, 5]:
+        result.append(packet.pack_many([rng.bytes(int(size)) for size in rng.integers(1, 60, count)]))
+    return result
+
+
+def test_crc16_running():
+    data = np.random.default_rng(0).bytes(1000)
+    crc = crc16.INITIAL
+    for start in range(0, len(data), 77):
+        crc = crc16.crc16(data[start:start+77], crc)
+    assert crc == crc16.crc16(data)
+
+
+def test_parser_round_trip():
+    rng = np.random.default_rng(1)
+    for parity in [0, 8]:
+        with fec_parity(parity):
+            for data in packets(rng):
+                expected = packet.unpack_many(data)
+                for chunk_sizes in [[len(data)], [1], [3, 50, 7]]:
+                    assert parse(data, chunk_sizes) == expected
+                # Bytes after the end of the packet are ignored
+                assert parse(data + rng.bytes(20), [len(data) + 20]) == expected
+
+
+def test_parser_matches_unpack_when_corrupted():
+    # Whatever is corrupted, the parser returns the same messages as
+    # unpack_many(), or both find the packet corrupt or incomplete
+    rng = np.random.default_rng(2)
+    for parity in [0, 8]:
+        with fec_parity(parity):
+            for data in packets(rng):
+                for _ in range(50):
+                    corrupted = bytearray(data)
+                    for i in rng.choice(len(data), int(rng.integers(1, 4)), replace=False):
+                        corrupted[i] ^= int(rng.integers(1, 256))
+                    if rng.random() < 0.3:
+                        corrupted = corrupted[:int(rng.integers(0, len(corrupted)))]
+                    corrupted = bytes(corrupted)
+                    if len(corrupted) < packet.header_size():
+                        expected = 'incomplete', None
+                    else:
+                        expected = outcome(packet.unpack_many, corrupted)
+                    actual = parser_outcome(corrupted, [int(rng.integers(1, 30))])
+                    if expected[0] == 'messages' or actual[0] == 'messages':
+                        assert actual == expected, (parity, corrupted)
+                    else:
+                        # The parser may find a corrupt header before the
+                        # packet is complete
+                        assert actual[0] in ('corrupt', expected[0]), (parity, corrupted)
+
+
+def test_corrupt_header_aborts():
+    # Headers that pack() and pack_many() never create are rejected as soon
+    # as they are received, and by unpack_many()
+    too_large = struct.pack('>HH', settings.MAX_PACKET_SIZE + 1, 0)
+    empty_aggregate = struct.pack('>HH', packet.AGGREGATE_FLAG, crc16.crc16(b''))
+    for header in [too_large, empty_aggregate]:
+        assert parser_outcome(header, [len(header)]) == ('corrupt', None)
+        assert outcome(packet.unpack_many, header) == ('corrupt', None)
+
+
+
+def test_undecompressable_message_skipped():
+    # A message with a valid checksum that fails to decompress is counted,
+    # the other messages of the packet are still returned
+    previous = settings.DO_COMPRESS
+    settings.DO_COMPRESS = True
+    try:
+        messages = [b'first message', b'second message']
+        data = packet.pack_many(messages)
+        corrupt = packet.pack_many(messages + [b'third message'])
+        # Replace the compression flag of the last message by an invalid one,
+        # and update the checksums to match
+        aggregate, checksum, body = packet.read_packet(corrupt)
+        offset = len(packet.read_packet(data)[2])
+        message = b'\x05' + body[offset+packet.SUBPACKET_HEADER.size+1:]
+        body = body[:offset] + packet.SUBPACKET_HEADER.pack(len(message), crc16.crc16(message)) + message
+        before = metrics.snapshot()['counters'].get('messages_corrupt', 0)
+        assert packet.split_messages(aggregate, crc16.crc16(body), body) == messages
+        assert metrics.snapshot()['counters']['messages_corrupt'] == before + 1
+    finally:
+        settings.DO_COMPRESS = previous
@@ -0,0 +1,104 @@
+import contextlib
+import struct
+
+import numpy as np
+import pytest
+
+import packet
+from packet import PacketCorruptError
+import reed_solomon
+from reed_solomon import ReedSolomonError
+import settings
+
+
+@contextlib.contextmanager
+def fec_parity(parity: int):
+    # Packets use the FEC settings from settings.py
+    previous = settings.FEC_PARITY
+    settings.FEC_PARITY = parity
+    try:
+        yield
+    finally:
+        settings.FEC_PARITY = previous
+
+
+def test_round_trip():
+    rng = np.random.default_rng(0)
+    for parity in [2, 4, 16, 32]:
+        for length in [1, 10, 200, 255 - parity]:
+            data = rng.bytes(length)
+            encoded = reed_solomon.encode(data, parity)
+            assert len(encoded) == length + parity
+            assert reed_solomon.decode(encoded, parity) == data
+
+
+def test_correct_errors():
+    # Up to parity / 2 wrong bytes anywhere in data or parity are corrected
+    rng = np.random.default_rng(1)
+    for parity in [2, 4, 16, 32]:
+        for length in [1, 10, 200, 255 - parity]:
+            data = rng.bytes(length)
+            encoded = bytearray(reed_solomon.encode(data, parity))
+            for i in rng.choice(len(encoded), min(parity // 2, len(encoded)), replace=False):
+                encoded[i] ^= int(rng.integers(1, 256))
+            assert reed_solomon.decode(bytes(encoded), parity) == data
+
+
+def test_too_many_errors():
+    # More than parity / 2 wrong bytes can not be corrected, that is detected
+    # in most cases
+    rng = np.random.default_rng(2)
+    detected = 0
+    for _ in range(20):
+        data = rng.bytes(50)
+        encoded = bytearray(reed_solomon.encode(data, 8))
+        for i in rng.choice(len(encoded), 10, replace=False):
+            encoded[i] ^= int(rng.integers(1, 256))
+        try:
+            assert reed_solomon.decode(bytes(encoded), 8) != data
+        except ReedSolomonError:
+            detected += 1
+    assert detected >= 15
+
+
+def test_packet_round_trip():
+    rng = np.random.default_rng(3)
+    with fec_parity(8):
+        for size in [0, 1, 60, 61, 200, settings.MAX_PACKET_SIZE - 1]:
+            message = rng.bytes(size)
+            data = packet.pack(message)
+            assert len(data) == packet.packed_size(size)
+            assert packet.unpack(data) == message
+
+
+def test_packet_burst_error():
+    # Interleaving spreads a burst of wrong bytes over all blocks, a burst of
+    # parity / 2 bytes per block is corrected
+    rng = np.random.default_rng(4)
+    with fec_parity(8):
+        message = rng.bytes(300)
+        data = bytearray(packet.pack(message))
+        _parity, block_count, _size = packet.fec_decode_header(data)
+        start = settings.FEC_HEADER_SIZE + 20
+        for i in range(start, start + 4 * block_count):
+            data[i] ^= 0xff
+        assert packet.unpack(bytes(data)) == message
+
+        # Errors in the header are corrected as well
+        data[0] ^= 0xff
+        data[3] ^= 0x01
+        assert packet.unpack(bytes(data)) == message
+
+
+def test_packet_invalid_header():
+    # Headers that decode without errors but can not come from pack(): no
+    # parity bytes, no blocks, a size smaller than the packet header or
+    # larger than the maximum, blocks larger than 255 bytes
+    headers = [(0, 1, 10), (8, 0, 100), (8, 1, 2), (8, 1, settings.MAX_PACKET_SIZE + 5), (200, 1, 100)]
+    with fec_parity(8):
+        for parity, block_count, size in headers:
+            header = reed_solomon.encode(struct.pack('>BBH', parity, block_count, size), settings.FEC_HEADER_PARITY)
+            data = header + bytes(300)
+            for function in [packet.get_size, packet.unpack, packet.PacketParser().feed]:
+                with pytest.raises(PacketCorruptError):
+                    function(data)
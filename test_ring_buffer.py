@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from ring_buffer import RingBuffer, RingBufferOverrunError
+
+
+def test_wraparound():
+    # Writes of different sizes, every range of up to size samples reads
+    # back as written, also when it wraps around the end of the buffer
+    buffer = RingBuffer(100)
+    written = np.arange(1000, dtype='i2')
+    position = 0
+    for size in [1, 30, 99, 100, 7, 64, 3, 80, 100, 16]:
+        buffer.write(written[position:position+size])
+        position += size
+        assert buffer.pos == position
+        for count in [1, size, 100]:
+            start = max(0, position - count)
+            assert np.array_equal(buffer.read(start, position - start), written[start:position])
+
+
+def test_read_is_contiguous_view():
+    buffer = RingBuffer(10)
+    buffer.write(np.arange(15, dtype='i2'))
+    view = buffer.read(5, 10)
+    assert view.base is buffer.data
+    assert view.tolist() == list(range(5, 15))
+
+
+def test_write_larger_than_buffer():
+    # Only the newest size samples are kept, the position counts all of them
+    buffer = RingBuffer(10)
+    buffer.write(np.arange(5, dtype='i2'))
+    buffer.write(np.arange(5, 30, dtype='i2'))
+    assert buffer.pos == 30
+    assert buffer.read(20, 10).tolist() == list(range(20, 30))
+    assert not buffer.available(19)
+
+
+def test_overrun():
+    buffer = RingBuffer(10)
+    buffer.write(np.arange(25, dtype='i2'))
+    assert buffer.available(15)
+    assert not buffer.available(14)
+    for start, count in [(14, 5), (0, 1), (15, 11)]:
+        with pytest.raises(RingBufferOverrunError):
+            buffer.read(start, count)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from modem import ModemConfig
+from packet import PacketCorruptError
+import tone_conversion
+
+
+TEST_MESSAGE = b'testing testing 123'
+
+
+def test_gray_neighbours_differ_in_one_bit():
+    for bits in range(1, 9):
+        config = ModemConfig.from_profile('mfsk', USE_GRAY_ENCODING=True, TONE_BITS=bits)
+        differences = config.tone_values[1:] ^ config.tone_values[:-1]
+        assert all(bin(int(difference)).count('1') == 1 for difference in differences), bits
+
+
+def test_value_tones_inverse_of_tone_values():
+    for use_gray in [True, False]:
+        config = ModemConfig.from_profile('mfsk', USE_GRAY_ENCODING=use_gray, TONE_BITS=5)
+        values = np.arange(2**5)
+        assert np.array_equal(config.tone_values[config.value_tones], values)
+        assert sorted(config.tone_values.tolist()) == values.tolist()
+
+
+def test_round_trip():
+    for use_gray in [True, False]:
+        for bits in range(1, 9):
+            config = ModemConfig.from_profile('mfsk', USE_GRAY_ENCODING=use_gray, TONE_BITS=bits)
+            tones = tone_conversion.bytes_to_tones(TEST_MESSAGE, config)
+            assert np.all((tones >= 0) & (tones < 2**bits))
+            assert tone_conversion.tones_to_bytes(tones.tolist(), config) == TEST_MESSAGE
+
+
+def test_fsk_round_trip():
+    config = ModemConfig.from_profile('fsk')
+    tones = tone_conversion.bytes_to_tones(TEST_MESSAGE, config)
+    assert tone_conversion.tones_to_bytes(tones.tolist(), config) == TEST_MESSAGE
+
+
+def test_soft_bits_round_trip():
+    config = ModemConfig.from_profile('mfsk', TONE_BITS=4, CONVOLUTIONAL_CODING=True, USE_GRAY_ENCODING=True)
+    tones = tone_conversion.bytes_to_tones(TEST_MESSAGE, config)
+    # Perfect soft decisions: positive for 0, negative for 1
+    llrs = 1 - 2.0 * config.tone_bit_table[tones].ravel()
+    restored = tone_conversion.soft_bits_to_bytes(llrs, config)
+    assert restored[:len(TEST_MESSAGE)] == TEST_MESSAGE
+
+
+
+def test_illegal_tones():
+    # The end tone and tones outside of the tone range send no value
+    config = ModemConfig.from_profile('mfsk', TONE_BITS=4)
+    for tone in [-1, 16, 37]:
+        with pytest.raises(PacketCorruptError):
+            tone_conversion.tones_to_bytes([1, 2, tone, 3], config)
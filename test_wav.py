@@ -1,4 +1,5 @@
 import wave
+from typing import Iterable
 
 import numpy as np
 
@@ -19,9 +20,18 @@ def read() -> np.ndarray:
 
 
 def write(samples: np.ndarray) -> None:
+    write_blocks([samples])
+
+
+def write_blocks(blocks: Iterable[np.ndarray]) -> None:
+    # Write blocks of samples as they are produced, for example by
+    # encode.blocks(), so not all samples have to be in memory at once
     with wave.open(settings.TEST_WAV, 'wb') as wave_writer:
         wave_writer.setnchannels(1)  # mono
         wave_writer.setsampwidth(2)  # 16 bits per sample
         wave_writer.setframerate(settings.SAMPLE_RATE)
-        wave_writer.writeframes(samples)
-        print(f'Written {len(samples)} samples to {settings.TEST_WAV}')
+        count = 0
+        for samples in blocks:
+            wave_writer.writeframes(samples)
+            count += len(samples)
+        print(f'Written {count} samples to {settings.TEST_WAV}')
@@ -1,77 +1,94 @@
-import settings
-import gray
-
-
-def bytes_to_tones(data: bytes) -> list[int]:
-    byte_list = list(data)
-
-    if settings.USE_GRAY_ENCODING:
-        for i, byte in enumerate(byte_list):
-            byte_list[i] = gray.to_gray(byte)
-
-    tones = []
-
-    if not settings.MFSK or settings.TONE_BITS == 1:
-        for byte in byte_list:
-            tones.append(byte >> 7 & 1)
-            tones.append(byte >> 6 & 1)
-            tones.append(byte >> 5 & 1)
-            tones.append(byte >> 4 & 1)
-            tones.append(byte >> 3 & 1)
-            tones.append(byte >> 2 & 1)
-            tones.append(byte >> 1 & 1)
-            tones.append(byte >> 0 & 1)
-    elif settings.TONE_BITS == 2:
-        for byte in byte_list:
-            tones.append(byte >> 6 & 0b11)
-            tones.append(byte >> 4 & 0b11)
-            tones.append(byte >> 2 & 0b11)
-            tones.append(byte >> 0 & 0b11)
-    elif settings.TONE_BITS == 4:
-        for byte in byte_list:
-            tones.append(byte >> 4)
-            tones.append(byte & 0xF)
-    elif settings.TONE_BITS == 8:
-        tones = byte_list
-    else:
-        raise ValueError()
-
-    return tones
-
-
-def tones_to_bytes(tones: list[int]):
-    if settings.MFSK:
-        assert settings.TONE_BITS in {1, 2, 4, 8}
-        tone_bits = settings.TONE_BITS
-    else:
-        tone_bits = 1
-
-    byte_list = []
-    tones_per_byte = 8 // tone_bits
-    for i in range(0, len(tones) // tones_per_byte * tones_per_byte, tones_per_byte):
-        b = 0
-        for j in range(tones_per_byte):
-            b |= tones[i + j] << (8 - (j+1)*tone_bits)
-        byte_list.append(b)
-
-    if settings.USE_GRAY_ENCODING:
-        for i, byte in enumerate(byte_list):
-            byte_list[i] = gray.from_gray(byte)
-
-    return bytes(byte_list)
+from typing import Optional
+
+import numpy as np
+
+import convolutional
+import modem
+from modem import ModemConfig
+from packet import PacketCorruptError
+
+
+def tone_bits(config: ModemConfig) -> int:
+    # Number of bits sent by every tone
+    return config.TONE_BITS if config.MFSK else 1
+
+
+def bits_to_tones(bits: np.ndarray, tone_bits: int) -> np.ndarray:
+    # Group bits in tones of tone_bits bits, most significant bit first. The
+    # last tone is padded with zero bits.
+    padding = -len(bits) % tone_bits
+    bits = np.concatenate((bits, np.zeros(padding, dtype=bits.dtype))).reshape(-1, tone_bits)
+    return bits.astype(int) @ (1 << np.arange(tone_bits - 1, -1, -1))
+
+
+def tones_to_bits(values: np.ndarray, tone_bits: int) -> np.ndarray:
+    # Reverse of bits_to_tones(), including padding bits
+    values = np.asarray(values, dtype=int)
+    return (values[:, np.newaxis] >> np.arange(tone_bits - 1, -1, -1) & 1).astype('u1').ravel()
+
+
+def bytes_to_tones(data: bytes, config: Optional[ModemConfig] = None) -> np.ndarray:
+    config = modem.get(config)
+    bits = np.unpackbits(np.frombuffer(data, dtype='u1'))
+
+    if config.MFSK and config.CONVOLUTIONAL_CODING:
+        bits = convolutional.encode(bits)
+
+    values = bits_to_tones(bits, tone_bits(config))
+    if config.MFSK:
+        # Tone that sends every value, see ModemConfig.tone_values
+        return config.value_tones[values]
+    return values
+
+
+def tones_to_bitstream(tones: list[int], config: Optional[ModemConfig] = None) -> np.ndarray:
+    # Bits sent by tones, most significant bit of every tone first
+    config = modem.get(config)
+    values = np.asarray(tones, dtype=int)
+    if config.MFSK:
+        if np.any((values < 0) | (values >= len(config.tone_values))):
+            raise PacketCorruptError('Illegal tone')
+        values = config.tone_values[values]
+    return tones_to_bits(values, tone_bits(config))
+
+
+def tones_to_bytes(tones: list[int], config: Optional[ModemConfig] = None) -> bytes:
+    # Bytes sent by tones. Bits after the last complete byte are padding.
+    bits = tones_to_bitstream(tones, config)
+    return np.packbits(bits[:len(bits) // 8 * 8]).tobytes()
+
+
+def soft_bits_to_bytes(llrs: np.ndarray, config: Optional[ModemConfig] = None) -> bytes:
+    # Decode convolutionally coded bits, given as log-likelihood ratios
+    # (positive for a bit that is probably 0). Padding and tail bits decode
+    # as zero bits after the packet, like padding of uncoded tones.
+    bits = convolutional.decode(llrs)
+    return np.packbits(bits[:len(bits) // 8 * 8]).tobytes()
 
 
 if __name__ == '__main__':
     test_message = b'testing testing 123'
-    settings.MFSK = True
     for use_gray in [True, False]:
-        settings.USE_GRAY_ENCODING = use_gray
         print('gray:', use_gray)
-        for tone_bits in [1, 2, 4, 8]:
-            print('tone_bits:', tone_bits)
-            settings.TONE_BITS = tone_bits
-            tones = bytes_to_tones(test_message)
+        for bits in [1, 2, 3, 4, 5, 6, 7, 8]:
+            print('tone_bits:', bits)
+            config = ModemConfig.from_profile('mfsk', USE_GRAY_ENCODING=use_gray, TONE_BITS=bits)
+            if use_gray:
+                # Values of adjacent tones differ in exactly one bit
+                differences = config.tone_values[1:] ^ config.tone_values[:-1]
+                assert all(bin(int(difference)).count('1') == 1 for difference in differences)
+            tones = bytes_to_tones(test_message, config)
             print('tones:', tones)
-            restored = tones_to_bytes(tones)
+            restored = tones_to_bytes(tones, config)
             print('restored:', restored)
             assert restored == test_message
+
+            config = ModemConfig.from_profile('mfsk', USE_GRAY_ENCODING=use_gray, TONE_BITS=bits,
+                                              CONVOLUTIONAL_CODING=True)
+            tones = bytes_to_tones(test_message, config)
+            print('coded tones:', tones)
+            # Perfect soft decisions: large positive for 0, negative for 1
+            llrs = 1 - 2.0 * config.tone_bit_table[tones].ravel()
+            restored = soft_bits_to_bytes(llrs, config)
+            print('restored:', restored)
+            assert restored[:len(test_message)] == test_message